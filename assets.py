@@ -0,0 +1,42 @@
+import os
+
+import pygame
+
+'''
+Fonts and images shared by the whole client, each loaded once on first use
+
+pygame.font.SysFont scans the system font list the first time it's
+called (running fc-list on Linux) and opens and parses the font file on
+every call, and the menu alone used to ask for the same Consolas 14 seven
+times. Everything here is looked up by name and size (or scale) and kept
+for the life of the process, so each font and image is loaded at most
+once and only when something first draws with it. Sharing font objects
+also lets gui's render cache hit across widgets.
+
+Needs pygame.init() (or pygame.font.init()) before the first font.
+'''
+asset_dir = os.path.dirname(os.path.abspath(__file__)) #images are found next to the code, whatever the working directory
+default_font = "Consolas"
+
+fonts = {} #(name, size) -> pygame.font.Font
+images = {} #(file name, scale) -> surface
+
+def font(size, name = default_font):
+    key = (name, size)
+    loaded = fonts.get(key)
+    if loaded is None:
+        loaded = fonts[key] = pygame.font.SysFont(name, size)
+    return loaded
+
+#an image file, scale > 1 gives a copy scaled up by that factor (cached as well)
+def image(file_name, scale = 1):
+    key = (file_name, scale)
+    loaded = images.get(key)
+    if loaded is None:
+        if scale == 1:
+            loaded = pygame.image.load(os.path.join(asset_dir, file_name))
+        else:
+            original = image(file_name)
+            loaded = pygame.transform.scale(original, (scale * original.get_width(), scale * original.get_height()))
+        images[key] = loaded
+    return loaded
@@ -0,0 +1,240 @@
+import asyncio
+import struct
+import time
+
+import packet
+import server
+import sim
+import stats
+
+'''
+Hands datagrams from the UDP transport to the server
+'''
+class DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+    
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data, addr)
+
+'''
+Game server running on a single asyncio event loop
+
+Accept, per-user reads, the simulation tick and the broadcast are all
+coroutines on the same loop, so matches and users are only ever touched
+from one thread. Every awake match is stepped on one shared schedule.
+With nobody connected, or every match hibernating, the tick coroutine
+waits on an event instead of polling, and self.schedule only holds the
+state timeouts of hibernating matches.
+'''
+class AsyncServer(server.Server):
+    def __init__(self, port, **kwargs):
+        super().__init__(port, **kwargs)
+        self.wake = None #set whenever a user joins or a match wakes, created on the running loop
+        self.udp_transport = None
+    
+    async def handle_user(self, reader, writer):
+        conn = self.assign(writer)
+        print("Connection Accepted! (match {})".format(conn.match.id))
+        self.wake.set()
+        await self.read_stream(conn, reader, writer)
+    
+    def adopt(self, sock):
+        asyncio.ensure_future(self.adopt_stream(sock))
+    
+    async def adopt_stream(self, sock):
+        reader, writer = await asyncio.open_connection(sock = sock)
+        self.adopted += 1
+        await self.handle_user(reader, writer)
+    
+    def adopt_users(self):
+        super().adopt_users()
+        if not self.open: #launcher gone, stop reading it and let run_matches finish
+            asyncio.get_running_loop().remove_reader(self.handoff)
+            self.wake.set()
+    
+    #awake matches all run on run_matches' schedule, it only needs waking in case it's asleep
+    def schedule_match(self, match, due):
+        self.schedule.remove(match)
+        if self.wake:
+            self.wake.set()
+    
+    async def report_status(self):
+        while self.open:
+            self.send_status(time.monotonic())
+            await asyncio.sleep(self.status_interval)
+    
+    async def handle_spectator(self, reader, writer):
+        await self.read_stream(self.add_spectator(writer), reader, writer)
+    
+    #handle everything the user sends until they disconnect
+    async def read_stream(self, conn, reader, writer):
+        try:
+            while self.open:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                recv_start = time.perf_counter()
+                self.handle_data(conn, data)
+                self.metrics.phase['recv'].record(time.perf_counter() - recv_start)
+        except (ConnectionError, ValueError, struct.error):
+            pass
+        finally:
+            self.remove_user(writer)
+    
+    def broadcast(self):
+        for match in self.matches:
+            if match.hibernating:
+                continue
+            roster, score = match.transmit()
+            for conn in match.users:
+                if not conn.sock.is_closing():
+                    self.send_update(conn, roster, score)
+                else:
+                    conn.send_failures += 1
+                    self.metrics.send_failures += 1
+            self.send_spectators(match, roster, score, time.monotonic())
+        
+        for match in self.matches:
+            if self.hibernation and not match.hibernating and self.drained(match) and match.hibernate() \
+                    and match.wake_at is not None:
+                self.schedule.set(match, match.wake_at)
+    
+    #True if every stream of the match has handed its data to the socket, a hibernating match isn't flushed
+    #again and its users wouldn't be checked for stalling
+    def drained(self, match):
+        return all(conn.sock.transport.get_write_buffer_size() == 0 for conn in match.users + match.spectators)
+    
+    #the transport buffers whatever the socket won't take, so queued data is only handed over once that's empty
+    def flush(self, conn):
+        if conn.sock.is_closing():
+            return
+        transport = conn.sock.transport
+        if transport.get_write_buffer_size() == 0:
+            data = conn.take_pending()
+            if data:
+                self.count_sent(conn, len(data))
+                conn.sock.write(data)
+        
+        self.check_backlog(conn, transport.get_write_buffer_size() > 0 or conn.has_pending())
+    
+    #streams belong to the event loop, there's nothing to unregister
+    def close_socket(self, writer):
+        writer.close()
+    
+    #handle_user sees the connection close and removes the user
+    def drop_user(self, conn):
+        conn.sock.transport.abort()
+    
+    def send_datagram(self, conn, data):
+        if packet.lose_datagram(self.loss):
+            self.metrics.datagrams_dropped += 1
+            return
+        self.count_sent(conn, len(data))
+        self.metrics.datagrams_sent += 1
+        self.udp_transport.sendto(data, conn.udp_addr)
+    
+    async def handle_admin(self, reader, writer):
+        writer.write(stats.report(self))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+    
+    #runs every match on fixed tick and transmit schedules
+    async def run_matches(self):
+        loop = asyncio.get_running_loop()
+        tick_interval = self.step_ticks * sim.Simulation.tick_interval
+        tx_interval = server.Match.tx_interval
+        
+        next_tick = next_tx = loop.time()
+        while self.open:
+            for match in self.schedule.pop_due(time.time()): #state timeouts
+                match.wake(time.time())
+            
+            if all(match.hibernating for match in self.matches): #nothing to simulate, sleep until someone connects or does something
+                self.wake.clear()
+                wake_at = self.schedule.next_due()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), None if wake_at is None else max(0, wake_at - time.time()))
+                except asyncio.TimeoutError:
+                    pass
+                if not self.open:
+                    break
+                next_tick = next_tx = loop.time()
+                continue
+            
+            now = loop.time()
+            work_start = time.perf_counter()
+            worked = now >= next_tick or now >= next_tx
+            if now >= next_tick:
+                self.tick_stats.record(now - next_tick)
+                
+                wall = time.time()
+                for match in self.matches:
+                    if not match.hibernating:
+                        match.step()
+                        match.last_tick = wall #what a hibernating match catches up from
+                        self.metrics.ticks += 1
+                self.metrics.phase['simulate'].record(time.perf_counter() - work_start)
+                
+                next_tick += tick_interval
+                if now - next_tick > tick_interval: #fell far behind, don't try to catch up
+                    next_tick = now + tick_interval
+            
+            if now >= next_tx:
+                broadcast_start = time.perf_counter()
+                self.broadcast()
+                self.metrics.phase['broadcast'].record(time.perf_counter() - broadcast_start)
+                
+                next_tx += tx_interval
+                if now - next_tx > tx_interval:
+                    next_tx = now + tx_interval
+            
+            if worked:
+                self.work_stats.record(time.perf_counter() - work_start)
+            
+            await asyncio.sleep(min(next_tick, next_tx) - loop.time())
+    
+    async def serve(self):
+        self.wake = asyncio.Event()
+        
+        if self.udp:
+            loop = asyncio.get_running_loop()
+            self.udp_transport, protocol = await loop.create_datagram_endpoint(lambda: DatagramProtocol(self),
+                                                                            sock = self.udp_sock)
+        
+        if self.admin_sock:
+            await asyncio.start_server(self.handle_admin, sock = self.admin_sock)
+        if self.spectator_sock:
+            await asyncio.start_server(self.handle_spectator, sock = self.spectator_sock)
+        
+        if self.handoff:
+            asyncio.get_running_loop().add_reader(self.handoff, self.adopt_users)
+            asyncio.create_task(self.report_status())
+            await self.run_matches()
+            return
+        
+        listener = await asyncio.start_server(self.handle_user, sock = self.sock)
+        async with listener:
+            await self.run_matches()
+
+def main(port, **kwargs):
+    s = AsyncServer(port, **kwargs)
+    s.start()
+    
+    s.listen()
+    print("Waiting for connections...")
+    
+    try:
+        asyncio.run(s.serve())
+    except KeyboardInterrupt:
+        print("Keyboard interrupt: killing server")
+        print(s.tick_stats)
+        print(s.work_stats)
+    for match in s.matches: #also when serve returns because a launcher closed the handoff
+        match.close()
+
+if __name__ == '__main__':
+    main(10000)
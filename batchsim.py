@@ -0,0 +1,220 @@
+import math
+
+import numpy as np
+
+import packet
+import sim
+
+'''
+Player inputs for a batch of matches, one array entry per match
+'''
+class BatchInput:
+    def __init__(self, n):
+        self.p1y = np.full(n, 45, dtype = np.int64) #paddle y positions
+        self.p2y = np.full(n, 45, dtype = np.int64)
+        self.p1_key = np.zeros(n, dtype = np.int64) #key presses, cleared once a serve is taken
+        self.p2_key = np.zeros(n, dtype = np.int64)
+        self.players = np.zeros(n, dtype = np.int64) #number of players in each match
+
+'''
+Vectorized version of sim.Simulation
+
+Holds the state of n matches in arrays and advances all of them at once
+with the same rules as sim.Simulation.step_once, so match i of a batch
+and a Simulation fed the same inputs stay identical tick for tick.
+'''
+class BatchSimulation:
+    w_court = sim.Simulation.w_court
+    h_court = sim.Simulation.h_court
+    paddle_sep = sim.Simulation.paddle_sep
+    paddle_len = sim.Simulation.paddle_len
+    
+    end_ticks = sim.Simulation.end_ticks
+    
+    ball_speed = sim.Simulation.ball_speed
+    max_bounces = sim.Simulation.max_bounces
+    
+    win_score = sim.Simulation.win_score
+    
+    left_plane = sim.Simulation.left_plane
+    right_plane = sim.Simulation.right_plane
+    
+    def __init__(self, n, step_ticks = 1):
+        self.n = n
+        self.step_ticks = step_ticks #ticks of game time per step
+        
+        self.ball_x = np.full(n, -2.0) #float ball position and velocity
+        self.ball_y = np.full(n, -2.0)
+        self.vel_x = np.zeros(n)
+        self.vel_y = np.zeros(n)
+        self.ball_carry = np.zeros(n) #ticks of movement left over when a step ran out of bounces
+        
+        self.p1y = np.full(n, 45, dtype = np.int64)
+        self.p2y = np.full(n, 45, dtype = np.int64)
+        self.score = np.zeros((n, 2), dtype = np.int64) #(p1, p2) per match
+        self.server = np.full(n, 3, dtype = np.int64) #same states as GamePacket.server
+        
+        self.tick = 0 #every match is stepped together so they share a tick count
+        self.last_hit = np.full(n, -1.0)
+        self.end_start = np.zeros(n, dtype = np.int64)
+    
+    #advance every match n steps with the same inputs
+    def step(self, inputs, n = 1):
+        for i in range(n):
+            self.step_once(inputs)
+    
+    def step_once(self, inputs):
+        self.tick += self.step_ticks
+        
+        self.p1y[:] = inputs.p1y
+        self.p2y[:] = inputs.p2y
+        
+        p1_score = self.score[:, 0]
+        p2_score = self.score[:, 1]
+        enough_players = inputs.players >= 2
+        
+        #each match takes exactly one transition branch, chosen by its state at the start of the tick
+        in_game = self.server == 0
+        p1_serve = self.server == 1
+        p2_serve = self.server == 2
+        waiting = self.server == 3
+        ended = self.server == 4
+        
+        '''
+        State machine transitions
+        '''
+        #out of bounds
+        out_p1 = in_game & (self.ball_x < 0)
+        out_p2 = in_game & ~out_p1 & (self.ball_x > self.w_court)
+        out = out_p1 | out_p2
+        self.ball_x[out] = 80
+        self.ball_y[out] = 100
+        p2_score[out_p1] += 1
+        p1_score[out_p2] += 1
+        self.server[out_p1] = 2
+        self.server[out_p2] = 1
+        
+        won = in_game & ((p1_score > self.win_score) | (p2_score > self.win_score))
+        self.end_start[won] = self.tick
+        self.server[won] = 4
+        
+        #serves
+        self.server[(p1_serve | p2_serve) & ~enough_players] = 3
+        
+        serve_p1 = p1_serve & enough_players & (inputs.p1_key == 32)
+        self.ball_x[serve_p1] = self.paddle_sep + 1
+        self.ball_y[serve_p1] = self.p1y[serve_p1]
+        self.vel_x[serve_p1] = self.ball_speed
+        self.vel_y[serve_p1] = 0
+        self.ball_carry[serve_p1] = 0
+        self.server[serve_p1] = 0
+        inputs.p1_key[serve_p1] = 0
+        
+        serve_p2 = p2_serve & enough_players & (inputs.p2_key == 32)
+        self.ball_x[serve_p2] = self.w_court - self.paddle_sep - 1
+        self.ball_y[serve_p2] = self.p2y[serve_p2]
+        self.vel_x[serve_p2] = -self.ball_speed
+        self.vel_y[serve_p2] = 0
+        self.ball_carry[serve_p2] = 0
+        self.server[serve_p2] = 0
+        inputs.p2_key[serve_p2] = 0
+        
+        #wait for players
+        self.server[waiting & enough_players] = 1
+        
+        #end, winner serves first
+        done = ended & (self.tick - self.end_start > self.end_ticks)
+        p1_won = done & (p1_score > p2_score) & enough_players
+        p2_won = done & ~p1_won & (p2_score > p1_score) & enough_players
+        self.server[done] = 3
+        self.server[p1_won] = 1
+        self.server[p2_won] = 2
+        self.score[done] = 0
+        self.ball_x[done] = 80
+        self.ball_y[done] = 100
+        
+        '''
+        State machine actions
+        '''
+        self.move_ball(self.server == 0, self.tick - self.step_ticks, self.step_ticks)
+    
+    #same sweep as sim.Simulation.move_ball: every moving match advances to its next crossing
+    #each round, and drops out once the rest of its move is clear
+    def move_ball(self, moving, start, duration):
+        remaining = float(duration) + self.ball_carry
+        self.ball_carry[moving] = 0
+        playing = moving
+        for i in range(self.max_bounces):
+            if not moving.any():
+                break
+            x, y = self.ball_x, self.ball_y
+            v_x, v_y = self.vel_x, self.vel_y
+            
+            #earliest crossing before the end of the move, paddles win ties with walls
+            t = remaining.copy()
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                left = moving & (v_x < 0) & (x > self.left_plane)
+                left &= (self.left_plane - x) / v_x <= t
+                np.divide(self.left_plane - x, v_x, out = t, where = left)
+                
+                right = moving & (v_x > 0) & (x < self.right_plane)
+                right &= (self.right_plane - x) / v_x <= t
+                np.divide(self.right_plane - x, v_x, out = t, where = right)
+                
+                wall_y = np.where(v_y < 0, 0.0, self.h_court)
+                t_wall = np.maximum(0, (wall_y - y) / v_y)
+                wall = moving & (v_y != 0) & (t_wall < t)
+            t[wall] = t_wall[wall]
+            left &= ~wall
+            right &= ~wall
+            crossing = left | right | wall
+            
+            remaining[crossing] -= t[crossing]
+            x[wall] += v_x[wall] * t[wall]
+            y[wall] = wall_y[wall]
+            np.negative(v_y, out = v_y, where = wall)
+            
+            paddle = left | right
+            y[paddle] += v_y[paddle] * t[paddle]
+            x[left] = self.left_plane
+            x[right] = self.right_plane
+            
+            #paddle hits
+            hit = (left & (np.abs(self.p1y - y) <= self.paddle_len/2)) | (right & (np.abs(self.p2y - y) <= self.paddle_len/2))
+            if hit.any():
+                self.hit_velocity(hit, np.where(left, self.p1y, self.p2y))
+                self.last_hit[hit] = start + duration - remaining[hit]
+            
+            moving = crossing
+        
+        #still crossing after the last round: out of bounces, wait there and carry the rest over
+        self.ball_carry[moving] = remaining[moving]
+        playing = playing & ~moving
+        self.ball_x[playing] += self.vel_x[playing] * remaining[playing]
+        self.ball_y[playing] += self.vel_y[playing] * remaining[playing]
+    
+    #same as sim.Simulation.get_velocity_from_hit for the matches selected by hit
+    def hit_velocity(self, hit, player_y):
+        v_x = -self.vel_x[hit]
+        v_y = self.vel_y[hit]
+        m = np.sqrt(v_x ** 2 + v_y ** 2) #vector magnitude
+        direction = v_x / np.abs(v_x) #1 = right, -1 = left
+        offset = player_y[hit] - self.ball_y[hit]
+        
+        centre = np.abs(offset) <= self.paddle_len/6
+        self.vel_x[hit] = np.where(centre, m * direction, m * direction * 1/math.sqrt(2))
+        self.vel_y[hit] = np.where(centre, 0, np.where(offset < 0, m * 1/math.sqrt(2), m * -1/math.sqrt(2)))
+    
+    #integer ball positions, as sent to clients
+    def ball(self):
+        return np.trunc(self.ball_x).astype(np.int64), np.trunc(self.ball_y).astype(np.int64)
+    
+    #GamePacket for a single match of the batch
+    def state(self, i):
+        state = packet.GamePacket()
+        state.ball = (int(self.ball_x[i]), int(self.ball_y[i]))
+        state.p1y = int(self.p1y[i])
+        state.p2y = int(self.p2y[i])
+        state.score = (int(self.score[i, 0]), int(self.score[i, 1]))
+        state.server = int(self.server[i])
+        return state
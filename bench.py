@@ -0,0 +1,723 @@
+import argparse
+import asyncio
+import os
+import socket
+import threading
+import time
+import math
+import collections
+import struct
+
+import packet
+import sim
+import server
+import asyncserver
+import netclient
+
+'''
+Benchmarks, run with: python bench.py <name>
+'''
+
+def run_select_server(s):
+    while s.open:
+        s.tick()
+
+def run_async_server(s):
+    asyncio.run(s.serve())
+
+engines = {
+    'select' : (server.Server, run_select_server),
+    'asyncio' : (asyncserver.AsyncServer, run_async_server),
+}
+
+def start_engine(engine, port, **kwargs):
+    server_class, runner = engines[engine]
+    s = server_class(port, **kwargs)
+    s.start()
+    s.listen()
+    threading.Thread(target = runner, args = (s,), daemon = True).start()
+    return s
+
+#cpu used by the whole process while a server sits with nobody connected
+def bench_idle(args):
+    for i, engine in enumerate(args.engines):
+        start_engine(engine, args.port + i)
+        time.sleep(0.2) #let the engine settle
+        
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        time.sleep(args.seconds)
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        
+        print("{:8} idle cpu: {:.2f}%".format(engine, 100 * cpu / wall))
+
+#tick jitter with one full match of silent players connected
+def bench_jitter(args):
+    for i, engine in enumerate(args.engines):
+        s = start_engine(engine, args.port + i)
+        
+        users = []
+        for name in ("p1", "p2"):
+            user = socket.create_connection(('127.0.0.1', args.port + i))
+            user.sendall(packet.frame(packet.HelloPacket(name).pack_bytes()))
+            users.append(user)
+        
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        time.sleep(args.seconds)
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        
+        print("{:8} cpu: {:.2f}%, {}".format(engine, 100 * cpu / wall, s.tick_stats))
+        for user in users:
+            user.close()
+
+#scripted players for headless runs: chase the ball at half a unit per tick, aiming off-centre by a
+#drifting amount so rallies angle off and points get scored, and serve straight away
+def autopilot(simulation, inputs):
+    state = simulation.state
+    moves = (simulation.tick + simulation.step_ticks + 1) // 2 - (simulation.tick + 1) // 2 #even ticks in the coming step
+    if moves:
+        aim = state.ball[1] + (simulation.tick // 300) % 7 - 3
+        aim = max(simulation.paddle_len, min(simulation.h_court - simulation.paddle_len, aim)) #the ball parks off court between points
+        inputs.p1y += max(-moves, min(moves, aim - inputs.p1y))
+        inputs.p2y += max(-moves, min(moves, aim - inputs.p2y))
+    
+    inputs.p1_key = 32 if state.server == 1 else 0
+    inputs.p2_key = 32 if state.server == 2 else 0
+
+#play a headless match for the given number of ticks, calls on_tick(simulation) after every step
+def play_match(ticks, on_tick = None, step_ticks = 1, ball_speed = 1):
+    simulation = sim.Simulation(step_ticks)
+    simulation.ball_speed = ball_speed
+    inputs = sim.PlayerInput()
+    inputs.players = 2
+    
+    while simulation.tick < ticks:
+        autopilot(simulation, inputs)
+        simulation.step(inputs)
+        if on_tick:
+            on_tick(simulation)
+    return simulation
+
+#raw simulation speed and a determinism check
+def bench_sim(args):
+    ticks = int(args.seconds * 100000)
+    
+    start = time.perf_counter()
+    simulation = play_match(ticks)
+    elapsed = time.perf_counter() - start
+    print("autopilot match: {:.1f} ticks/ms ({} ticks, score {})".format(ticks / elapsed / 1000, ticks, simulation.state.score))
+    
+    inputs = sim.PlayerInput()
+    inputs.players = 2
+    inputs.p1_key = 32
+    simulation = sim.Simulation()
+    start = time.perf_counter()
+    simulation.step(inputs, ticks)
+    elapsed = time.perf_counter() - start
+    print("step(n):         {:.1f} ticks/ms".format(ticks / elapsed / 1000))
+    
+    runs = []
+    for i in range(2):
+        states = []
+        play_match(ticks // 10, lambda simulation: states.append(simulation.state.pack_bytes()))
+        runs.append(states)
+    print("deterministic:   {}".format(runs[0] == runs[1]))
+
+#batched engine throughput in matches x ticks per second, needs numpy
+def bench_batch(args):
+    import numpy as np
+    import batchsim
+    
+    for n in args.matches:
+        batch = batchsim.BatchSimulation(n)
+        inputs = batchsim.BatchInput(n)
+        inputs.players[:] = 2
+        
+        ticks = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.seconds:
+            #same policy as autopilot, for every match at once
+            if batch.tick % 2 == 0:
+                ball_x, ball_y = batch.ball()
+                aim = ball_y + (batch.tick // 300) % 7 - 3
+                inputs.p1y += np.sign(aim - inputs.p1y)
+                inputs.p2y += np.sign(aim - inputs.p2y)
+            inputs.p1_key[:] = np.where(batch.server == 1, 32, 0)
+            inputs.p2_key[:] = np.where(batch.server == 2, 32, 0)
+            
+            batch.step(inputs)
+            ticks += 1
+        elapsed = time.perf_counter() - start
+        
+        print("{:7} matches: {:.0f} ticks/s, {:.2f}M match-ticks/s".format(n, ticks / elapsed, n * ticks / elapsed / 1e6))
+
+#bytes per second for one full scripted match, old fixed GamePacket/PlayerPacket format vs framed messages
+def bench_bandwidth(args):
+    simulation = sim.Simulation()
+    inputs = sim.PlayerInput()
+    inputs.players = 2
+    simulation.state.p1_name = "player one"
+    simulation.state.p2_name = "player two"
+    
+    tx_ticks = math.ceil(server.Match.tx_interval / simulation.tick_interval) #ticks between transmits
+    snapshots = packet.SnapshotHistory()
+    encoders = [packet.SnapshotEncoder(snapshots), packet.SnapshotEncoder(snapshots)]
+    decoders = [packet.SnapshotDecoder(), packet.SnapshotDecoder()]
+    last_shared = [None, None]
+    last_input = None
+    player = netclient.Client("player one") #builds the inputs messages the way the client does, never connected
+    session = player.session
+    last_datagram = 0 #time of the last inputs datagram
+    old = {'down' : 0, 'up' : 0}
+    new = {'down' : 0, 'up' : 0}
+    udp = {'up' : 0} #upstream with the UDP transport, every message in a datagram behind the token
+    
+    while simulation.state.server != 4 and simulation.tick < 10000000:
+        autopilot(simulation, inputs)
+        simulation.step(inputs)
+        now = simulation.tick * simulation.tick_interval
+        
+        changed = (inputs.p1y, inputs.p1_key) != last_input
+        if changed: #clients only send when their input changes
+            session.add_input(inputs.p1y, inputs.p1_key, now)
+            old['up'] += packet.PlayerPacket("player one", inputs.p1y).length
+            new['up'] += len(packet.frame(session.inputs_message(1))) #the stream is reliable, only the newest input
+            last_input = (inputs.p1y, inputs.p1_key)
+        if changed or now - last_datagram > player.input_resend_interval: #over UDP the newest inputs also go out again now and then
+            udp['up'] += packet.datagram_header.size + len(packet.frame(session.inputs_message(len(session.recent_inputs))))
+            last_datagram = now
+        
+        if simulation.tick % tx_ticks == 0:
+            state = simulation.state
+            snapshots.update(state, simulation.tick)
+            shared = (packet.RosterPacket(state.p1_name, state.p2_name).pack_bytes(),
+                    packet.ScorePacket(state.score, state.server).pack_bytes())
+            for i in range(2):
+                old['down'] += state.length
+                
+                for message, last in zip(shared, last_shared[i] or (None, None)):
+                    if message != last:
+                        new['down'] += len(packet.frame(message))
+                last_shared[i] = shared
+                
+                snapshot = encoders[i].frame()
+                new['down'] += len(snapshot)
+                seq, tick, fields = decoders[i].decode(snapshot[packet.frame_header.size:])
+                encoders[i].ack(seq)
+            ack = packet.frame(packet.AckPacket().pack_bytes())
+            new['up'] += len(ack)
+            udp['up'] += packet.datagram_header.size + len(ack)
+    
+    seconds = simulation.tick * simulation.tick_interval
+    print("match: {:.0f} s of play, final score {}".format(seconds, simulation.state.score))
+    for name, counts in (("old", old), ("new", new)):
+        print("{}: {:.0f} B/s down per client, {:.0f} B/s up per client".format(name, counts['down'] / 2 / seconds, counts['up'] / seconds))
+    print("saved: {:.0f}% down, {:.0f}% up".format(100 - 100 * new['down'] / old['down'], 100 - 100 * new['up'] / old['up']))
+    print("udp: {:.0f} B/s up per client, inputs resent up to {} at a time".format(udp['up'] / seconds,
+                                                                                    session.recent_inputs.maxlen))
+
+#end to end UDP transport over localhost with datagrams dropped in both directions
+def bench_udp(args):
+    for i, engine in enumerate(args.engines):
+        port = args.port + i
+        s = start_engine(engine, port, udp = True, loss = args.loss)
+        
+        players = []
+        for name in ("p1", "p2"):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(packet.frame(packet.HelloPacket(name).pack_bytes()))
+            
+            frames = packet.FrameBuffer()
+            welcome = None
+            while welcome is None: #snapshots may arrive over TCP until the UDP transport is up
+                for raw in frames.feed(sock.recv(4096)):
+                    if raw[0] == packet.MSG_WELCOME:
+                        welcome = packet.WelcomePacket()
+                        welcome.unpack_bytes(raw)
+            sock.setblocking(False)
+            
+            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_sock.connect(('127.0.0.1', welcome.udp_port))
+            udp_sock.setblocking(False)
+            players.append({'sock' : sock, 'udp' : udp_sock, 'token' : welcome.token,
+                            'decoder' : packet.SnapshotDecoder(), 'inputs' : collections.deque(maxlen = 3),
+                            'received' : 0, 'stale' : 0, 'gap' : 0, 'last' : None, 'pos' : 45})
+        
+        def send(player, message):
+            data = packet.datagram_header.pack(player['token']) + packet.frame(message)
+            packet.send_datagram(player['udp'], data, loss = args.loss)
+        
+        start = time.perf_counter()
+        seq = 0
+        while time.perf_counter() - start < args.seconds + 0.5:
+            now = time.perf_counter()
+            seq += 1
+            for n, player in enumerate(players):
+                if now - start < args.seconds: #move, then hold still at the end so the last input can settle
+                    player['pos'] = 45 + int(30 * math.sin(now * (2 + n)))
+                player['inputs'].append((seq & 0xFFFF, int(time.time() / sim.Simulation.tick_interval) & 0xFFFF, player['pos'], 0))
+                send(player, packet.InputsPacket(player['inputs']).pack_bytes())
+                
+                try:
+                    player['sock'].recv(65536) #roster and score, unused here
+                except BlockingIOError:
+                    pass
+                
+                while True:
+                    try:
+                        data = player['udp'].recv(packet.max_datagram_length)
+                    except BlockingIOError:
+                        break
+                    for raw in packet.datagram_messages(data):
+                        decoded = player['decoder'].decode(raw)
+                        if decoded is None:
+                            player['stale'] += 1
+                            continue
+                        player['received'] += 1
+                        if player['last']:
+                            player['gap'] = max(player['gap'], now - player['last'])
+                        player['last'] = now
+                        send(player, packet.AckPacket(decoded[0]).pack_bytes())
+            time.sleep(0.01)
+        
+        match = s.matches[0]
+        expected = (args.seconds + 0.5) / server.Match.tx_interval
+        print("{:8} loss {:.0%}:".format(engine, args.loss))
+        for n, player in enumerate(players):
+            applied = match.inputs.p1y if n == 0 else match.inputs.p2y
+            print("    p{}: {} snapshots (~{:.0f}% of sent), {} dropped as stale/unusable, worst gap {:.0f} ms, final input {} on server {}".format(
+                n + 1, player['received'], 100 * player['received'] / expected, player['stale'], player['gap'] * 1000,
+                player['pos'], "matches" if applied == player['pos'] else "MISMATCH ({})".format(applied)))
+            player['sock'].close()
+            player['udp'].close()
+
+#the per-call codec from before precompiled structs, kept as the baseline for bench_codec
+def legacy_roster(p1_name, p2_name):
+    struct.calcsize('!B16s16s') #every packet object used to work out its own length
+    return struct.pack('!B16s16s', packet.MSG_ROSTER, bytes(p1_name, 'utf-8'), bytes(p2_name, 'utf-8'))
+
+def legacy_game_packet(state):
+    struct.calcsize('hhhh16s16sBBB')
+    return struct.pack('hhhh16s16sBBB', state.ball[0], state.ball[1], state.p1y, state.p2y,
+                    bytes(state.p1_name, 'utf-8'), bytes(state.p2_name, 'utf-8'),
+                    state.score[0], state.score[1], state.server)
+
+def legacy_delta(seq, fields, base):
+    mask = 0
+    diffs = []
+    for i in range(4):
+        diff = fields[i] - base[i]
+        if diff != 0:
+            mask |= 1 << i
+            if -128 <= diff <= 127:
+                diffs.append(struct.pack('!b', diff))
+            else:
+                mask |= 16 << i
+                diffs.append(struct.pack('!h', diff))
+    return packet.frame(struct.pack(packet.delta_format, packet.MSG_DELTA, seq, 1, 3, mask) + b''.join(diffs))
+
+def legacy_feed(buffer, data):
+    buffer.extend(data)
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= 2:
+        length = struct.unpack_from('!H', buffer, offset)[0]
+        if len(buffer) - offset - 2 < length:
+            break
+        offset += 2
+        messages.append(bytes(buffer[offset:offset + length]))
+        offset += length
+    del buffer[:offset]
+    return messages
+
+#ns per operation for the packet codec, the old per-call struct formats against precompiled structs
+def bench_codec(args):
+    state = packet.GamePacket()
+    state.ball = (80, 45)
+    state.p1_name = "player one"
+    state.p2_name = "player two"
+    base = (77, 43, 40, 50)
+    
+    def snapshot_for(users):
+        snapshots = packet.SnapshotHistory()
+        encoders = [packet.SnapshotEncoder(snapshots) for i in range(users)]
+        snapshots.update(state)
+        for encoder in encoders:
+            encoder.ack(snapshots.seq)
+        def transmit():
+            snapshots.update(state)
+            for encoder in encoders:
+                encoder.frame()
+        return transmit
+    
+    received = b''.join(packet.frame(packet.InputPacket(45, 0).pack_bytes()) for i in range(4))
+    frames = packet.FrameBuffer()
+    legacy_buffer = bytearray()
+    fields = packet.snapshot_fields(state)
+    
+    cases = [
+        ("roster pack", lambda: legacy_roster(state.p1_name, state.p2_name),
+                        lambda: packet.RosterPacket(state.p1_name, state.p2_name).pack_bytes()),
+        ("GamePacket pack", lambda: legacy_game_packet(state), state.pack_bytes),
+        ("snapshot, 2 users", lambda: [legacy_delta(1, fields, base) for i in range(2)], snapshot_for(2)),
+        ("snapshot, 16 users", lambda: [legacy_delta(1, fields, base) for i in range(16)], snapshot_for(16)),
+        ("receive 4 inputs", lambda: legacy_feed(legacy_buffer, received), lambda: frames.feed(received)),
+    ]
+    
+    number = max(1, int(args.seconds * 20000))
+    for name, before, after in cases:
+        results = []
+        for function in (before, after):
+            start = time.perf_counter()
+            for i in range(number):
+                function()
+            results.append((time.perf_counter() - start) / number * 1e9)
+        print("{:20} before: {:7.0f} ns/op, after: {:7.0f} ns/op ({:.1f}x)".format(name, results[0], results[1], results[0] / results[1]))
+
+#client frame time as HUD texts are added, rendering every frame vs the gui render cache
+def bench_gui(args):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import gui
+    pygame.init()
+    
+    font = pygame.font.SysFont("Consolas", 14)
+    surface = pygame.Surface((320, 180))
+    frames = max(1, int(args.seconds * 200))
+    for count in (4, 16, 64):
+        texts = [gui.Text("HUD text {}".format(i), (160, 90), font) for i in range(count)]
+        
+        results = []
+        for cached in (False, True):
+            start = time.perf_counter()
+            for frame in range(frames):
+                texts[0].text = "Score {}".format(frame // 100) #one text changing now and then, like the score
+                for text in texts:
+                    if cached:
+                        text.draw(surface)
+                    else:
+                        surface.blit(font.render(text.text, False, text.color), (0, 0))
+            results.append((time.perf_counter() - start) / frames * 1e6)
+        print("{:3} texts: {:7.1f} us/frame uncached, {:6.1f} us/frame cached".format(count, *results))
+
+#points lost by a player who tracks the ball perfectly but whose inputs reach the server late,
+#with and without lag compensation
+def bench_lag(args):
+    ticks = int(args.seconds * 20000)
+    for delay in (0, 5, 10, 15):
+        results = []
+        for compensate in (False, True):
+            simulation = sim.Simulation()
+            inputs = sim.PlayerInput()
+            inputs.players = 2
+            seen = sim.PlayerInput() #what player 1 has on their own screen
+            in_flight = collections.deque() #player 1's inputs on their way to the server
+            
+            lost = [0, 0] #points lost by (p1, p2), scores reset every match so count them as they happen
+            for i in range(ticks):
+                autopilot(simulation, seen)
+                seen.p1y = max(simulation.paddle_len, min(simulation.h_court - simulation.paddle_len,
+                                                          simulation.state.ball[1])) #player 1 keeps the paddle on the ball as they see it
+                in_flight.append((seen.p1y, seen.p1_key))
+                if len(in_flight) > delay:
+                    inputs.p1y, inputs.p1_key = in_flight.popleft()
+                inputs.p2y, inputs.p2_key = seen.p2y, seen.p2_key
+                inputs.p1_lag = delay if compensate else 0
+                
+                playing = simulation.state.server == 0
+                simulation.step(inputs)
+                if playing and simulation.state.server != 0:
+                    score = simulation.state.score
+                    if simulation.state.server == 4: #match point
+                        lost[0 if score[0] < score[1] else 1] += 1
+                    else:
+                        lost[2 - simulation.state.server] += 1
+            
+            results.append(lost)
+        
+        print("delay {:2} ticks: points lost (p1, p2) without compensation {}, with {}".format(delay, *results))
+
+#the same autopilot match simulated at lower tick rates and with faster balls: cost per second of
+#game time, and rallies and points, which should barely move if the sweep keeps gameplay the same
+def bench_tickrate(args):
+    ticks = int(args.seconds * 20000)
+    for step_ticks, ball_speed in ((1, 1), (2, 1), (4, 1), (5, 1), (10, 1), (5, 2), (5, 4)):
+        counts = {'hits' : 0, 'points' : 0, 'last_hit' : -1, 'playing' : False}
+        def count(simulation):
+            if simulation.last_hit != counts['last_hit']:
+                counts['hits'] += 1
+                counts['last_hit'] = simulation.last_hit
+            playing = simulation.state.server == 0
+            if counts['playing'] and not playing:
+                counts['points'] += 1
+            counts['playing'] = playing
+        
+        start = time.process_time()
+        simulation = play_match(ticks, count, step_ticks, ball_speed)
+        cpu = time.process_time() - start
+        
+        game_seconds = simulation.tick * simulation.tick_interval
+        print("{:4.0f} Hz, ball speed {}: {:6.1f} us cpu per game second, {} points, {:.1f} hits per point".format(
+            1 / simulation.step_interval, ball_speed, cpu / game_seconds * 1e6, counts['points'],
+            counts['hits'] / max(1, counts['points'])))
+
+#cost of recording a match on the tick path, size of the log and how fast it replays
+def bench_record(args):
+    import record
+    import tempfile
+    
+    ticks = int(args.seconds * 20000)
+    with tempfile.TemporaryDirectory() as directory:
+        timings = []
+        for recording in (False, True):
+            simulation = sim.Simulation()
+            inputs = sim.PlayerInput()
+            inputs.players = 2
+            recorder = record.Recorder(os.path.join(directory, "match.npr"), simulation) if recording else None
+            
+            start = time.perf_counter()
+            while simulation.tick < ticks:
+                autopilot(simulation, inputs)
+                if recorder:
+                    recorder.record_step(simulation, inputs)
+                    simulation.step(inputs)
+                    recorder.stepped(simulation, inputs)
+                else:
+                    simulation.step(inputs)
+            timings.append((time.perf_counter() - start) / simulation.tick)
+        recorder.close(simulation)
+        
+        path = os.path.join(directory, "match.npr")
+        minutes = simulation.tick * simulation.tick_interval / 60
+        print("step: {:.2f} us, recording: {:.2f} us".format(timings[0] * 1e6, timings[1] * 1e6))
+        print("log: {:.1f} KiB per minute of play".format(os.path.getsize(path) / 1024 / minutes))
+        
+        replay = record.Replay(record.Recording(path), verify = True)
+        start = time.perf_counter()
+        while replay.step():
+            pass
+        elapsed = time.perf_counter() - start
+        print("replay: {:.0f}x real time, {} keyframes checked, {} mismatched".format(minutes * 60 / elapsed, replay.checked,
+                                                                                  len(replay.mismatches)))
+        replay.recording.close()
+
+#relay process for bench_spectators
+def run_relay(server_port, port):
+    import relay
+    asyncio.run(relay.Relay('127.0.0.1', server_port, port).serve())
+
+#time the server spends sending per transmit to a full match and its spectators, with the spectators
+#connected straight to the server and then behind a relay in its own process
+def bench_spectators(args):
+    import multiprocessing
+    import stats
+    
+    for i, engine in enumerate(args.engines):
+        for j, via_relay in enumerate((False, True)):
+            port = args.port + 10 * i + 4 * j
+            s = start_engine(engine, port, spectator_port = port + 2)
+            
+            users = []
+            for name in ("p1", "p2"):
+                user = socket.create_connection(('127.0.0.1', port))
+                user.sendall(packet.frame(packet.HelloPacket(name).pack_bytes()))
+                users.append(user)
+            
+            relay_proc = None
+            watch_port = port + 2
+            if via_relay:
+                relay_proc = multiprocessing.Process(target = run_relay, args = (port + 2, port + 3), daemon = True)
+                relay_proc.start()
+                watch_port = port + 3
+                time.sleep(1) #let the relay start listening
+            for k in range(args.spectators):
+                user = socket.create_connection(('127.0.0.1', watch_port))
+                user.sendall(packet.frame(packet.WatchPacket().pack_bytes()))
+                users.append(user)
+            
+            time.sleep(0.5)
+            s.metrics.phase['broadcast'] = stats.Histogram()
+            time.sleep(args.seconds)
+            print("{:8} {} spectators {:6}: server broadcast ms {}, server spectators: {}".format(
+                engine, args.spectators, "relay" if via_relay else "direct", s.metrics.phase['broadcast'],
+                sum(len(match.spectators) for match in s.matches)))
+            
+            for user in users:
+                user.close()
+            if relay_proc:
+                relay_proc.terminate()
+                relay_proc.join()
+
+#seconds from a fresh interpreter starting to the first snapshot arriving, over the pygame-free blocking and
+#asyncio clients and the pygame client, each run in its own process so imports are paid in full
+connect_probes = {
+    'netclient' : """
+import netclient
+c = netclient.Client('probe')
+c.connect('127.0.0.1', {port})
+while not c.session.newest:
+    c.poll(1)
+""",
+    'netclient async' : """
+import asyncio, netclient
+async def probe():
+    c = netclient.AsyncClient('probe')
+    await c.connect('127.0.0.1', {port})
+    while not c.session.newest:
+        await c.receive()
+asyncio.run(probe())
+""",
+    'pygame client' : """
+import pygame, client
+pygame.init()
+game = client.Game()
+game.attempt_connection('127.0.0.1', {port}, 'probe')
+while not game.published or not game.published[0]:
+    time.sleep(0.001)
+""",
+}
+
+def bench_connect(args):
+    import subprocess
+    import sys
+    import statistics
+    
+    env = dict(os.environ, SDL_VIDEODRIVER = 'dummy', PYGAME_HIDE_SUPPORT_PROMPT = '1')
+    here = os.path.dirname(os.path.abspath(__file__))
+    for i, engine in enumerate(args.engines):
+        start_engine(engine, args.port + i)
+        for name, probe in connect_probes.items():
+            code = "import time\nstart = time.perf_counter()\n" + probe.format(port = args.port + i) + \
+                   "print(time.perf_counter() - start)\n"
+            times = []
+            for run in range(args.runs):
+                out = subprocess.run([sys.executable, '-c', code], cwd = here, env = env, capture_output = True,
+                                     text = True, timeout = 30).stdout
+                times.append(float(out.split()[-1]) * 1000)
+            print("{:8} {:16} import to first snapshot: median {:6.1f} ms, min {:6.1f} ms".format(
+                engine, name, statistics.median(times), min(times)))
+
+#the client's font and image loading as it was before assets.py: a SysFont and image load wherever one
+#is used, and every gui.Button loading a font of its own even when it's given one
+def legacy_assets():
+    import pygame
+    import assets
+    import gui
+    assets.font = lambda size, name = assets.default_font: pygame.font.SysFont(name, size)
+    assets.image = lambda file_name, scale = 1: pygame.transform.scale_by(pygame.image.load(file_name), scale)
+    button_init = gui.Button.__init__
+    def init(self, pos, size, **kwargs):
+        kwargs.setdefault('font', pygame.font.SysFont("Consolas", 14))
+        button_init(self, pos, size, **kwargs)
+    gui.Button.__init__ = init
+
+#time from client.main() being called in a fresh interpreter to its first menu frame, loading assets as
+#before assets.py and through it, each run in its own process (imports are timed separately, they're the same)
+def bench_startup(args):
+    import subprocess
+    import sys
+    import statistics
+    
+    env = dict(os.environ, SDL_VIDEODRIVER = 'dummy', PYGAME_HIDE_SUPPORT_PROMPT = '1')
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name, setup in (("before", "bench.legacy_assets()\n"), ("assets", "")):
+        code = ("import time\n"
+                "start = time.perf_counter()\n"
+                "import bench, pygame, client\n"
+                "loads = []\n"
+                "sys_font = pygame.font.SysFont\n"
+                "pygame.font.SysFont = lambda *args, **kwargs: loads.append(args) or sys_font(*args, **kwargs)\n" + setup +
+                "pygame.event.get = lambda *args, **kwargs: [pygame.event.Event(pygame.QUIT)] #leave after one frame\n"
+                "imported = time.perf_counter()\n"
+                "client.main(fps = 0)\n"
+                "print(len(loads), imported - start, time.perf_counter() - imported)\n")
+        imports = []
+        setups = []
+        for run in range(args.runs):
+            out = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], cwd = here, env = env,
+                                 capture_output = True, text = True, timeout = 30).stdout
+            font_loads, imported, setup_time = out.split()[-3:]
+            imports.append(float(imported) * 1000)
+            setups.append(float(setup_time) * 1000)
+        print("{:7} imports: median {:6.1f} ms, main() to first menu frame: median {:6.2f} ms, min {:6.2f} ms, {} font loads".format(
+            name, statistics.median(imports), statistics.median(setups), min(setups), font_loads))
+
+#cpu used with matches whose players sit at the serve, stepping and sending them anyway vs letting them hibernate
+#the players are netclient clients in this process, acking snapshots and pinging like real ones
+def bench_hibernate(args):
+    import select
+    import netclient
+    
+    for i, engine in enumerate(args.engines):
+        for j, hibernation in enumerate((False, True)):
+            port = args.port + 10 * i + j
+            s = start_engine(engine, port, hibernation = hibernation)
+            clients = []
+            for k in range(2 * args.idle_matches):
+                client = netclient.Client("p{}".format(k))
+                client.connect('127.0.0.1', port)
+                client.send_input(45, 0)
+                clients.append(client)
+            by_sock = {client.sock : client for client in clients}
+            
+            def pump(seconds):
+                end = time.time() + seconds
+                while time.time() < end:
+                    r, w, e = select.select(list(by_sock), [], [], 0.05)
+                    now = time.time()
+                    for sock in r:
+                        by_sock[sock].receive(now)
+                    for client in clients:
+                        ping = client.session.clock.ping(now)
+                        if ping:
+                            client.sock.sendall(ping)
+            
+            pump(1) #let the matches start and settle
+            ticks = s.metrics.ticks
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+            pump(args.seconds)
+            cpu = time.process_time() - cpu_start
+            wall = time.perf_counter() - wall_start
+            
+            print("{:8} {} matches at the serve, hibernation {:3}: cpu {:5.1f}%, steps {:6}, hibernating {}".format(
+                engine, args.idle_matches, "on" if hibernation else "off", 100 * cpu / wall, s.metrics.ticks - ticks,
+                sum(1 for match in s.matches if match.hibernating)))
+            for client in clients:
+                client.close()
+
+benches = {
+    'idle' : bench_idle,
+    'jitter' : bench_jitter,
+    'sim' : bench_sim,
+    'batch' : bench_batch,
+    'bandwidth' : bench_bandwidth,
+    'udp' : bench_udp,
+    'lag' : bench_lag,
+    'tickrate' : bench_tickrate,
+    'record' : bench_record,
+    'spectators' : bench_spectators,
+    'codec' : bench_codec,
+    'gui' : bench_gui,
+    'connect' : bench_connect,
+    'startup' : bench_startup,
+    'hibernate' : bench_hibernate,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "NetPong benchmarks")
+    parser.add_argument('bench', choices = list(benches))
+    parser.add_argument('--engines', nargs = '+', choices = list(engines), default = list(engines))
+    parser.add_argument('--seconds', type = float, default = 5)
+    parser.add_argument('--port', type = int, default = 10100)
+    parser.add_argument('--matches', type = int, nargs = '+', default = [1000, 10000, 100000])
+    parser.add_argument('--loss', type = float, default = 0.2, help = "datagram loss for the udp benchmark")
+    parser.add_argument('--spectators', type = int, default = 300, help = "spectators for the spectators benchmark")
+    parser.add_argument('--idle-matches', type = int, default = 100, help = "matches for the hibernate benchmark")
+    parser.add_argument('--runs', type = int, default = 5, help = "fresh processes per case for the connect and startup benchmarks")
+    args = parser.parse_args()
+    
+    benches[args.bench](args)
@@ -1,12 +1,16 @@
 import pygame
 import socket
-import select
 import time
 import threading
 import queue
 import random
+import collections
+import argparse
 
+import assets
+import netclient
 import packet
+import sim
 import gui
 
 background_color = (20, 20, 20)
@@ -16,12 +20,139 @@ h_screen = 180
 paddle_sep = 10
 paddle_len = 9
 
+'''
+Buffer of timestamped snapshots for drawing smoothly between server updates
+
+Entities are drawn a fixed delay behind the newest snapshot, interpolated
+between the two snapshots either side of that time. If the next snapshot
+is late the ball carries on along its last velocity for a short while.
+'''
+class SnapshotBuffer:
+    def __init__(self, **kwargs):
+        self.delay = kwargs.get('delay', 0.07) #seconds to draw behind the server
+        self.max_extrapolation = kwargs.get('max_extrapolation', 0.1) #seconds to carry the ball on past the newest snapshot
+        self.max_speed = kwargs.get('max_speed', 150) #court units per second, faster moves are teleports (score, serve)
+        
+        self.snapshots = collections.deque(maxlen = 32) #(server time, fields), oldest first
+        self.ticks = None #unwrapped server tick of the newest snapshot
+        self.offset = None #local time - server time
+    
+    def add(self, tick, fields, now):
+        if self.ticks is None:
+            self.ticks = tick
+        else:
+            step = (tick - self.ticks) & 0xFFFF
+            if step >= 0x8000: #older than what we have
+                return
+            self.ticks += step
+        
+        server_time = self.ticks * sim.Simulation.tick_interval
+        
+        #follow the fastest deliveries straight away and creep up slowly otherwise, so jitter doesn't move the clock
+        offset = now - server_time
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+        else:
+            self.offset += (offset - self.offset) * 0.01
+        
+        self.snapshots.append((server_time, fields))
+    
+    #(ball x, ball y, p1 y, p2 y) as floats for the given local time, or None before the first snapshot
+    def sample(self, now):
+        if not self.snapshots:
+            return None
+        
+        render_time = now - self.offset - self.delay
+        newest_time, newest = self.snapshots[-1]
+        
+        if render_time >= newest_time: #nothing newer yet, extrapolate the ball
+            if len(self.snapshots) < 2:
+                return newest
+            previous_time, previous = self.snapshots[-2]
+            dt = newest_time - previous_time
+            if dt <= 0:
+                return newest
+            ahead = min(render_time - newest_time, self.max_extrapolation)
+            vx = (newest[0] - previous[0]) / dt
+            vy = (newest[1] - previous[1]) / dt
+            if abs(vx) > self.max_speed or abs(vy) > self.max_speed:
+                return newest
+            return (newest[0] + vx * ahead, newest[1] + vy * ahead, newest[2], newest[3])
+        
+        for i in range(len(self.snapshots) - 1, 0, -1):
+            before_time, before = self.snapshots[i - 1]
+            if before_time <= render_time:
+                after_time, after = self.snapshots[i]
+                if after_time <= before_time:
+                    return after
+                t = (render_time - before_time) / (after_time - before_time)
+                if abs(after[0] - before[0]) > self.max_speed * (after_time - before_time) + 2:
+                    t = 0 if t < 0.5 else 1 #don't slide the ball across the court after a point
+                return tuple(b + (a - b) * t for a, b in zip(after, before))
+        return self.snapshots[0][1]
+
+'''
+Frame time statistics for the render loop
+'''
+class FrameStats:
+    def __init__(self, size = 1000):
+        self.samples = collections.deque(maxlen = size) #most recent frame times (seconds)
+        self.count = 0
+    
+    def record(self, frame_time):
+        self.samples.append(frame_time)
+        self.count += 1
+    
+    def percentile(self, p):
+        if not self.samples:
+            return 0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    
+    def fps(self):
+        return len(self.samples) / sum(self.samples) if self.samples and sum(self.samples) else 0
+    
+    def __str__(self):
+        return "Frames: {}, {:.0f} fps, p50: {:.1f} ms, p99: {:.1f} ms, max: {:.1f} ms".format(self.count,
+                                                                                     self.fps(),
+                                                                                     self.percentile(50) * 1000,
+                                                                                     self.percentile(99) * 1000,
+                                                                                     max(self.samples, default = 0) * 1000)
+
+'''
+Client side of a match, the renderer on top of netclient.Client
+
+Socket I/O runs on its own network thread once connected. It owns
+self.net, the connection and its session, and hands the render loop a
+new immutable update tuple through self.published, a single slot that
+is simply overwritten. The render loop hands inputs back the same way
+through self.input_slot, and the network thread sends them on a fixed
+cadence. Round trip, jitter, clock offset and snapshot age go to the
+render loop the same way through self.net_stats.
+'''
 class Game:
     def __init__(self, **kwargs):
         self.color = kwargs.get('color', (255,255,255))
-    
-        self.state = packet.GamePacket()
-        self.sock = socket.socket()
+        
+        self.view = packet.GamePacket() #render loop's copy, taken from published updates
+        self.watch = kwargs.get('watch') #match id to spectate instead of playing, None to play
+        self.interp_delay = kwargs.get('interp_delay') or (0.15 if self.watch is not None else 0.07) #spectator snapshots come slower
+        self.snapshots = SnapshotBuffer(delay = self.interp_delay)
+        
+        self.net_options = dict(watch = self.watch, view_delay = self.interp_delay,
+                                udp = kwargs.get('udp', False), #take the UDP transport if the server offers it
+                                loss = kwargs.get('loss', 0)) #fraction of outgoing datagrams to drop, for testing
+        self.net = netclient.Client(**self.net_options)
+        self.input_interval = kwargs.get('input_interval', 0.01) #seconds between input sends
+        
+        self.net_thread = None
+        self.running = False
+        self.failed = False #set by the network thread when the connection breaks
+        self.input_slot = (45, 0) #newest (pos, key) from the render loop
+        self.last_input = None #last (pos, key) sent
+        self.published = None #(newest, p1 name, p2 name, score, server), replaced as a whole
+        self.taken = None #last update the render loop applied
+        self.net_stats = None #(rtt, jitter, clock offset, snapshot age), replaced as a whole
         
         self.connect_thread = None
         self.connect_state = "Attempt" #Attempt, Connected, Fail
@@ -31,81 +162,172 @@ class Game:
         self.left_paddle = pygame.Rect(0,0,2,2*paddle_len)
         self.right_paddle = pygame.Rect(0,0,2,2*paddle_len)
         
-        self.font = pygame.font.SysFont("Consolas", 14)
-        self.big_font = pygame.font.SysFont("Consolas", 20)
+        self.font = assets.font(14)
+        self.big_font = assets.font(20)
         
         self.player1_name = gui.Text('', (w_screen//2 - 90, h_screen - 20), 
                                     self.font, color = (100,100,100))
         self.player2_name = gui.Text('', (w_screen//2 + 90, h_screen - 20), 
                                     self.font, color = (100,100,100))
-                                    
+        
         self.player1_score = gui.Text('', (w_screen//2 - 100, 20), 
                                     self.big_font, color = (100,100,100))
         self.player2_score = gui.Text('', (w_screen//2 + 100, 20), 
                                     self.big_font, color = (100,100,100))
+        self.shown_score = None #score the score texts were last set from
         
         self.waiting_text = gui.Text('Waiting for Players', (w_screen//2, h_screen//2), 
                                     self.big_font, color = (255,255,255))
         self.winner_text = gui.Text('__ Wins!', (w_screen//2, h_screen//2), 
                                     self.big_font, color = (255,255,255))
         
-        self.arrow = pygame.image.load('arrow.png')
+        self.arrow = assets.image('arrow.png')
         
         self.last_update = 0
-        self.update_interval = 0.01 
+        self.update_interval = 0.01 #seconds per paddle step while a key is held
     
-    def attempt_connection(self, ip, port):
+    def attempt_connection(self, ip, port, name):
+        self.close()
+        self.net = netclient.Client(name, **self.net_options)
+        self.view = packet.GamePacket()
+        self.snapshots = SnapshotBuffer(delay = self.interp_delay)
+        self.failed = False
+        self.input_slot = (45, 0)
+        self.last_input = None
+        self.published = None
+        self.taken = None
+        self.net_stats = None
+        
         self.connect_thread = threading.Thread(target = self.await_connection,
                                             args = (ip, port),
                                             daemon = True)
         self.connect_thread.start()
-        
+    
     def await_connection(self, ip, port):
         try:
-            self.sock = socket.socket()
-            self.sock.connect((ip, port))
-            self.sock.setblocking(False)
+            self.net.connect(ip, port)
+            self.start_network()
             self.connect_state_queue.put("Connected")
         except (ConnectionRefusedError, TimeoutError, socket.gaierror, OSError):
             self.connect_state_queue.put("Failed")
     
+    #stop the network thread, it closes the sockets on its way out
+    def close(self):
+        self.running = False
+        if self.net_thread and self.net_thread is not threading.current_thread():
+            self.net_thread.join()
+        self.net_thread = None
+        self.net.close()
+    
+    def start_network(self):
+        self.running = True
+        self.net_thread = threading.Thread(target = self.network_loop, daemon = True)
+        self.net_thread.start()
+    
+    #network thread: receive whenever there's data, send inputs on a fixed cadence in between
+    def network_loop(self):
+        next_input = time.time()
+        try:
+            while self.running:
+                if self.net.poll(max(0, next_input - time.time())):
+                    self.publish()
+                
+                now = time.time()
+                if now >= next_input:
+                    self.send_pending_input()
+                    next_input += self.input_interval
+                    if now - next_input > self.input_interval: #fell far behind, don't try to catch up
+                        next_input = now + self.input_interval
+        except (ConnectionResetError, ValueError, OSError):
+            self.failed = True
+        finally:
+            self.net.close()
+    
+    #render loop side of the input handoff
+    def set_input(self, pos, key):
+        self.input_slot = (pos, key)
+    
+    def send_pending_input(self):
+        if self.watch is not None: #spectators have no paddle
+            return
+        current = self.input_slot
+        if current != self.last_input:
+            self.net.send_input(*current)
+            self.last_input = current
+        else:
+            self.net.resend_inputs()
+    
+    #network thread side of the update handoff
+    def publish(self):
+        session = self.net.session
+        state = session.state
+        self.published = (session.newest, state.p1_name, state.p2_name, state.score, state.server)
+        self.net_stats = (session.clock.rtt, session.clock.jitter, session.clock.offset, session.snapshot_age)
+    
+    #render loop: the network overlay's text
+    def net_summary(self):
+        stats = self.net_stats
+        if stats is None or stats[0] is None:
+            return "rtt -"
+        rtt, jitter, offset, age = stats
+        return "rtt {:.0f}+-{:.0f} ms  clock {:+.0f} ms  age {} ms".format(rtt * 1000, jitter * 1000, offset * 1000,
+                                                                         "-" if age is None else round(age * 1000))
+    
+    #render loop: apply the newest published update, if there's a new one
+    def take_update(self):
+        update = self.published
+        if update is None or update is self.taken:
+            return
+        
+        newest, self.view.p1_name, self.view.p2_name, self.view.score, self.view.server = update
+        if newest and (self.taken is None or newest is not self.taken[0]):
+            seq, tick, fields, received = newest
+            packet.apply_snapshot(fields, self.view)
+            self.snapshots.add(tick, fields, received)
+        self.taken = update
+    
     #take packet data and use it to draw the game surface
     def draw(self, surface):
+        self.take_update()
+        
         #draw ball
-        self.ball.center = (self.state.ball[0] * 2, self.state.ball[1] * 2)
-        self.left_paddle.center = (paddle_sep, self.state.p1y * 2)
-        self.right_paddle.center = (w_screen - paddle_sep, self.state.p2y * 2)
-        
-        try: #convert from bytes and fail over to string otherwise
-            self.player1_name.text = self.state.p1_name.rstrip(b'\x00').decode("utf_8")
-            self.player2_name.text = self.state.p2_name.rstrip(b'\x00').decode("utf_8")
-        except TypeError:
-            self.player1_name.text = self.state.p1_name
-            self.player2_name.text = self.state.p2_name
-           
-        self.player1_score.text = '{}'.format(self.state.score[0])
-        self.player2_score.text = '{}'.format(self.state.score[1])
+        view = self.snapshots.sample(time.time())
+        if view is None:
+            view = (self.view.ball[0], self.view.ball[1], self.view.p1y, self.view.p2y)
+        
+        self.ball.center = (round(view[0] * 2), round(view[1] * 2))
+        self.left_paddle.center = (paddle_sep, round(view[2] * 2))
+        self.right_paddle.center = (w_screen - paddle_sep, round(view[3] * 2))
+        
+        #names arrive already decoded in roster messages, scores are only formatted when they change
+        self.player1_name.text = self.view.p1_name
+        self.player2_name.text = self.view.p2_name
+        
+        if self.view.score != self.shown_score:
+            self.player1_score.text = '{}'.format(self.view.score[0])
+            self.player2_score.text = '{}'.format(self.view.score[1])
+            self.shown_score = self.view.score
         
         self.player1_name.draw(surface)
         self.player2_name.draw(surface)
-
+        
         self.player1_score.draw(surface)
         self.player2_score.draw(surface)
         
-        if self.state.server == 0:
+        if self.view.server == 0:
             pass
-        elif self.state.server == 1 or self.state.server == 2:
-            if self.state.server == 1:
+        elif self.view.server == 1 or self.view.server == 2:
+            if self.view.server == 1:
                 arrow_x = -100
-            if self.state.server == 2:
+            if self.view.server == 2:
                 arrow_x = 100
-        
+            
             surface.blit(self.arrow, (w_screen//2 - self.arrow.get_width()//2 + arrow_x, 
                                 h_screen//2 - self.arrow.get_height()//2 - 85))
-        elif self.state.server == 3:
+        elif self.view.server == 3:
             self.waiting_text.draw(surface)
-        elif self.state.server == 4:
-            if (self.state.score[0] > self.state.score[1]):
+        elif self.view.server == 4:
+            if (self.view.score[0] > self.view.score[1]):
                 self.winner_text.text = "{} Wins!".format(self.player1_name.text)
             else:
                 self.winner_text.text = "{} Wins!".format(self.player2_name.text)
@@ -116,7 +338,7 @@ class Game:
         pygame.draw.rect(surface, self.color, self.left_paddle)
         pygame.draw.rect(surface, self.color, self.right_paddle)
 
-def main():
+def main(**kwargs):
     #setup
     pygame.init()
     pygame.display.set_caption("NetPong")
@@ -124,20 +346,18 @@ def main():
     window = pygame.display.set_mode([w_screen,h_screen], pygame.RESIZABLE)
     screen = pygame.Surface((w_screen,h_screen))
     
-    font = pygame.font.SysFont("Consolas", 14)
-    big_font = pygame.font.SysFont("Consolas", 20)
+    font = assets.font(14)
+    big_font = assets.font(20)
     
-    #load logo
-    logo_scale = 4
-    logo = pygame.image.load('logo.png')
-    logo = pygame.transform.scale(logo, (logo_scale * logo.get_width(), logo_scale * logo.get_height()))
+    #logo, scaled up once
+    logo = assets.image('logo.png', 4)
     
     #text boxes
     ip_text = gui.Text("Server IP", (w_screen//2 - 80, h_screen//2 - 15), font)
     ip_box = gui.TextBox((w_screen//2 + 40, h_screen//2 - 15), (140,15),
                         text = "127.0.0.1",
                         max_chars = 15)
-                        
+    
     name_text = gui.Text("Username", (w_screen//2 - 80, h_screen//2 + 15), font)
     name_box = gui.TextBox((w_screen//2 + 40, h_screen//2 + 15), (140,15),
                         text = '',
@@ -156,7 +376,7 @@ def main():
     fail_ok_button = gui.Button((w_screen//2, h_screen//2 + 30), (60,15),
                             text = "OK",
                             callback = None)
-                            
+    
     #pause menu buttons
     pause_resume_button = gui.Button((w_screen//2, h_screen//2 - 30), (60,15),
                             text = "Resume",
@@ -170,16 +390,28 @@ def main():
     state = "Menu"
     run = True
     
-    game = Game()
+    game = Game(**kwargs)
+    port = kwargs.get('port') or (10002 if game.watch is not None else 10000)
+    
+    fps = kwargs.get('fps', 60) #frame rate the render loop is paced to
+    clock = pygame.time.Clock()
+    frame_stats = FrameStats()
+    fps_text = gui.Text('', (30, 8), font, color = (100,100,100)) if kwargs.get('show_fps') else None
+    net_text = gui.Text('', (w_screen//2 + 30, 8), assets.font(10),
+                        color = (100,100,100)) if kwargs.get('show_net') else None
+    net_refresh = 0.25 #seconds between overlay updates, so the text isn't rendered again every frame
+    last_net_refresh = 0
+    trace = kwargs.get('trace') #tracer.Tracer for the frame's phases, None to not trace
     
     i = 0
     player_y = 45
-    last_y = 0
     player_key = 0
-    last_key = 0
     
     connect_thread = None
     while run:
+        if trace:
+            trace.begin('frame')
+            trace.begin('events')
         #cover screen
         screen.fill(background_color)
         
@@ -190,15 +422,17 @@ def main():
                 run = False
             elif event.type == pygame.KEYDOWN:
                 key_event = event
-    
+        if trace:
+            trace.end()
+            trace.begin('transitions')
+        
         '''
         State Machine Transitions
         '''
         if state == "Menu":
             if start_button.clicked:
                 player_y = 45
-                last_y = 0
-                game.attempt_connection(ip_box.text, 10000)
+                game.attempt_connection(ip_box.text, port, name_box.text)
                 state = "Connect"
         elif state == "Connect":
             if not game.connect_state_queue.empty(): #if finished
@@ -210,7 +444,9 @@ def main():
                     state = "Failed"
         elif state == "Game":
             state = "Game"
-            if key_event and key_event.key == pygame.K_ESCAPE: #pause if user hits escape key
+            if game.failed:
+                state = "Failed"
+            elif key_event and key_event.key == pygame.K_ESCAPE: #pause if user hits escape key
                 state = "Pause"
         elif state == "Failed":
             if fail_ok_button.clicked:
@@ -219,9 +455,12 @@ def main():
             if pause_resume_button.clicked:
                 state = "Game"
             elif pause_quit_button.clicked:
-                game.sock.close()
+                game.close()
                 state = "Menu"
-    
+        if trace:
+            trace.end()
+            trace.begin('draw ' + state) #the state machine's actions are mostly drawing
+        
         '''
         State Machine Actions
         '''
@@ -234,7 +473,7 @@ def main():
             ip_text.draw(screen)
             ip_box.draw(screen, key_event, scale=(w_screen / window.get_width(), 
                                         h_screen / window.get_height()))
-           
+            
             name_text.draw(screen)
             name_box.draw(screen, key_event, scale=(w_screen / window.get_width(), 
                                         h_screen / window.get_height()))
@@ -245,40 +484,32 @@ def main():
         elif state == "Connect":
             connecting_text.draw(screen)
         elif state == "Game":
-            if time.time() - game.last_update > game.update_interval:
-                keys = pygame.key.get_pressed()
+            #paddle moves one step per update_interval while a key is held, whatever the frame rate
+            keys = pygame.key.get_pressed()
+            now = time.time()
+            if now - game.last_update > 4 * game.update_interval: #after a pause or a long frame
+                game.last_update = now - game.update_interval
+            while now - game.last_update >= game.update_interval:
                 if keys[pygame.K_UP]: #move up
                     if player_y > 0:
                         player_y -= 1
                 elif keys[pygame.K_DOWN]: #move down
                     if player_y < h_screen // 2:
                         player_y += 1
-                        
-                if keys[pygame.K_SPACE]:
-                    player_key = 32
-                else:
-                    player_key = 0
-                        
-                game.last_update = time.time()
+                game.last_update += game.update_interval
             
-            r, w, e = select.select([game.sock], [game.sock], [game.sock], 1)
-            
-            if r:
-                try:
-                    p = game.sock.recv(game.state.length)
-                    game.state.unpack_bytes(p)
-                except ConnectionResetError:
-                    state = "Failed"
-            if w and player_y != last_y or player_key != last_key:
-                player_packet = packet.PlayerPacket(name_box.text, player_y)
-                player_packet.key = player_key
-                game.sock.sendall(player_packet.pack_bytes())
-                last_y = player_y
-                last_key = player_key
+            player_key = 32 if keys[pygame.K_SPACE] else 0
+            game.set_input(player_y, player_key)
             
             game.draw(screen)
+            
+            if net_text:
+                if now - last_net_refresh >= net_refresh:
+                    net_text.text = game.net_summary()
+                    last_net_refresh = now
+                net_text.draw(screen)
         elif state == "Failed":
-            game.sock.close()
+            game.close()
             failed_text.draw(screen)
             fail_ok_button.draw(screen, scale=(w_screen / window.get_width(), 
                                         h_screen / window.get_height()))
@@ -288,14 +519,57 @@ def main():
             
             pause_quit_button.draw(screen, scale=(w_screen / window.get_width(), 
                                         h_screen / window.get_height()))
-    
+        
+        if fps_text:
+            fps_text.text = "{:.0f} fps".format(frame_stats.fps())
+            fps_text.draw(screen)
+        
         '''
         Draw Window
         '''
+        if trace:
+            trace.end()
+            trace.begin('scale')
         window.blit(pygame.transform.scale(screen, window.get_rect().size), (0, 0))
+        if trace:
+            trace.end()
+            trace.begin('flip')
         pygame.display.flip()
+        if trace:
+            trace.end()
+            trace.begin('wait')
         
+        frame_stats.record(clock.tick(fps) / 1000) #sleeps off the rest of the frame
         i += 1
+        if trace:
+            trace.end()
+            trace.end()
+    
+    game.close()
+    print(frame_stats)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = "NetPong client")
+    parser.add_argument('--udp', action = 'store_true', help = "use the UDP transport if the server offers it")
+    parser.add_argument('--loss', type = float, default = 0, help = "fraction of outgoing datagrams to drop")
+    parser.add_argument('--interp-delay', type = float,
+                        help = "seconds to draw behind the newest snapshot, 0.07 playing and 0.15 watching by default")
+    parser.add_argument('--fps', type = int, default = 60, help = "frame rate to pace rendering to")
+    parser.add_argument('--show-fps', action = 'store_true', help = "draw the frame rate in the corner")
+    parser.add_argument('--show-net', action = 'store_true',
+                        help = "draw round trip time, jitter, server clock offset and snapshot age at the top")
+    parser.add_argument('--watch', type = int, nargs = '?', const = packet.WATCH_ANY,
+                        help = "spectate a match (any match if no id is given) instead of playing")
+    parser.add_argument('--port', type = int, help = "server port, 10000 to play, 10002 (or a relay's port) to watch")
+    parser.add_argument('--trace', metavar = 'FILE',
+                        help = "record a timeline of each frame's phases, written to FILE as Chrome trace JSON on exit or SIGUSR1")
+    args = parser.parse_args()
+    
+    trace = None
+    if args.trace:
+        import tracer
+        trace = tracer.Tracer(name = "NetPong client")
+        trace.install(args.trace)
+    
+    main(udp = args.udp, loss = args.loss, interp_delay = args.interp_delay, fps = args.fps, show_fps = args.show_fps,
+         show_net = args.show_net, watch = args.watch, port = args.port, trace = trace)
\ No newline at end of file
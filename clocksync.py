@@ -0,0 +1,111 @@
+import collections
+import time
+
+import packet
+import sim
+
+'''
+Round trip time and clock offset from ping/pong exchanges, NTP style
+
+Either side pings now and then with its send time t0. The other side
+answers straight away with t0, the time t1 the ping arrived and the time
+t2 it answered, and the pong arrives back at t3. Then
+    
+    rtt = (t3 - t0) - (t2 - t1)
+    offset = ((t1 - t0) + (t2 - t3)) / 2
+
+where offset is how far the other side's clock is ahead of ours. It's
+only exact when both directions take as long, and a sample that queued
+somewhere has a long round trip and a skewed offset, so as in NTP's clock
+filter the offset is taken from the shortest round trip of the last few
+samples and then smoothed. The round trip time and its jitter (mean
+deviation) are smoothed the way TCP does (RFC 6298).
+
+Pongs from the server also carry the match tick it answered on. That
+tick was simulated at most a step before the answer, so every pong gives
+a latest possible server time for it and the earliest of the last few,
+carried forward at the tick rate, puts snapshot ticks on the server's
+clock. Even the earliest bound is late by anything up to a step, so the
+tick is put half a step before it, and an age that still comes out
+negative is taken as 0.
+
+Times are time.time() on both sides.
+'''
+class ClockSync:
+    def __init__(self, **kwargs):
+        self.interval = kwargs.get('interval', 1) #seconds between pings
+        self.window = kwargs.get('window', 8) #recent samples the offset is picked from
+        self.step_interval = kwargs.get('step_interval', sim.Simulation.tick_interval) #seconds between the server's steps
+        
+        self.next_ping = 0
+        self.samples = collections.deque(maxlen = self.window) #(rtt, offset), oldest first
+        self.count = 0 #pongs taken
+        self.rtt = None #smoothed round trip time (seconds)
+        self.jitter = None #mean deviation of the round trip time (seconds)
+        self.offset = None #other clock - our clock (seconds)
+        self.anchors = collections.deque(maxlen = self.window) #(tick, other clock) from recent pongs, server ticks only
+    
+    #framed ping if one is due, otherwise None
+    def ping(self, now):
+        if now < self.next_ping:
+            return None
+        self.next_ping = now + self.interval
+        return packet.frame(packet.PingPacket(now).pack_bytes())
+    
+    def pong(self, raw, now):
+        msg = packet.PongPacket()
+        msg.unpack_bytes(raw)
+        rtt = (now - msg.ping_sent) - (msg.replied - msg.received)
+        if rtt < 0: #a clock stepped while the ping was out
+            return
+        offset = ((msg.received - msg.ping_sent) + (msg.replied - now)) / 2
+        
+        self.count += 1
+        if self.rtt is None:
+            self.rtt = rtt
+            self.jitter = rtt / 2
+        else:
+            self.jitter += (abs(rtt - self.rtt) - self.jitter) / 4
+            self.rtt += (rtt - self.rtt) / 8
+        
+        self.samples.append((rtt, offset))
+        best = min(self.samples)[1]
+        self.offset = best if self.offset is None else self.offset + (best - self.offset) / 4
+        self.anchors.append((msg.tick, msg.replied))
+    
+    #the other side's clock now, our own until the first pong
+    def remote_time(self, now):
+        return now + (self.offset or 0)
+    
+    #the server's clock when it simulated a snapshot tick (modulo 65536), None until the first pong
+    def tick_time(self, tick):
+        if not self.anchors:
+            return None
+        newest_tick = self.anchors[-1][0]
+        latest = min(replied + tick_distance(anchor_tick, newest_tick) * sim.Simulation.tick_interval
+                     for anchor_tick, replied in self.anchors)
+        newest_time = latest - self.step_interval / 2 #somewhere in the step before the answer
+        return newest_time - tick_distance(tick, newest_tick) * sim.Simulation.tick_interval
+    
+    #how long ago the server simulated a snapshot tick
+    def snapshot_age(self, tick, now):
+        tick_time = self.tick_time(tick)
+        if tick_time is None:
+            return None
+        return max(0, self.remote_time(now) - tick_time)
+    
+    def __str__(self):
+        if self.rtt is None:
+            return "RTT: -"
+        return "RTT: {:.1f} ms, jitter: {:.1f} ms, offset: {:+.1f} ms".format(self.rtt * 1000, self.jitter * 1000,
+                                                                          self.offset * 1000)
+
+#ticks from a to b modulo 65536, negative if b is before a
+def tick_distance(a, b):
+    return ((b - a + 0x8000) & 0xFFFF) - 0x8000
+
+#framed pong answering a ping that arrived at received, tick is the server's match tick (0 from clients)
+def answer(raw, received, tick = 0):
+    msg = packet.PingPacket()
+    msg.unpack_bytes(raw)
+    return packet.frame(packet.PongPacket(msg.sent, received, time.time(), tick & 0xFFFF).pack_bytes())
@@ -1,5 +1,46 @@
+import collections
+
 import pygame
 
+import assets
+
+'''
+Rendered text cache
+
+Rasterising text is the most expensive thing the client does per frame,
+so rendered strings are shared through a bounded LRU keyed on font, text
+and colour, and each widget also holds on to its own last render.
+'''
+render_cache = collections.OrderedDict() #(font, text, color) -> surface, least recently used first
+render_cache_size = 256
+
+def render_text(font, text, color):
+    key = (font, text, color)
+    render = render_cache.get(key)
+    if render is None:
+        render = font.render(text, False, color)
+        render_cache[key] = render
+        if len(render_cache) > render_cache_size:
+            render_cache.popitem(last = False)
+    else:
+        render_cache.move_to_end(key)
+    return render
+
+'''
+A widget's last rendered text, rendered again only when the font, text or colour change
+'''
+class TextRender:
+    def __init__(self):
+        self.key = None
+        self.surface = None
+    
+    def get(self, font, text, color):
+        key = (font, text, color)
+        if key != self.key:
+            self.surface = render_text(font, text, color)
+            self.key = key
+        return self.surface
+
 class Text:
     def __init__(self, text, pos, font, **kwargs):
         self.pos = pos
@@ -7,9 +48,10 @@ class Text:
         self.text = text
         
         self.color = kwargs.get('color', (255,255,255))
-        
+        self.render = TextRender()
+    
     def draw(self, surface):
-        text_render = self.font.render(self.text, False, self.color)
+        text_render = self.render.get(self.font, self.text, self.color)
         text_rect = text_render.get_rect(center = self.pos)
         surface.blit(text_render, text_rect)
 
@@ -19,7 +61,7 @@ class Button(pygame.Rect):
         self.center = pos
         
         self.text = kwargs.get('text', None)
-        self.font = kwargs.get('font', pygame.font.SysFont("Consolas", 14))
+        self.font = kwargs.get('font') or assets.font(14) #shared font, only looked up when none is given
         
         self.color = kwargs.get('color', (255,255,255))
         self.hover_color = kwargs.get('hover_color', (200,200,200))
@@ -29,7 +71,8 @@ class Button(pygame.Rect):
         self.callback_args = kwargs.get('callback_args', None)
         
         self.clicked = False
-        
+        self.render = TextRender()
+    
     def draw(self, surface, **kwargs):
         draw_color = self.color
         
@@ -41,7 +84,7 @@ class Button(pygame.Rect):
             if pygame.mouse.get_pressed(num_buttons=3)[0]:
                 if not self.clicked:
                     self.clicked = True
-            
+                
                 draw_color = self.click_color
             else:
                 if self.clicked:
@@ -53,10 +96,10 @@ class Button(pygame.Rect):
         pygame.draw.rect(surface, draw_color, self)
         
         if self.text:
-            text_render = self.font.render(self.text, False, (20, 20, 20))
+            text_render = self.render.get(self.font, self.text, (20, 20, 20))
             text_rect = text_render.get_rect(center = self.center)
             surface.blit(text_render, text_rect)
-
+    
     def on_click_func(self):
         if self.callback:
             self.callback(self.callback_args)
@@ -94,7 +137,7 @@ class TextBox(Button):
             draw_color = self.click_color
         
         pygame.draw.rect(surface, draw_color, self)
-
-        text_render = self.font.render(self.text, False, (20, 20, 20))
+        
+        text_render = self.render.get(self.font, self.text, (20, 20, 20))
         text_rect = text_render.get_rect(center = self.center)
         surface.blit(text_render, text_rect)
\ No newline at end of file
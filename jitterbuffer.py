@@ -0,0 +1,110 @@
+import collections
+
+import packet
+
+'''
+Per-player input jitter buffer, lives on the server
+
+Clients stamp every input with a sequence number and the tick it was
+made on, counted on their own clock at the simulation's tick rate. An
+input is played into the simulation at that tick moved onto the server's
+timeline: client tick + base + depth. The base is the smallest
+(server tick on arrival - client tick) seen recently, which takes in the
+clock difference and the fastest delivery, and the depth is how many
+ticks of slower deliveries the buffer soaks up. Inputs that arrive in a
+burst are then played out at the pace they were made instead of all at
+once.
+
+The depth adapts: it's worked out now and then from how late recent
+inputs arrived compared to the fastest one (a high percentile, plus a
+tick of headroom) and steps down by a tick at a time, and an input that
+arrives too late to be played on time raises it straight away. Late
+inputs are still played, on the next step.
+
+Playout ticks never go backwards, so inputs are played in the order they
+were made. When several fall in the same step the newest position wins
+and a key press in any of them is kept, so a serve pressed and released
+between two steps isn't lost.
+'''
+class InputBuffer:
+    def __init__(self, **kwargs):
+        self.window = kwargs.get('window', 200) #recent arrivals the base and depth are worked out from
+        self.percentile = kwargs.get('percentile', 95) #share of arrivals the depth should cover
+        self.headroom = kwargs.get('headroom', 1) #ticks added on top
+        self.max_depth = kwargs.get('max_depth', 10) #ticks, never hold inputs back longer than this
+        self.adapt_interval = kwargs.get('adapt_interval', 50) #arrivals between working the depth out again
+        
+        self.commands = collections.deque() #(playout tick, pos, key) waiting, in order
+        self.transit = collections.deque(maxlen = self.window) #server tick on arrival - client tick
+        self.base = None
+        self.depth = self.headroom
+        self.last_seq = None
+        self.client_ticks = None #unwrapped client tick of the newest input
+        self.last_playout = None
+        self.since_adapt = 0
+        
+        self.received = 0
+        self.late = 0 #inputs that arrived after their playout tick
+    
+    #take one input, stale and repeated sequence numbers are ignored (the UDP transport repeats inputs)
+    #returns True if the input was new
+    def add(self, seq, tick, pos, key, server_tick):
+        if self.last_seq is not None and not packet.seq_newer(seq, self.last_seq):
+            return False
+        self.last_seq = seq
+        self.received += 1
+        
+        if self.client_ticks is None:
+            self.client_ticks = tick
+        else:
+            self.client_ticks += ((tick - self.client_ticks + 0x8000) & 0xFFFF) - 0x8000
+        
+        transit = server_tick - self.client_ticks
+        self.transit.append(transit)
+        if self.base is None or transit < self.base:
+            self.base = transit
+        
+        self.since_adapt += 1
+        if self.since_adapt >= self.adapt_interval:
+            self.adapt()
+        
+        playout = self.client_ticks + self.base + self.depth
+        if self.last_playout is not None and playout < self.last_playout:
+            playout = self.last_playout
+        if playout < server_tick: #too late to be played on time, buffer more from now on
+            self.late += 1
+            self.depth = min(self.depth + 1, self.max_depth)
+        self.last_playout = playout
+        self.commands.append((playout, pos, key))
+        return True
+    
+    #an input that came without a stamp (the old single input message), stamped with the server tick it arrived on,
+    #so it's still played in order on a step instead of straight into the simulation
+    def add_unstamped(self, pos, key, server_tick):
+        seq = 0 if self.last_seq is None else (self.last_seq + 1) & 0xFFFF
+        return self.add(seq, server_tick & 0xFFFF, pos, key, server_tick)
+    
+    #work the base and depth out again from the recent arrivals
+    def adapt(self):
+        self.since_adapt = 0
+        self.base = min(self.transit)
+        spread = sorted(transit - self.base for transit in self.transit)
+        target = min(spread[min(len(spread) - 1, int(self.percentile / 100 * len(spread)))] + self.headroom, self.max_depth)
+        if target > self.depth:
+            self.depth = target
+        elif target < self.depth:
+            self.depth -= 1
+    
+    #(newest pos, any key pressed, newest key) to play for a step ending before server tick end, None if nothing is due
+    def take(self, end):
+        if not self.commands or self.commands[0][0] >= end:
+            return None
+        pressed = 0
+        while self.commands and self.commands[0][0] < end:
+            playout, pos, key = self.commands.popleft()
+            pressed = pressed or key
+        return pos, pressed, key
+    
+    def __str__(self):
+        return "Depth: {} ticks, waiting: {}, received: {}, late: {}".format(self.depth, len(self.commands),
+                                                                             self.received, self.late)
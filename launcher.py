@@ -0,0 +1,239 @@
+import argparse
+import multiprocessing
+import os
+import select
+import socket
+import time
+
+import stats
+
+'''
+Multi-core server, run with: python launcher.py --workers 4
+
+The launcher owns the game port and does nothing but accept. Every
+accepted connection is passed to one of the worker processes over a Unix
+socket (SCM_RIGHTS), and the worker serves it exactly as if it had
+accepted it itself. Each worker is an ordinary server with its own
+matches and tick loop, so matches on different workers run on different
+cores.
+
+Handing sockets over instead of letting every worker accept on the same
+port with SO_REUSEPORT keeps matches whole: the kernel would spread the
+two players of a match over two workers. A new user goes to a worker with
+a match waiting for its second player if there is one, otherwise to the
+worker with the fewest users.
+
+Workers report their load once a second and the launcher serves every
+worker's latest report on its admin port. UDP and spectators belong to a
+single server, so neither is offered in this mode.
+'''
+
+#worker process: serves whatever the launcher hands it until the launcher goes away
+def run_worker(index, control, inherited, engine, options):
+    for sock in inherited: #the launcher's end of every control socket, so we see EOF when it exits
+        sock.close()
+    if options.get('record_dir'):
+        options['record_dir'] = os.path.join(options['record_dir'], "worker-{}".format(index))
+        os.makedirs(options['record_dir'], exist_ok = True)
+    
+    if engine == 'asyncio':
+        import asyncserver
+        asyncserver.main(None, handoff = control, **options)
+        return
+    
+    import server
+    s = server.Server(None, handoff = control, **options)
+    s.start()
+    s.listen()
+    while s.open:
+        s.tick()
+    for match in s.matches: #the launcher is gone, finish the recordings before the process exits
+        match.close()
+
+'''
+The launcher's view of one worker process
+'''
+class Worker:
+    def __init__(self, index, process, control):
+        self.index = index
+        self.process = process
+        self.control = control #our end of the worker's control socket
+        self.alive = True
+        
+        self.sent = 0 #users handed over
+        self.users = 0 #estimates, replaced by the worker's own numbers once it has seen every user we sent
+        self.open = 0 #matches waiting for a second player
+        self.status = {} #latest load report
+        self.buffer = b''
+    
+    def __str__(self):
+        fields = " ".join("{}={:g}".format(key, value) for key, value in self.status.items())
+        return "worker {} pid={} alive={} sent={} {}".format(self.index, self.process.pid, int(self.alive), self.sent, fields)
+
+class Launcher:
+    def __init__(self, port, workers, **kwargs):
+        self.port = port
+        self.worker_count = workers
+        self.engine = kwargs.get('engine', 'select')
+        self.admin_port = kwargs.get('admin_port') #local port serving the per worker report, None for no admin socket
+        self.options = kwargs.get('options', {}) #Server kwargs for every worker
+        
+        self.sock = socket.socket()
+        self.admin_sock = None
+        self.workers = []
+        self.start_time = time.time()
+    
+    def start(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', self.port))
+        self.sock.listen()
+        self.sock.setblocking(False)
+        if self.admin_port:
+            self.admin_sock = stats.admin_socket(self.admin_port)
+        
+        for index in range(self.worker_count):
+            ours, theirs = socket.socketpair()
+            inherited = [self.sock, ours] + [worker.control for worker in self.workers]
+            if self.admin_sock:
+                inherited.append(self.admin_sock)
+            process = multiprocessing.Process(target = run_worker,
+                                              args = (index, theirs, inherited, self.engine, dict(self.options)),
+                                              daemon = True)
+            process.start()
+            theirs.close()
+            ours.settimeout(1) #a worker that can't take a user within a second doesn't get them
+            self.workers.append(Worker(index, process, ours))
+    
+    #keep matches whole: fill a waiting match first, otherwise the least loaded worker
+    def place(self):
+        alive = [worker for worker in self.workers if worker.alive]
+        for worker in alive:
+            if worker.open > 0:
+                return worker
+        return min(alive, key = lambda worker: worker.users, default = None)
+    
+    def hand_off(self, sock):
+        worker = self.place()
+        if worker is None:
+            sock.close()
+            return
+        try:
+            socket.send_fds(worker.control, [b'u'], [sock.fileno()])
+        except OSError:
+            self.lost(worker)
+        else:
+            worker.sent += 1
+            worker.users += 1
+            worker.open += -1 if worker.open > 0 else 1
+        sock.close() #the worker has its own copy now
+    
+    def accept_users(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except BlockingIOError:
+                return
+            self.hand_off(sock)
+    
+    def read_status(self, worker):
+        try:
+            data = worker.control.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self.lost(worker)
+            return
+        
+        worker.buffer += data
+        *lines, worker.buffer = worker.buffer.split(b'\n')
+        for line in lines:
+            try:
+                worker.status = stats.parse_status(line.decode())
+            except ValueError:
+                continue
+            if worker.status['adopted'] == worker.sent: #otherwise users are still in flight and our estimate is newer
+                worker.users = worker.status['users']
+                worker.open = worker.status['open']
+    
+    def lost(self, worker):
+        if worker.alive:
+            print("Lost worker {}".format(worker.index))
+        worker.alive = False
+        worker.control.close()
+    
+    #plain text report in the stats.py format, totals then one line per worker
+    def report(self):
+        alive = [worker for worker in self.workers if worker.alive]
+        lines = [
+            "uptime_s {:.1f}".format(time.time() - self.start_time),
+            "workers {}".format(len(alive)),
+            "users {:g}".format(sum(worker.status.get('users', 0) for worker in alive)),
+            "matches {:g}".format(sum(worker.status.get('matches', 0) for worker in alive)),
+            "accepted {}".format(sum(worker.sent for worker in self.workers)),
+            "cpu {:.3f}".format(sum(worker.status.get('cpu', 0) for worker in alive)),
+        ]
+        lines += [str(worker) for worker in self.workers]
+        return ("\n".join(lines) + "\n").encode()
+    
+    def serve_admin(self):
+        while True:
+            try:
+                sock, addr = self.admin_sock.accept()
+            except BlockingIOError:
+                return
+            
+            sock.settimeout(1)
+            try:
+                sock.sendall(self.report())
+            except OSError:
+                pass
+            sock.close()
+    
+    def run(self):
+        while any(worker.alive for worker in self.workers):
+            listening = [self.sock] + [worker.control for worker in self.workers if worker.alive]
+            if self.admin_sock:
+                listening.append(self.admin_sock)
+            r, w, e = select.select(listening, [], [], 1)
+            
+            for sock in r:
+                if sock is self.sock:
+                    self.accept_users()
+                elif sock is self.admin_sock:
+                    self.serve_admin()
+                else:
+                    self.read_status(next(worker for worker in self.workers if worker.control is sock))
+    
+    def close(self):
+        for worker in self.workers:
+            if worker.alive:
+                worker.control.close()
+                worker.alive = False
+        for worker in self.workers:
+            worker.process.join(2)
+        self.sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "NetPong multi-core server")
+    parser.add_argument('--port', type = int, default = 10000)
+    parser.add_argument('--workers', type = int, default = os.cpu_count() or 1, help = "worker processes, one per core by default")
+    parser.add_argument('--engine', choices = ['select', 'asyncio'], default = 'select')
+    parser.add_argument('--no-lag-compensation', dest = 'lag_compensation', action = 'store_false',
+                        help = "judge hits against the newest paddle positions only")
+    parser.add_argument('--admin-port', type = int, default = 10001, help = "local port for the per worker report, 0 to disable")
+    parser.add_argument('--step-ticks', type = int, default = 1,
+                        help = "10 ms ticks simulated per step, 2 steps at 50 Hz, 4 at 25 Hz")
+    parser.add_argument('--record', metavar = 'DIR', help = "record every match into DIR/worker-N (see record.py)")
+    args = parser.parse_args()
+    
+    options = dict(lag_compensation = args.lag_compensation, step_ticks = args.step_ticks, record_dir = args.record)
+    launcher = Launcher(args.port, args.workers, engine = args.engine, admin_port = args.admin_port, options = options)
+    launcher.start()
+    print("Waiting for connections on {} workers...".format(args.workers))
+    
+    try:
+        launcher.run()
+    except KeyboardInterrupt:
+        print("Keyboard interrupt: stopping workers")
+        print(launcher.report().decode(), end = '')
+    launcher.close()
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import netclient
+import server
+import bench
+import launcher
+
+'''
+Headless load test, run with: python loadtest.py --clients 200
+
+Starts a server in its own process and connects bot clients to it over
+localhost from one or more bot processes. Every bot is a
+netclient.AsyncClient, the same client core client.py runs: it sends a
+Hello, sweeps its paddle up and down with a new tick-stamped input every
+time, keeps serve (key 32) held, acks snapshots and answers the server's
+pings. Inputs go through the server's jitter buffer exactly as a real
+player's do, so input to echo includes the time they wait there. Nothing
+is imported from pygame.
+
+Measured over the run, after the ramp up:
+- server: tick jitter, time spent simulating and sending per loop and the
+  round trip times it measured by pinging the bots, or
+  with --workers each worker's users, matches, cpu and tick jitter
+- bots: snapshots received per second, snapshot inter-arrival jitter and
+  the time from sending a paddle position to seeing it in a snapshot,
+  all over the stream transport
+'''
+
+def percentile(samples, p):
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+def ms_summary(samples):
+    return "p50: {:.2f} ms, p90: {:.2f} ms, p99: {:.2f} ms, max: {:.2f} ms".format(percentile(samples, 50) * 1000,
+                                                                              percentile(samples, 90) * 1000,
+                                                                              percentile(samples, 99) * 1000,
+                                                                              max(samples, default = 0) * 1000)
+
+#server process: runs the engine and measures between start and until (time.monotonic, shared by every process),
+#then keeps serving until the bots are done so none of them see it go away
+def run_server(engine, port, start, until, ready, done, results):
+    sys.stdout = open(os.devnull, 'w') #one line per connection otherwise
+    s = bench.start_engine(engine, port)
+    ready.set()
+    
+    time.sleep(max(0, start - time.monotonic()))
+    s.tick_stats = server.TickStats()
+    s.work_stats = server.TickStats(label = "Work")
+    time.sleep(max(0, until - time.monotonic()))
+    
+    results.put({
+        'server' : [str(s.tick_stats), str(s.work_stats)],
+        'ping' : [conn.clock.rtt for conn in list(s.connections.values()) if conn.clock.rtt is not None],
+        'matches' : len(s.matches),
+        'connections' : len(s.connections),
+    })
+    done.wait()
+
+#launcher process: the same, with the server split over worker processes behind the launcher
+def run_launcher(engine, port, workers, start, until, ready, done, results):
+    sys.stdout = open(os.devnull, 'w')
+    l = launcher.Launcher(port, workers, engine = engine)
+    l.start()
+    threading.Thread(target = l.run, daemon = True).start()
+    ready.set()
+    
+    time.sleep(max(0, until - time.monotonic()))
+    results.put({
+        'server' : [str(worker) for worker in l.workers],
+        'matches' : int(sum(worker.status.get('matches', 0) for worker in l.workers)),
+        'connections' : int(sum(worker.status.get('users', 0) for worker in l.workers)),
+    })
+    done.wait()
+    l.close()
+
+'''
+One bot, a netclient.AsyncClient sweeping its paddle
+'''
+class Bot:
+    min_y = 9 #paddle sweep range, kept inside the court
+    max_y = 81
+    hold = 1 #seconds to stay connected after the run, the server counts its users as it ends
+    
+    def __init__(self, name, stats, input_interval):
+        self.name = name
+        self.stats = stats #shared by every bot in the process
+        self.input_interval = input_interval
+        
+        self.client = netclient.AsyncClient(name)
+        self.pos = 45
+        self.direction = 1
+        self.sent = {} #paddle position -> time it was last sent
+        self.last_seen = None
+        self.last_seq = None #newest snapshot seen
+        self.last_arrival = None
+    
+    def next_pos(self):
+        if not self.min_y <= self.pos + self.direction <= self.max_y:
+            self.direction = -self.direction
+        self.pos += self.direction
+        return self.pos
+    
+    async def run(self, port, until):
+        try:
+            await self.client.connect('127.0.0.1', port)
+        except OSError:
+            self.stats['failed'] += 1
+            return
+        
+        sender = asyncio.create_task(self.send_inputs(until))
+        try:
+            while time.monotonic() < until:
+                if not await asyncio.wait_for(self.client.receive(), until - time.monotonic()):
+                    self.stats['dropped'] += 1
+                    break
+                self.observe()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            sender.cancel()
+        await asyncio.sleep(max(0, until + self.hold - time.monotonic()))
+        await self.client.close()
+    
+    async def send_inputs(self, until):
+        while time.monotonic() < until:
+            pos = self.next_pos()
+            self.sent[pos] = time.monotonic()
+            self.client.send_input(pos, 32)
+            await asyncio.sleep(self.input_interval)
+    
+    #note a snapshot the session has just taken, and our paddle in it
+    def observe(self):
+        session = self.client.session
+        if session.newest is None or session.newest[0] == self.last_seq:
+            return
+        self.last_seq = session.newest[0]
+        
+        now = time.monotonic()
+        recording = now >= self.stats['start']
+        if recording:
+            self.stats['snapshots'] += 1
+            if self.last_arrival is not None:
+                self.stats['gaps'].append(now - self.last_arrival)
+        self.last_arrival = now
+        
+        state = session.state
+        if self.name not in (state.p1_name, state.p2_name): #roster not in yet
+            return
+        y = state.p1y if state.p1_name == self.name else state.p2y
+        if y != self.last_seen and y in self.sent:
+            if recording:
+                self.stats['latency'].append(now - self.sent[y])
+            self.last_seen = y
+
+#bot process: runs its share of the bots on one event loop, connecting them over the ramp
+def run_bots(first, count, port, ramp, start, until, input_interval, results):
+    async def main():
+        stats = {'start' : start, 'snapshots' : 0, 'gaps' : [], 'latency' : [], 'failed' : 0, 'dropped' : 0}
+        
+        tasks = []
+        for i in range(count):
+            bot = Bot("bot{}".format(first + i), stats, input_interval)
+            tasks.append(asyncio.create_task(bot.run(port, until)))
+            await asyncio.sleep(ramp / count)
+        await asyncio.gather(*tasks)
+        return stats
+    
+    results.put(asyncio.run(main()))
+
+def main(args):
+    results = multiprocessing.Queue()
+    ready = multiprocessing.Event()
+    done = multiprocessing.Event()
+    
+    start = time.monotonic() + args.ramp + 1 #measure once every bot is in and the server has had time to start
+    until = start + args.seconds
+    if args.workers:
+        server_proc = multiprocessing.Process(target = run_launcher,
+                                            args = (args.engine, args.port, args.workers, start, until, ready, done, results))
+    else:
+        server_proc = multiprocessing.Process(target = run_server,
+                                            args = (args.engine, args.port, start, until, ready, done, results))
+    server_proc.start()
+    ready.wait()
+    
+    bot_procs = []
+    per_proc = -(-args.clients // args.procs)
+    for first in range(0, args.clients, per_proc):
+        count = min(per_proc, args.clients - first)
+        proc = multiprocessing.Process(target = run_bots,
+                                    args = (first, count, args.port, args.ramp, start, until,
+                                            1 / args.input_rate, results))
+        proc.start()
+        bot_procs.append(proc)
+    
+    server_stats = None
+    bots = []
+    for i in range(len(bot_procs) + 1):
+        result = results.get()
+        if 'server' in result:
+            server_stats = result
+        else:
+            bots.append(result)
+    done.set()
+    for proc in bot_procs + [server_proc]:
+        proc.join()
+    
+    gaps = [gap for stats in bots for gap in stats['gaps']]
+    latency = [sample for stats in bots for sample in stats['latency']]
+    snapshots = sum(stats['snapshots'] for stats in bots)
+    tx_interval = server.Match.tx_interval
+    
+    print("{} engine, {} clients over {} bot processes, {:.0f} s measured".format(args.engine, args.clients,
+                                                                                len(bot_procs), args.seconds))
+    print("server: {} matches, {} connections{}".format(server_stats['matches'], server_stats['connections'],
+                                                     ", {} workers".format(args.workers) if args.workers else ""))
+    for line in server_stats['server']:
+        print("    {}".format(line))
+    if 'ping' in server_stats:
+        print("    ping rtt: {}".format(ms_summary(server_stats['ping'])))
+    print("bots: netclient.AsyncClient over the stream, tick-stamped inputs played through the server's jitter buffer")
+    print("transmit rate: {:.1f} snapshots/s per client (target {:.1f})".format(snapshots / args.clients / args.seconds,
+                                                                               1 / tx_interval))
+    print("snapshot inter-arrival: {}".format(ms_summary(gaps)))
+    print("snapshot jitter: {}".format(ms_summary([abs(gap - tx_interval) for gap in gaps])))
+    print("input to echo (jitter buffered): {}".format(ms_summary(latency)))
+    print("failed connections: {}, dropped: {}".format(sum(stats['failed'] for stats in bots),
+                                                       sum(stats['dropped'] for stats in bots)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "NetPong load test")
+    parser.add_argument('--clients', type = int, default = 100)
+    parser.add_argument('--engine', choices = list(bench.engines), default = 'select')
+    parser.add_argument('--seconds', type = float, default = 10, help = "measured time after the ramp up")
+    parser.add_argument('--ramp', type = float, default = 2, help = "seconds over which the bots connect")
+    parser.add_argument('--procs', type = int, default = max(1, (os.cpu_count() or 2) - 1), help = "bot processes")
+    parser.add_argument('--input-rate', type = float, default = 60, help = "inputs per second per bot")
+    parser.add_argument('--port', type = int, default = 10200)
+    parser.add_argument('--workers', type = int, default = 0,
+                        help = "run the server as this many worker processes behind launcher.py, 0 for a single process")
+    args = parser.parse_args()
+    
+    main(args)
@@ -0,0 +1,282 @@
+import collections
+import select
+import socket
+import struct
+import time
+
+import clocksync
+import packet
+import sim
+
+'''
+Client core: connecting, the handshake, sending inputs and receiving
+snapshots, without pygame
+
+Session holds the protocol state and does no I/O itself, it's fed what
+arrives and hands back what has to go out. Client runs a session over a
+socket with blocking connects and select (client.py's network thread is
+one of these), AsyncClient runs one over asyncio streams. Nothing here
+imports more than the standard library and the protocol modules, so
+bots, probes and tests can talk to a server without a display, and
+asyncio is only imported once an AsyncClient connects.
+
+Quick use:
+    
+    c = netclient.Client("probe")
+    c.connect('127.0.0.1', 10000)
+    while c.poll(1):
+        print(c.session.state, c.session.clock)
+'''
+
+'''
+Protocol state of one connection
+'''
+class Session:
+    def __init__(self, name = '', **kwargs):
+        self.name = name
+        self.watch = kwargs.get('watch') #match id to spectate instead of playing, None to play
+        self.view_delay = kwargs.get('view_delay', 0.07) #seconds the renderer draws behind the newest snapshot, told to the server
+        
+        self.state = packet.GamePacket() #the match as of the newest messages
+        self.frames = packet.FrameBuffer() #received stream bytes not yet parsed into messages
+        self.decoder = packet.SnapshotDecoder()
+        self.clock = clocksync.ClockSync() #round trip time and server clock
+        self.newest = None #(seq, tick, fields, time received) of the newest snapshot
+        self.snapshot_age = None #smoothed time from the server simulating a snapshot to it arriving (seconds)
+        self.welcome = None #the server's UDP offer, if it made one
+        
+        self.input_seq = 0
+        self.recent_inputs = collections.deque(maxlen = 3) #(seq, tick, pos, key), newest last
+    
+    #first message on a new connection
+    def hello(self):
+        if self.watch is not None:
+            return packet.frame(packet.WatchPacket(self.watch).pack_bytes())
+        return packet.frame(packet.HelloPacket(self.name, round(self.view_delay * 1000)).pack_bytes())
+    
+    #stamp a new input with our tick, the server plays it in at the same pace (see jitterbuffer.py)
+    def add_input(self, pos, key, now):
+        self.input_seq = (self.input_seq + 1) & 0xFFFF
+        tick = int(now / sim.Simulation.tick_interval) & 0xFFFF
+        self.recent_inputs.append((self.input_seq, tick, pos, key))
+    
+    #inputs message carrying the newest count inputs
+    def inputs_message(self, count):
+        return packet.InputsPacket(list(self.recent_inputs)[-count:]).pack_bytes()
+    
+    #handle received messages, skipping straight to the newest snapshot
+    #returns (framed replies for the stream, ack for a new snapshot or None)
+    def handle(self, messages, now):
+        reliable, snapshot = packet.latest_snapshot(messages)
+        
+        replies = b''
+        for raw in reliable:
+            msg_type = raw[0]
+            if msg_type == packet.MSG_PING:
+                replies += clocksync.answer(raw, now)
+            elif msg_type == packet.MSG_PONG:
+                self.clock.pong(raw, now)
+            elif msg_type == packet.MSG_ROSTER:
+                roster = packet.RosterPacket()
+                roster.unpack_bytes(raw)
+                self.state.p1_name = roster.p1_name
+                self.state.p2_name = roster.p2_name
+            elif msg_type == packet.MSG_SCORE:
+                score = packet.ScorePacket()
+                score.unpack_bytes(raw)
+                self.state.score = score.score
+                self.state.server = score.server
+            elif msg_type == packet.MSG_WELCOME:
+                self.welcome = packet.WelcomePacket()
+                self.welcome.unpack_bytes(raw)
+        
+        ack = self.apply_snapshot(snapshot, now) if snapshot else None
+        return replies, ack
+    
+    def apply_snapshot(self, raw, now):
+        decoded = self.decoder.decode(raw) #None if stale or out of order
+        if not decoded:
+            return None
+        seq, tick, fields = decoded
+        packet.apply_snapshot(fields, self.state)
+        self.newest = (seq, tick, fields, now)
+        
+        age = self.clock.snapshot_age(tick, now)
+        if age is not None:
+            self.snapshot_age = age if self.snapshot_age is None else self.snapshot_age + (age - self.snapshot_age) / 8
+        
+        if self.watch is not None: #spectator streams are all keyframes, nothing to ack
+            return None
+        return packet.AckPacket(seq).pack_bytes()
+
+'''
+Session over a socket, for blocking code and select loops
+
+Takes the UDP transport if asked to and the server offers it, snapshots
+and acks then go over UDP and everything else stays on the stream.
+'''
+class Client:
+    def __init__(self, name = '', **kwargs):
+        self.session = Session(name, **kwargs)
+        self.use_udp = kwargs.get('udp', False) #take the UDP transport if the server offers it
+        self.loss = kwargs.get('loss', 0) #fraction of outgoing datagrams to drop, for testing
+        self.input_resend_interval = kwargs.get('input_resend_interval', 0.1) #resend inputs over UDP this often even if they haven't changed
+        
+        self.host = None
+        self.sock = None
+        self.udp_sock = None
+        self.outbound = bytearray() #stream bytes the socket hasn't taken yet, sent in order once it's writable
+        self.last_input_tx = 0
+    
+    #blocking connect and handshake, the socket is non-blocking from then on
+    def connect(self, host, port, timeout = None):
+        self.host = host
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) #acks and pongs go out as they're written
+        self.sock.sendall(self.session.hello())
+        self.sock.setblocking(False)
+    
+    def close(self):
+        self.outbound.clear()
+        if self.sock:
+            self.sock.close()
+        if self.udp_sock:
+            self.udp_sock.close()
+            self.udp_sock = None
+    
+    def sockets(self):
+        return [self.sock, self.udp_sock] if self.udp_sock else [self.sock]
+    
+    #wait up to timeout for the server and handle whatever arrived, returns True if anything did
+    #raises ConnectionResetError once the server has closed or sent something that doesn't parse
+    def poll(self, timeout):
+        r, w, e = select.select(self.sockets(), [self.sock] if self.outbound else [], [], timeout)
+        now = time.time()
+        if w:
+            self.flush()
+        if self.sock in r:
+            self.receive(now)
+        if self.udp_sock and self.udp_sock in r:
+            self.receive_datagrams(now)
+        ping = self.session.clock.ping(now)
+        if ping:
+            self.send_stream(ping)
+        return bool(r)
+    
+    #queue stream data and send what the socket takes without blocking, the rest goes out from poll
+    def send_stream(self, data):
+        self.outbound += data
+        self.flush()
+    
+    def flush(self):
+        if not self.outbound:
+            return
+        try:
+            sent = self.sock.send(self.outbound)
+        except BlockingIOError:
+            return
+        del self.outbound[:sent]
+    
+    #handle everything buffered on the stream
+    def receive(self, now):
+        self.handle(self.session.frames.feed(packet.recv_all(self.sock)), now)
+    
+    #handle every datagram waiting on the UDP socket
+    def receive_datagrams(self, now):
+        messages = []
+        while True:
+            try:
+                data = self.udp_sock.recv(packet.max_datagram_length)
+            except (BlockingIOError, ConnectionRefusedError):
+                break
+            try:
+                messages.extend(packet.datagram_messages(data))
+            except (ValueError, struct.error):
+                pass #a mangled datagram only loses itself
+        self.handle(messages, now)
+    
+    def handle(self, messages, now):
+        try:
+            replies, ack = self.session.handle(messages, now)
+        except struct.error:
+            raise ConnectionResetError("malformed message from the server")
+        if replies:
+            self.send_stream(replies)
+        if self.use_udp and self.session.welcome and self.session.welcome.udp_port and not self.udp_sock:
+            self.open_udp()
+        if ack:
+            if self.udp_sock:
+                self.send_datagram([ack])
+            else:
+                self.send_stream(packet.frame(ack))
+    
+    def open_udp(self):
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.connect((self.host, self.session.welcome.udp_port))
+        self.udp_sock.setblocking(False)
+        self.send_datagram([]) #registers our address with the server
+    
+    #send messages in one datagram with our token in front
+    def send_datagram(self, messages):
+        data = packet.datagram_header.pack(self.session.welcome.token) + b''.join(packet.frame(m) for m in messages)
+        packet.send_datagram(self.udp_sock, data, loss = self.loss)
+    
+    def send_input(self, pos, key):
+        now = time.time()
+        self.session.add_input(pos, key, now)
+        if self.udp_sock:
+            self.send_datagram([self.session.inputs_message(len(self.session.recent_inputs))])
+            self.last_input_tx = now
+        else:
+            self.send_stream(packet.frame(self.session.inputs_message(1)))
+    
+    #over UDP the newest inputs are repeated now and then in case every datagram carrying them was lost
+    def resend_inputs(self):
+        now = time.time()
+        if self.udp_sock and self.session.recent_inputs and now - self.last_input_tx > self.input_resend_interval:
+            self.send_datagram([self.session.inputs_message(len(self.session.recent_inputs))])
+            self.last_input_tx = now
+
+'''
+Session over asyncio streams, stream transport only
+'''
+class AsyncClient:
+    def __init__(self, name = '', **kwargs):
+        self.session = Session(name, **kwargs)
+        self.reader = None
+        self.writer = None
+    
+    async def connect(self, host, port):
+        import asyncio
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(self.session.hello())
+    
+    #wait for the server and handle what it sent, returns False once it has closed
+    async def receive(self):
+        data = await self.reader.read(65536)
+        if not data:
+            return False
+        
+        now = time.time()
+        try:
+            replies, ack = self.session.handle(self.session.frames.feed(data), now)
+        except (ValueError, struct.error):
+            raise ConnectionResetError("malformed message from the server")
+        if ack:
+            replies += packet.frame(ack)
+        replies += self.session.clock.ping(now) or b''
+        if replies:
+            self.writer.write(replies)
+        return True
+    
+    def send_input(self, pos, key):
+        self.session.add_input(pos, key, time.time())
+        self.writer.write(packet.frame(self.session.inputs_message(1)))
+    
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
@@ -1,5 +1,7 @@
 import socket
 import struct
+import random
+import functools
 
 '''
 Base packet class
@@ -18,9 +20,11 @@ class Packet:
 Server -> Client Packet
 '''
 class GamePacket(Packet):
-    def __init__(self):
-        self.packstring = 'hhhh16s16sBBB'
+    packstring = 'hhhh16s16sBBB'
+    codec = struct.Struct(packstring)
+    length = codec.size
     
+    def __init__(self):
         self.ball = (0,0) #ball position (x, y)
         self.p1y = 0 #player 1 y coordinate
         self.p2y = 0 #player 2 y coordinate
@@ -29,18 +33,15 @@ class GamePacket(Packet):
         self.score = (0,0) #player score (p1, p2)
         self.server = 0 #0 = game, 1 = p1, 2 = p2, 3 = waiting, 4 = end
         
-        self.length = struct.calcsize(self.packstring)
-        
     def pack_bytes(self):
-        return struct.pack(self.packstring,
-                            self.ball[0], self.ball[1], 
+        return self.codec.pack(self.ball[0], self.ball[1], 
                             self.p1y, self.p2y,
-                            bytes(self.p1_name, 'utf-8'), bytes(self.p2_name, 'utf-8'),
+                            encode_name(self.p1_name), encode_name(self.p2_name),
                             self.score[0], self.score[1],
                             self.server)
     
     def unpack_bytes(self, raw):
-        data = struct.unpack(self.packstring, raw)
+        data = self.codec.unpack(raw)
         
         self.ball = (data[0], data[1])
         self.p1y = data[2]
@@ -61,21 +62,573 @@ class GamePacket(Packet):
 Client -> Server Game Packet
 '''
 class PlayerPacket(Packet):
+    packstring = '16shB'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
     def __init__(self, username, pos):
-        self.packstring = '16shB'
-        
         self.name = username #p1 or p2
         self.pos = pos #y position
         self.key = 0
         
-        self.length = struct.calcsize(self.packstring)
-        
     def pack_bytes(self):
-        return struct.pack(self.packstring, bytes(self.name, 'utf-8'), self.pos, self.key)
+        return self.codec.pack(encode_name(self.name), self.pos, self.key)
     
     def unpack_bytes(self, raw):
-        data = struct.unpack(self.packstring, raw)
+        data = self.codec.unpack(raw)
         self.name, self.pos, self.key = data
         
     def __str__(self):
-        return "Username {}, Pos: {}".format(self.name, self.pos)
\ No newline at end of file
+        return "Username {}, Pos: {}".format(self.name, self.pos)
+
+'''
+Message protocol
+
+Every message starts with a message type byte and is packed in network
+byte order, so there is no alignment padding. Player names, score and
+serve state only change now and then, so they get their own messages
+that are sent when they change. Ball and paddle positions go out every
+transmit as snapshots, delta-encoded against the newest snapshot the
+client has acknowledged.
+'''
+MSG_ROSTER = 1 #server -> client, player names
+MSG_SCORE = 2 #server -> client, score and serve state
+MSG_SNAPSHOT = 3 #server -> client, full ball and paddle positions
+MSG_DELTA = 4 #server -> client, ball and paddle positions relative to an acknowledged snapshot
+MSG_HELLO = 5 #client -> server, username, sent once connected
+MSG_INPUT = 6 #client -> server, paddle position and key
+MSG_ACK = 7 #client -> server, sequence number of the newest snapshot received
+MSG_WELCOME = 8 #server -> client, token and port for the optional UDP transport
+MSG_INPUTS = 9 #client -> server, the newest few inputs with their sequence numbers and ticks
+MSG_WATCH = 10 #spectator -> server or relay, the match to watch
+MSG_PING = 11 #either way, the sender's clock when it was sent
+MSG_PONG = 12 #either way, answers a ping with both sides' clocks (see clocksync.py)
+
+#true if sequence number a is newer than b, allowing for wraparound
+def seq_newer(a, b):
+    return 0 < ((a - b) & 0xFFFF) < 0x8000
+
+#names repeat on every roster, so their encodings are kept
+@functools.lru_cache(maxsize = 1024)
+def encode_name(name):
+    return bytes(name, 'utf-8')
+
+def decode_name(raw):
+    return raw.rstrip(b'\x00').decode("utf_8", errors = "replace")
+
+'''
+Server -> Client player names
+'''
+class RosterPacket(Packet):
+    msg_type = MSG_ROSTER
+    packstring = '!B16s16s'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, p1_name = "", p2_name = ""):
+        self.p1_name = p1_name
+        self.p2_name = p2_name
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, encode_name(self.p1_name), encode_name(self.p2_name))
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.p1_name = decode_name(data[1])
+        self.p2_name = decode_name(data[2])
+    
+    def __str__(self):
+        return "P1: {}, P2: {}".format(self.p1_name, self.p2_name)
+
+'''
+Server -> Client score and serve state
+'''
+class ScorePacket(Packet):
+    msg_type = MSG_SCORE
+    packstring = '!BBBB'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, score = (0,0), server = 0):
+        self.score = score #player score (p1, p2)
+        self.server = server #same values as GamePacket.server
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, self.score[0], self.score[1], self.server)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.score = (data[1], data[2])
+        self.server = data[3]
+    
+    def __str__(self):
+        return "Score: {}, Server: {}".format(self.score, self.server)
+
+'''
+Client -> Server username and how far behind the server its view is drawn
+'''
+class HelloPacket(Packet):
+    msg_type = MSG_HELLO
+    packstring = '!B16sH'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, username = "", view_delay = 0):
+        self.name = username
+        self.view_delay = view_delay #interpolation delay in ms
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, encode_name(self.name), self.view_delay)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.name = decode_name(data[1])
+        self.view_delay = data[2]
+    
+    def __str__(self):
+        return "Username: {}, View delay: {} ms".format(self.name, self.view_delay)
+
+'''
+Client -> Server paddle position and key
+'''
+class InputPacket(Packet):
+    msg_type = MSG_INPUT
+    packstring = '!BhB'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, pos = 0, key = 0):
+        self.pos = pos #y position
+        self.key = key
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, self.pos, self.key)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.pos = data[1]
+        self.key = data[2]
+    
+    def __str__(self):
+        return "Pos: {}, Key: {}".format(self.pos, self.key)
+
+'''
+Client -> Server snapshot acknowledgement
+'''
+class AckPacket(Packet):
+    msg_type = MSG_ACK
+    packstring = '!BH'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, seq = 0):
+        self.seq = seq
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, self.seq)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.seq = data[1]
+    
+    def __str__(self):
+        return "Ack: {}".format(self.seq)
+
+'''
+Server -> Client UDP transport details, port 0 means the server has no UDP transport
+'''
+class WelcomePacket(Packet):
+    msg_type = MSG_WELCOME
+    packstring = '!BIH'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, token = 0, udp_port = 0):
+        self.token = token #identifies the connection in datagrams from the client
+        self.udp_port = udp_port
+        
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, self.token, self.udp_port)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.token = data[1]
+        self.udp_port = data[2]
+        
+    def __str__(self):
+        return "Token: {}, UDP Port: {}".format(self.token, self.udp_port)
+
+'''
+Client -> Server tick-stamped inputs
+
+Carries the newest few (seq, tick, pos, key) inputs, oldest first. The
+tick is the client's tick (modulo 65536) the input was made on, and the
+server plays it in at the matching tick (see jitterbuffer.py). Over UDP
+the newest few are repeated, so losing a datagram doesn't lose an input
+as long as a later one gets through, on the stream each input is sent
+once.
+'''
+class InputsPacket(Packet):
+    msg_type = MSG_INPUTS
+    packstring = '!BB'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    input_codec = struct.Struct('!HHhB')
+    
+    def __init__(self, inputs = ()):
+        self.inputs = list(inputs) #(seq, tick, pos, key), oldest first
+        
+    def pack_bytes(self):
+        buffer = bytearray(self.length + len(self.inputs) * self.input_codec.size)
+        self.codec.pack_into(buffer, 0, self.msg_type, len(self.inputs))
+        for i, values in enumerate(self.inputs):
+            self.input_codec.pack_into(buffer, self.length + i * self.input_codec.size, *values)
+        return bytes(buffer)
+    
+    def unpack_bytes(self, raw):
+        count = self.codec.unpack_from(raw)[1]
+        self.inputs = [self.input_codec.unpack_from(raw, self.length + i * self.input_codec.size) for i in range(count)]
+        
+    def __str__(self):
+        return "Inputs: {}".format(self.inputs)
+
+'''
+Spectator -> Server match to watch, sent instead of a hello on the spectator port
+
+Spectators are sent roster, score and full snapshots at the spectator
+rate and never send inputs. WATCH_ANY follows whichever match is going.
+'''
+WATCH_ANY = 0xFFFF
+
+class WatchPacket(Packet):
+    msg_type = MSG_WATCH
+    packstring = '!BH'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, match_id = WATCH_ANY):
+        self.match_id = match_id
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, self.match_id)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.match_id = data[1]
+    
+    def __str__(self):
+        return "Watch: {}".format(self.match_id)
+
+'''
+Clock sync ping, answered straight away with a pong
+'''
+class PingPacket(Packet):
+    msg_type = MSG_PING
+    packstring = '!Bd'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, sent = 0):
+        self.sent = sent #sender's time.time()
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, self.sent)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.sent = data[1]
+    
+    def __str__(self):
+        return "Ping: {:.6f}".format(self.sent)
+
+'''
+Clock sync pong, the ping's send time echoed with the answering side's
+receive and reply times, and from the server the match tick it replied on
+(modulo 65536, 0 from clients) so snapshot ticks can be put on its clock
+'''
+class PongPacket(Packet):
+    msg_type = MSG_PONG
+    packstring = '!BdddH'
+    codec = struct.Struct(packstring)
+    length = codec.size
+    
+    def __init__(self, ping_sent = 0, received = 0, replied = 0, tick = 0):
+        self.ping_sent = ping_sent
+        self.received = received
+        self.replied = replied
+        self.tick = tick
+    
+    def pack_bytes(self):
+        return self.codec.pack(self.msg_type, self.ping_sent, self.received, self.replied, self.tick)
+    
+    def unpack_bytes(self, raw):
+        data = self.codec.unpack(raw)
+        self.ping_sent, self.received, self.replied, self.tick = data[1:]
+    
+    def __str__(self):
+        return "Pong: {:.6f}, Received: {:.6f}, Replied: {:.6f}, Tick: {}".format(self.ping_sent, self.received,
+                                                                                  self.replied, self.tick)
+
+'''
+Server -> Client ball and paddle positions
+
+A snapshot is the tuple (ball x, ball y, p1 y, p2 y), stamped with the
+server tick it was taken on (modulo 65536). Keyframes carry the tick and
+all four fields. Deltas carry the sequence and tick distances back to
+their base snapshot and a mask byte: bit i set means field i changed,
+bit i + 4 set means its difference is sent as a short instead of a
+signed byte.
+'''
+snapshot_format = '!BHHhhhh'
+delta_format = '!BHBBB'
+snapshot_codec = struct.Struct(snapshot_format)
+delta_codec = struct.Struct(delta_format)
+delta_length = delta_codec.size
+diff_codecs = (struct.Struct('!b'), struct.Struct('!h'))
+
+def snapshot_fields(state):
+    return (state.ball[0], state.ball[1], state.p1y, state.p2y)
+
+def apply_snapshot(fields, state):
+    state.ball = (fields[0], fields[1])
+    state.p1y = fields[2]
+    state.p2y = fields[3]
+
+'''
+Snapshots taken by one match, shared by its users' encoders
+
+One snapshot is taken per transmit. Every user whose newest ack is the
+same base gets the same framed bytes, so each snapshot is encoded at
+most once per distinct base however many users are watching. Deltas are
+packed into a reusable buffer with the frame header in front.
+'''
+class SnapshotHistory:
+    history_size = 32 #snapshots kept as possible bases
+    framed_snapshot_codec = struct.Struct('!H' + snapshot_format[1:])
+    framed_delta_codec = struct.Struct('!H' + delta_format[1:])
+    
+    def __init__(self):
+        self.seq = 0
+        self.tick = 0
+        self.fields = None
+        self.history = {} #seq -> (tick, fields), oldest first
+        self.framed = {} #base seq (None for a keyframe) -> framed current snapshot
+        self.buffer = bytearray(self.framed_delta_codec.size + 8) #room for four short diffs
+    
+    #take this transmit's snapshot, returns its seq
+    def update(self, state, tick = 0):
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.tick = tick & 0xFFFF
+        self.fields = snapshot_fields(state)
+        
+        self.history[self.seq] = (self.tick, self.fields)
+        while len(self.history) > self.history_size:
+            del self.history[next(iter(self.history))]
+        self.framed.clear()
+        return self.seq
+    
+    #the current snapshot framed for a client whose newest ack is base, a keyframe if base is None or gone
+    def frame(self, base = None):
+        if base not in self.history:
+            base = None
+        framed = self.framed.get(base)
+        if framed is None:
+            framed = self.framed[base] = self.encode(base)
+        return framed
+    
+    def encode(self, base):
+        if base is not None:
+            base_tick, base_fields = self.history[base]
+            distance = (self.seq - base) & 0xFFFF
+            ticks = (self.tick - base_tick) & 0xFFFF
+            if distance <= 255 and ticks <= 255: #otherwise too far back to express in a delta
+                return self.encode_delta(distance, ticks, base_fields)
+        return self.framed_snapshot_codec.pack(snapshot_codec.size, MSG_SNAPSHOT, self.seq, self.tick, *self.fields)
+    
+    def encode_delta(self, distance, ticks, base):
+        buffer = self.buffer
+        offset = self.framed_delta_codec.size
+        mask = 0
+        for i in range(4):
+            diff = self.fields[i] - base[i]
+            if diff != 0:
+                mask |= 1 << i
+                if -128 <= diff <= 127:
+                    diff_codecs[0].pack_into(buffer, offset, diff)
+                    offset += 1
+                else:
+                    mask |= 16 << i
+                    diff_codecs[1].pack_into(buffer, offset, diff)
+                    offset += 2
+        
+        self.framed_delta_codec.pack_into(buffer, 0, offset - frame_header.size, MSG_DELTA, self.seq, distance, ticks, mask)
+        return bytes(buffer[:offset])
+
+'''
+Per-client snapshot encoder, lives on the server and tracks what the client has acknowledged
+'''
+class SnapshotEncoder:
+    def __init__(self, snapshots = None):
+        self.snapshots = snapshots or SnapshotHistory() #shared with the other users of the match
+        self.acked = None #newest acknowledged seq
+    
+    #the match's current snapshot, framed for this client
+    def frame(self):
+        return self.snapshots.frame(self.acked)
+    
+    #take a snapshot and frame it, for an encoder with a history of its own
+    def encode(self, state, tick = 0):
+        self.snapshots.update(state, tick)
+        return self.frame()
+    
+    #returns True if seq is a newer snapshot than any acknowledged so far
+    def ack(self, seq):
+        if seq not in self.snapshots.history or (self.acked is not None and not seq_newer(seq, self.acked)):
+            return False
+        self.acked = seq
+        return True
+
+'''
+Per-connection snapshot decoder, lives on the client
+'''
+class SnapshotDecoder:
+    history_size = 64 #decoded snapshots kept as possible bases
+    
+    def __init__(self):
+        self.history = {} #seq -> (tick, fields), oldest first
+        self.latest = None #newest decoded seq
+    
+    #returns (seq, tick, fields), or None if the snapshot is stale or its base is gone
+    def decode(self, raw):
+        if raw[0] == MSG_SNAPSHOT:
+            data = snapshot_codec.unpack(raw)
+            seq = data[1]
+            tick = data[2]
+            fields = data[3:]
+        else:
+            msg_type, seq, distance, ticks, mask = delta_codec.unpack_from(raw)
+            if (seq - distance) & 0xFFFF not in self.history:
+                return None
+            
+            base_tick, base = self.history[(seq - distance) & 0xFFFF]
+            tick = (base_tick + ticks) & 0xFFFF
+            fields = list(base)
+            offset = delta_length
+            for i in range(4):
+                if mask & (1 << i):
+                    codec = diff_codecs[1] if mask & (16 << i) else diff_codecs[0]
+                    fields[i] += codec.unpack_from(raw, offset)[0]
+                    offset += codec.size
+            fields = tuple(fields)
+        
+        if self.latest is not None and not seq_newer(seq, self.latest):
+            return None
+        
+        self.latest = seq
+        self.history[seq] = (tick, fields)
+        while len(self.history) > self.history_size:
+            del self.history[next(iter(self.history))]
+        return seq, tick, fields
+
+'''
+Stream framing
+
+Every message goes on the stream behind a 2 byte length prefix, so a
+reader never depends on how recv happens to split the stream and can
+step over message types it doesn't know.
+'''
+frame_header = struct.Struct('!H')
+max_frame_length = 1024
+
+def frame(message):
+    return frame_header.pack(len(message)) + message
+
+'''
+Per-connection reassembly buffer, collects received bytes and hands back complete messages
+'''
+class FrameBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
+        
+    #add received bytes, returns every message completed by them in order (raises ValueError on a bad frame)
+    #messages are memoryviews into the received bytes, nothing is copied unless a frame spans two reads
+    def feed(self, data):
+        if self.buffer:
+            self.buffer.extend(data)
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        view = memoryview(data)
+        
+        messages = []
+        offset = 0
+        while len(view) - offset >= frame_header.size:
+            length = frame_header.unpack_from(view, offset)[0]
+            if length == 0 or length > max_frame_length:
+                raise ValueError("Bad frame length {}".format(length))
+            if len(view) - offset - frame_header.size < length:
+                break
+            
+            offset += frame_header.size
+            messages.append(view[offset:offset + length])
+            offset += length
+        
+        self.buffer.extend(view[offset:])
+        return messages
+
+#read everything a non-blocking socket has buffered, raises ConnectionResetError once the peer has closed
+def recv_all(sock, size = 65536):
+    chunks = []
+    while True:
+        try:
+            data = sock.recv(size)
+        except BlockingIOError:
+            break
+        if not data:
+            if not chunks:
+                raise ConnectionResetError
+            break
+        chunks.append(data)
+        if len(data) < size:
+            break
+    return b''.join(chunks)
+
+'''
+Datagrams
+
+Server -> client datagrams are one or more framed messages. Client ->
+server datagrams start with the connection's token from the welcome
+message, followed by framed messages.
+'''
+datagram_header = struct.Struct('!I')
+max_datagram_length = 1200
+
+#all messages in a datagram (raises ValueError on a bad frame)
+def datagram_messages(data):
+    return FrameBuffer().feed(data)
+
+#True for a fraction (loss) of calls, used to drop datagrams when testing against packet loss
+def lose_datagram(loss):
+    return loss > 0 and random.random() < loss
+
+#best effort send on a UDP socket, optionally dropping a fraction of datagrams
+def send_datagram(sock, data, addr = None, loss = 0):
+    if lose_datagram(loss):
+        return
+    try:
+        if addr:
+            sock.sendto(data, addr)
+        else:
+            sock.send(data)
+    except (BlockingIOError, ConnectionRefusedError):
+        pass #datagrams are best effort
+
+#splits messages into reliable ones (to be applied in order) and the newest snapshot, older snapshots are dropped
+def latest_snapshot(messages):
+    reliable = []
+    snapshot = None
+    for raw in messages:
+        if raw[0] == MSG_SNAPSHOT or raw[0] == MSG_DELTA:
+            snapshot = raw
+        else:
+            reliable.append(raw)
+    return reliable, snapshot
@@ -0,0 +1,356 @@
+import argparse
+import bisect
+import mmap
+import struct
+import time
+
+import packet
+import sim
+
+'''
+Match recordings
+
+A recording is an append-only log of one match. It starts with a header,
+then holds two kinds of record:
+- an input record for every step whose inputs differ from the inputs the
+  simulation was left with after the step before
+- a keyframe holding the whole simulation, every keyframe_ticks and
+  whenever the server changed the state between steps (a player joining
+  or leaving)
+The simulation is deterministic, so replaying the inputs from any
+keyframe reproduces the match exactly. Every later keyframe is then a
+checkpoint to compare the replay against.
+
+Closing the recorder appends an end record, an index of keyframe offsets
+and a footer pointing at the index. A log cut short by a crash has none
+of these, so its keyframes are found by scanning it instead.
+'''
+magic = b'NPRC'
+index_magic = b'NPIX'
+version = 2
+
+REC_INPUT = 1 #inputs for the step taken at this tick
+REC_KEYFRAME = 2 #whole simulation and inputs before the step taken at this tick
+REC_END = 3 #tick the recording stopped at
+REC_INDEX = 4 #(tick, offset) of every keyframe, only written on close
+
+header_codec = struct.Struct('!4sBBIdd') #magic, version, step ticks, match id, ball speed, start time
+record_header = struct.Struct('!BI') #type, tick, at the front of every record
+inputs_format = 'hhBBBBB' #p1y, p2y, p1 key, p2 key, players, p1 lag, p2 lag
+input_codec = struct.Struct('!BI' + inputs_format)
+history_size = sim.Simulation.max_lag_ticks + 4
+keyframe_codec = struct.Struct('!BI' + inputs_format
+                            + 'dddddI' #ball x, y, velocity x, y, last hit, end start
+                            + 'hh16s16sBBB' #the GamePacket fields
+                            + 'ii' + 'h' * (2 * history_size) #view ticks and paddle histories
+                            + 'BdddddB' * 2 #pending misses: present, time, ball x, y, velocity x, y, lag
+                            + 'd') #ball time carried over
+end_codec = record_header
+index_entry = struct.Struct('!IQ')
+footer_codec = struct.Struct('!Q4s') #offset of the index record, index magic
+
+record_sizes = {REC_INPUT : input_codec.size, REC_KEYFRAME : keyframe_codec.size, REC_END : end_codec.size}
+
+#unpacked keyframe fields compared when checking a replay, names and score only when no one joined or left
+keyframe_sim = (slice(9, 17), slice(21, None))
+keyframe_names = slice(17, 19)
+keyframe_score = slice(19, 21)
+
+def input_values(inputs):
+    return (inputs.p1y, inputs.p2y, inputs.p1_key, inputs.p2_key, inputs.players, inputs.p1_lag, inputs.p2_lag)
+
+def set_inputs(inputs, values):
+    inputs.p1y, inputs.p2y, inputs.p1_key, inputs.p2_key, inputs.players, inputs.p1_lag, inputs.p2_lag = values
+
+def pack_keyframe(simulation, inputs):
+    state = simulation.state
+    missed = []
+    for miss in simulation.missed:
+        if miss is None:
+            missed.extend((0, 0, 0, 0, 0, 0, 0))
+        else:
+            when, pos, velocity, lag = miss
+            missed.extend((1, when, pos[0], pos[1], velocity[0], velocity[1], lag))
+    
+    return keyframe_codec.pack(REC_KEYFRAME, simulation.tick, *input_values(inputs),
+                            simulation.ball_subpixel[0], simulation.ball_subpixel[1],
+                            simulation.ball_velocity[0], simulation.ball_velocity[1],
+                            simulation.last_hit, simulation.end_start,
+                            state.p1y, state.p2y, packet.encode_name(state.p1_name), packet.encode_name(state.p2_name),
+                            state.score[0], state.score[1], state.server,
+                            simulation.view_ticks[0], simulation.view_ticks[1],
+                            *simulation.paddle_history[0], *simulation.paddle_history[1],
+                            *missed, simulation.ball_carry)
+
+#put a simulation and its inputs back to an unpacked keyframe
+def restore_keyframe(values, simulation, inputs):
+    simulation.tick = values[1]
+    set_inputs(inputs, values[2:9])
+    
+    x, y, v_x, v_y, simulation.last_hit, simulation.end_start = values[9:15]
+    simulation.ball_subpixel = (x, y)
+    simulation.ball_velocity = (v_x, v_y)
+    
+    state = simulation.state
+    state.p1y, state.p2y = values[15:17]
+    state.p1_name = packet.decode_name(values[17])
+    state.p2_name = packet.decode_name(values[18])
+    state.score = values[19:21]
+    state.server = values[21]
+    state.ball = sim.vec2quantize(simulation.ball_subpixel)
+    
+    simulation.view_ticks = list(values[22:24])
+    histories = values[24:24 + 2 * history_size]
+    simulation.paddle_history = (list(histories[:history_size]), list(histories[history_size:]))
+    
+    missed = values[24 + 2 * history_size:-1]
+    simulation.missed = [None, None]
+    for player in (0, 1):
+        present, when, x, y, v_x, v_y, lag = missed[7 * player:7 * player + 7]
+        if present:
+            simulation.missed[player] = (when, (x, y), (v_x, v_y), lag)
+    simulation.ball_carry = values[-1]
+
+'''
+Writes one match's recording, called either side of every step
+
+Between keyframes a step costs a tuple comparison, and a 14 byte write
+into the file's buffer when the inputs changed.
+'''
+class Recorder:
+    keyframe_ticks = 500
+    buffer_size = 65536
+    
+    def __init__(self, path, simulation, match_id = 0):
+        self.file = open(path, 'xb', buffering = self.buffer_size)
+        self.file.write(header_codec.pack(magic, version, simulation.step_ticks, match_id,
+                                        simulation.ball_speed, time.time()))
+        self.offset = header_codec.size
+        
+        self.index = [] #(tick, offset) of every keyframe
+        self.next_keyframe = 0
+        self.last_inputs = None #inputs as the simulation left them after the last step
+        self.outside = None #names and score after the last step, anything else means the server changed them
+    
+    def write(self, record):
+        self.file.write(record)
+        self.offset += len(record)
+    
+    #before a step, with the inputs it's about to take
+    def record_step(self, simulation, inputs):
+        state = simulation.state
+        if simulation.tick >= self.next_keyframe or (state.p1_name, state.p2_name, state.score) != self.outside:
+            self.index.append((simulation.tick, self.offset))
+            self.write(pack_keyframe(simulation, inputs))
+            self.next_keyframe = simulation.tick + self.keyframe_ticks
+            self.file.flush() #a crash loses at most the steps since the last keyframe
+        else:
+            values = input_values(inputs)
+            if values != self.last_inputs:
+                self.write(input_codec.pack(REC_INPUT, simulation.tick, *values))
+    
+    #after a step, the simulation can change the inputs (serve keys are cleared once taken)
+    def stepped(self, simulation, inputs):
+        state = simulation.state
+        self.outside = (state.p1_name, state.p2_name, state.score)
+        self.last_inputs = input_values(inputs)
+    
+    def close(self, simulation):
+        if self.file.closed:
+            return
+        self.write(end_codec.pack(REC_END, simulation.tick))
+        
+        index_offset = self.offset
+        self.write(record_header.pack(REC_INDEX, len(self.index)))
+        for tick, offset in self.index:
+            self.write(index_entry.pack(tick, offset))
+        self.write(footer_codec.pack(index_offset, index_magic))
+        self.file.close()
+
+'''
+A recording opened for replay, memory mapped so seeking only touches the pages it reads
+'''
+class Recording:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        
+        file_magic, file_version, self.step_ticks, self.match_id, self.ball_speed, self.start_time = header_codec.unpack_from(self.data)
+        if file_magic != magic or file_version != version:
+            raise ValueError("{} is not a version {} match recording".format(path, version))
+        
+        if not self.read_index():
+            self.scan()
+        if not self.index:
+            raise ValueError("{} has no keyframes".format(path))
+    
+    #use the index written on close, False if there isn't one
+    def read_index(self):
+        if len(self.data) < header_codec.size + footer_codec.size:
+            return False
+        index_offset, footer_magic = footer_codec.unpack_from(self.data, len(self.data) - footer_codec.size)
+        if footer_magic != index_magic:
+            return False
+        
+        kind, count = record_header.unpack_from(self.data, index_offset)
+        self.index = [index_entry.unpack_from(self.data, index_offset + record_header.size + i * index_entry.size)
+                      for i in range(count)]
+        self.end = index_offset
+        kind, self.end_tick = end_codec.unpack_from(self.data, index_offset - end_codec.size)
+        return True
+    
+    #walk every record, stopping at the first one that's cut short
+    def scan(self):
+        self.index = []
+        self.end_tick = 0
+        offset = header_codec.size
+        while offset + record_header.size <= len(self.data):
+            kind, tick = record_header.unpack_from(self.data, offset)
+            size = record_sizes.get(kind)
+            if size is None or offset + size > len(self.data):
+                break
+            if kind == REC_KEYFRAME:
+                self.index.append((tick, offset))
+            self.end_tick = tick
+            offset += size
+        self.end = offset
+    
+    def close(self):
+        self.data.close()
+
+'''
+Headless replay of a recording from any tick
+
+With verify set, every keyframe reached is compared with the replayed
+simulation before it's applied, and the ticks that differ are kept in
+mismatches.
+'''
+class Replay:
+    def __init__(self, recording, tick = 0, verify = False):
+        self.recording = recording
+        self.verify = verify
+        self.checked = 0 #keyframes compared
+        self.mismatches = [] #ticks of keyframes that didn't match the replay
+        
+        self.simulation = sim.Simulation(recording.step_ticks)
+        self.simulation.ball_speed = recording.ball_speed
+        self.inputs = sim.PlayerInput()
+        
+        #start from the last keyframe at or before tick
+        ticks = [keyframe_tick for keyframe_tick, offset in recording.index]
+        keyframe_tick, self.offset = recording.index[max(0, bisect.bisect_right(ticks, tick) - 1)]
+        restore_keyframe(keyframe_codec.unpack_from(recording.data, self.offset), self.simulation, self.inputs)
+        self.offset += keyframe_codec.size
+        
+        while self.simulation.tick < tick and self.step():
+            pass
+    
+    #apply the records for the current tick and take a step, False once the recording is over
+    def step(self):
+        data = self.recording.data
+        while self.offset < self.recording.end:
+            kind, tick = record_header.unpack_from(data, self.offset)
+            if tick > self.simulation.tick:
+                break
+            if kind == REC_INPUT:
+                set_inputs(self.inputs, input_codec.unpack_from(data, self.offset)[2:])
+            elif kind == REC_KEYFRAME:
+                values = keyframe_codec.unpack_from(data, self.offset)
+                if self.verify:
+                    self.check(values)
+                restore_keyframe(values, self.simulation, self.inputs)
+            self.offset += record_sizes[kind]
+        
+        if self.simulation.tick >= self.recording.end_tick:
+            return False
+        self.simulation.step(self.inputs)
+        return True
+    
+    def check(self, values):
+        ours = keyframe_codec.unpack(pack_keyframe(self.simulation, self.inputs))
+        same = all(ours[part] == values[part] for part in keyframe_sim)
+        if ours[keyframe_names] == values[keyframe_names]:
+            same = same and ours[keyframe_score] == values[keyframe_score]
+        if not same:
+            self.mismatches.append(values[1])
+        self.checked += 1
+
+#replay the whole recording as fast as possible, checking every keyframe
+def verify(recording):
+    replay = Replay(recording, verify = True)
+    start = time.perf_counter()
+    first_tick = replay.simulation.tick
+    while replay.step():
+        pass
+    elapsed = time.perf_counter() - start
+    
+    game_time = (replay.simulation.tick - first_tick) * sim.Simulation.tick_interval
+    print("match {}: {:.0f} s of play, final score {}".format(recording.match_id, game_time, replay.simulation.state.score))
+    print("replayed in {:.2f} s, {:.0f}x real time".format(elapsed, game_time / max(elapsed, 1e-9)))
+    print("keyframes checked: {}, mismatched: {}".format(replay.checked, len(replay.mismatches)))
+    for tick in replay.mismatches[:10]:
+        print("    mismatch at tick {}".format(tick))
+    return not replay.mismatches
+
+#draw the replay with the client's renderer, at speed times real time
+def play(recording, tick, speed):
+    import pygame
+    import client
+    
+    pygame.init()
+    pygame.display.set_caption("NetPong replay")
+    window = pygame.display.set_mode([client.w_screen, client.h_screen], pygame.RESIZABLE)
+    screen = pygame.Surface((client.w_screen, client.h_screen))
+    clock = pygame.time.Clock()
+    
+    game = client.Game()
+    replay = Replay(recording, tick)
+    game.net.session.state = replay.simulation.state #the replay stands in for the network thread
+    
+    start = time.time()
+    start_tick = replay.simulation.tick
+    shown = None
+    run = True
+    while run:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                run = False
+        
+        now = time.time()
+        target = start_tick + (now - start) * speed / sim.Simulation.tick_interval
+        while replay.simulation.tick < target and replay.step():
+            pass
+        
+        if replay.simulation.tick != shown:
+            shown = replay.simulation.tick
+            state = replay.simulation.state
+            game.net.session.newest = (shown & 0xFFFF, shown & 0xFFFF, packet.snapshot_fields(state), now)
+            game.publish()
+        
+        screen.fill(client.background_color)
+        game.draw(screen)
+        window.blit(pygame.transform.scale(screen, window.get_rect().size), (0, 0))
+        pygame.display.flip()
+        clock.tick(60)
+    
+    pygame.quit()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "NetPong match recordings")
+    parser.add_argument('path')
+    parser.add_argument('--tick', type = int, default = 0, help = "tick to start from")
+    parser.add_argument('--show', action = 'store_true', help = "print the state at --tick instead of verifying")
+    parser.add_argument('--play', action = 'store_true', help = "play the recording back in a window")
+    parser.add_argument('--speed', type = float, default = 1, help = "playback speed for --play")
+    args = parser.parse_args()
+    
+    recording = Recording(args.path)
+    if args.play:
+        play(recording, args.tick, args.speed)
+    elif args.show:
+        replay = Replay(recording, args.tick)
+        print("tick {}: {}".format(replay.simulation.tick, replay.simulation.state))
+    else:
+        ok = verify(recording)
+        recording.close()
+        exit(0 if ok else 1)
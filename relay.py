@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import time
+
+import packet
+
+'''
+Spectator relay, run with: python relay.py --server HOST
+
+Watches one match on a game server's spectator port like any other
+spectator and passes the stream on to spectators of its own, so the game
+server sends the stream once however many people are watching. Relays
+can watch relays, so more viewers just means more relays.
+
+The newest roster and score are kept for viewers who join later. Each
+snapshot is framed once and the same bytes are written to every viewer.
+A viewer whose connection hasn't taken the last snapshot yet skips this
+one, and a viewer who stays behind for too long is dropped.
+'''
+
+'''
+One spectator connected to the relay
+'''
+class Viewer:
+    def __init__(self, writer):
+        self.writer = writer
+        self.last_roster = None #last roster/score messages sent, resent only when they change
+        self.last_score = None
+        self.behind_since = None #when the viewer's connection last had nothing left over
+
+class Relay:
+    def __init__(self, server, server_port, port, **kwargs):
+        self.server = server
+        self.server_port = server_port #the server's spectator port
+        self.port = port
+        self.match_id = kwargs.get('match_id', packet.WATCH_ANY)
+        self.max_stall = kwargs.get('max_stall', 2) #seconds a viewer may stay backed up before they're dropped
+        self.max_queued = kwargs.get('max_queued', 65536) #bytes a viewer may have buffered before they're dropped
+        self.retry_interval = kwargs.get('retry_interval', 1) #seconds between attempts to reach the server
+        
+        self.viewers = []
+        self.roster = None #newest framed roster and score from the server
+        self.score = None
+        
+        self.snapshots = 0 #snapshots received from the server
+        self.skipped = 0 #snapshots not sent to a viewer who was still behind
+        self.dropped = 0 #viewers dropped for falling too far behind
+    
+    #watch the match on the server, reconnecting whenever it goes away
+    async def subscribe(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.server, self.server_port)
+            except OSError:
+                await asyncio.sleep(self.retry_interval)
+                continue
+            
+            print("Watching {}:{}".format(self.server, self.server_port))
+            writer.write(packet.frame(packet.WatchPacket(self.match_id).pack_bytes()))
+            frames = packet.FrameBuffer()
+            try:
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                    for raw in frames.feed(data):
+                        self.forward(raw)
+            except (ConnectionError, ValueError):
+                pass
+            writer.close()
+            
+            print("Lost the server, reconnecting")
+            await asyncio.sleep(self.retry_interval)
+    
+    def forward(self, raw):
+        msg_type = raw[0]
+        if msg_type == packet.MSG_ROSTER:
+            self.roster = packet.frame(bytes(raw))
+        elif msg_type == packet.MSG_SCORE:
+            self.score = packet.frame(bytes(raw))
+        elif msg_type == packet.MSG_SNAPSHOT:
+            self.fan_out(packet.frame(bytes(raw)))
+    
+    #write one framed snapshot to every viewer that has taken the last one
+    def fan_out(self, snapshot):
+        self.snapshots += 1
+        now = time.monotonic()
+        for viewer in self.viewers:
+            writer = viewer.writer
+            if writer.is_closing():
+                continue
+            
+            buffered = writer.transport.get_write_buffer_size()
+            if buffered:
+                self.skipped += 1
+                if viewer.behind_since is None:
+                    viewer.behind_since = now
+                elif now - viewer.behind_since > self.max_stall or buffered > self.max_queued:
+                    self.dropped += 1
+                    writer.transport.abort()
+                continue
+            viewer.behind_since = None
+            
+            if self.roster is not viewer.last_roster or self.score is not viewer.last_score:
+                writer.write((self.roster or b'') + (self.score or b''))
+                viewer.last_roster = self.roster
+                viewer.last_score = self.score
+            writer.write(snapshot)
+    
+    #viewers have nothing to say, what they send is read and ignored until they leave
+    async def handle_viewer(self, reader, writer):
+        viewer = Viewer(writer)
+        self.viewers.append(viewer)
+        try:
+            while await reader.read(65536):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.viewers.remove(viewer)
+            writer.close()
+    
+    async def serve(self):
+        listener = await asyncio.start_server(self.handle_viewer, '', self.port)
+        async with listener:
+            await self.subscribe()
+    
+    def __str__(self):
+        return "Viewers: {}, snapshots: {}, skipped: {}, dropped: {}".format(len(self.viewers), self.snapshots,
+                                                                         self.skipped, self.dropped)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "NetPong spectator relay")
+    parser.add_argument('--server', default = '127.0.0.1', help = "game server or relay to watch")
+    parser.add_argument('--server-port', type = int, default = 10002, help = "its spectator port")
+    parser.add_argument('--port', type = int, default = 10003, help = "port for our own spectators")
+    parser.add_argument('--match', type = int, default = packet.WATCH_ANY, help = "match id to watch, any by default")
+    args = parser.parse_args()
+    
+    relay = Relay(args.server, args.server_port, args.port, match_id = args.match)
+    try:
+        asyncio.run(relay.serve())
+    except KeyboardInterrupt:
+        print("Keyboard interrupt: stopping relay")
+        print(relay)
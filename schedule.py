@@ -0,0 +1,51 @@
+import heapq
+
+'''
+The select server's match deadlines, in a heap
+
+Every match that's awake has one deadline: its next step or transmit,
+whichever comes first. A hibernating match has one only if its state
+times out by itself (the end screen), otherwise it's not in here at all
+and costs nothing until a user wakes it. The loop sleeps until the
+earliest deadline and only touches the matches that are due.
+
+Moving a deadline pushes a new entry and leaves the old one in the heap,
+it's skipped when it comes up.
+'''
+class Schedule:
+    def __init__(self):
+        self.heap = [] #(due, match id, match)
+        self.due = {} #match -> due of its live entry
+    
+    def set(self, match, due):
+        if self.due.get(match) == due:
+            return
+        self.due[match] = due
+        heapq.heappush(self.heap, (due, match.id, match))
+    
+    def remove(self, match):
+        self.due.pop(match, None)
+    
+    #earliest deadline, None if nothing is scheduled
+    def next_due(self):
+        heap = self.heap
+        while heap:
+            due, match_id, match = heap[0]
+            if self.due.get(match) == due:
+                return due
+            heapq.heappop(heap)
+        return None
+    
+    #take every match due by now off the schedule, earliest first
+    def pop_due(self, now):
+        heap = self.heap
+        matches = []
+        while heap and heap[0][0] <= now:
+            due, match_id, match = heapq.heappop(heap)
+            if self.due.get(match) == due:
+                del self.due[match]
+                matches.append(match)
+        return matches
+    
+    def __len__(self):
+        return len(self.due)
@@ -1,265 +1,975 @@
+import os
 import socket
-import select
-import threading
+import selectors
 import random
 import struct
 import time
-import math
+import collections
+import argparse
 
+import clocksync
+import jitterbuffer
 import packet
+import record
+import schedule
+import sim
+import stats
 
-def vec2add(a, b):
-    return (a[0] + b[0], a[1] + b[1])
-
-def vec2mul(a, b):
-    return (a[0] * b[0], a[1] * b[1])
+def init_socket(sock):
+    sock.setblocking(False)
 
-def vec2scalarmul(a, b):
-    return (a * b[0], a * b[1])
+#user streams carry small messages that shouldn't wait on Nagle for the previous one to be acknowledged
+def init_stream(sock):
+    init_socket(sock)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-def vec2div(a,b):
-    return (a[0] / b[0], a[1] / b[1])
+'''
+Tick timing statistics, records how far each tick strayed from the tick interval
+(or, with another label, any other per-tick duration)
+'''
+class TickStats:
+    def __init__(self, size = 10000, label = "Jitter"):
+        self.label = label
+        self.samples = collections.deque(maxlen = size) #most recent deviations (seconds)
+        self.count = 0
+        self.worst = 0
+    
+    def record(self, deviation):
+        self.samples.append(deviation)
+        self.count += 1
+        self.worst = max(self.worst, abs(deviation))
+    
+    def percentile(self, p):
+        if not self.samples:
+            return 0
+        ordered = sorted(abs(d) for d in self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    
+    def __str__(self):
+        if not self.samples:
+            return "Ticks: 0"
+        mean = sum(abs(d) for d in self.samples) / len(self.samples)
+        return "Ticks: {}, {} mean: {:.3f} ms, p50: {:.3f} ms, p99: {:.3f} ms, max: {:.3f} ms".format(self.count,
+                                                                                                    self.label,
+                                                                                                    mean * 1000,
+                                                                                                    self.percentile(50) * 1000,
+                                                                                                    self.percentile(99) * 1000,
+                                                                                                    self.worst * 1000)
 
-def vec2quantize(a):
-    return (int(a[0]), int(a[1]))
+'''
+One independent game between two players, wraps a simulation with its users
+'''
+class Match:
+    tx_interval = 0.033
+    
+    def __init__(self, match_id, lag_compensation = True, step_ticks = 1, record_dir = None, trace = None):
+        self.id = match_id
+        self.trace = trace #the server's tracer.Tracer, None when not tracing
+        self.lag_compensation = lag_compensation #judge hits against the paddle each user saw
+        self.sim = sim.Simulation(step_ticks)
+        self.sim.trace = trace
+        self.tick_interval = self.sim.step_interval #seconds between steps
+        
+        self.recorder = None #appends every step to a recording when the server has a record_dir
+        if record_dir is not None:
+            path = os.path.join(record_dir, "match-{}-{}.npr".format(time.strftime("%Y%m%d-%H%M%S"), match_id))
+            try:
+                self.recorder = record.Recorder(path, self.sim, match_id)
+            except OSError as e: #the match is still played, only not recorded
+                print("Not recording match {}: {}".format(match_id, e))
+        self.state = self.sim.state #current game state to be sent to users
+        self.inputs = sim.PlayerInput() #latest inputs from the users
+        
+        self.snapshots = packet.SnapshotHistory() #one snapshot per transmit, shared by the users' encoders
+        self.sent_times = {} #snapshot seq -> send time, oldest first, for measuring round trips
+        self.roster = self.score = None #framed roster and score messages as of the last transmit
+        self.roster_key = self.score_key = None
+        
+        self.last_tx = 0
+        self.last_tick = 0
+        
+        self.users = [] #user connections, index 0 = p1, index 1 = p2
+        self.spectators = [] #spectator connections, all sent the same stream
+        self.last_spectator_tx = 0
+        self.spectator_fields = None #snapshot fields the spectators were last sent
+        
+        self.hibernating = False #not stepped or sent until a user does something or wake_at comes
+        self.wake_at = None #loop time a hibernating match's state times out by itself, None if only users can wake it
+    
+    def is_full(self):
+        return len(self.users) >= 2
+    
+    def add_user(self, user):
+        self.users.append(user)
+        self.inputs.players = len(self.users)
+    
+    def remove_user(self, user):
+        user_index = self.users.index(user)
+        self.users.remove(user)
+        self.inputs.players = len(self.users)
+        
+        if user_index == 0:
+            if len(self.users) > 0:
+                self.state.p1_name = self.state.p2_name
+                self.state.score = (self.state.score[1], self.state.score[0])
+                self.state.p2_name = ""
+            else:
+                self.state.p1_name = ""
+        elif user_index == 1:
+            self.state.p2_name = ""
+    
+    def set_name(self, user, name):
+        user_index = self.users.index(user)
+        
+        if user_index == 0:
+            self.state.p1_name = name
+        elif user_index == 1:
+            self.state.p2_name = name
+    
+    def set_input(self, user_index, pos, key):
+        if user_index == 0:
+            self.inputs.p1y = pos
+            self.inputs.p1_key = key
+        elif user_index == 1:
+            self.inputs.p2y = pos
+            self.inputs.p2_key = key
+    
+    #play the users' buffered inputs due during this step, returns (user index, key as last made) for each
+    def play_inputs(self):
+        end = self.sim.tick + self.sim.step_ticks
+        played = []
+        for user_index, conn in enumerate(self.users):
+            command = conn.input_buffer.take(end)
+            if command:
+                pos, pressed, key = command
+                self.set_input(user_index, pos, pressed)
+                played.append((user_index, key))
+        return played
+    
+    #a key press played in only lasts its step, unless the simulation took it the key goes back to how it was last made
+    def release_keys(self, played):
+        for user_index, key in played:
+            if user_index == 0 and self.inputs.p1_key:
+                self.inputs.p1_key = key
+            elif user_index == 1 and self.inputs.p2_key:
+                self.inputs.p2_key = key
+    
+    #advance the game by one step if one is due, returns True if it ticked
+    def update(self, loop_time):
+        if loop_time - self.last_tick < self.tick_interval:
+            return False
+        
+        self.step()
+        #steps keep to a fixed schedule so game time keeps pace with the clock, unless it fell far behind
+        self.last_tick += self.tick_interval
+        if loop_time - self.last_tick > self.tick_interval:
+            self.last_tick = loop_time
+        return True
+    
+    #advance the game by exactly one step
+    def step(self):
+        trace = self.trace
+        if trace:
+            trace.begin('step')
+            trace.begin('inputs')
+        played = self.play_inputs()
+        if self.lag_compensation:
+            self.inputs.p1_lag = self.users[0].lag_ticks() if len(self.users) > 0 else 0
+            self.inputs.p2_lag = self.users[1].lag_ticks() if len(self.users) > 1 else 0
+        if trace:
+            trace.end()
+        
+        if self.recorder:
+            self.recorder.record_step(self.sim, self.inputs)
+        if trace:
+            trace.begin('simulate')
+        self.sim.step(self.inputs)
+        self.release_keys(played)
+        if trace:
+            trace.end()
+        if self.recorder:
+            self.recorder.stepped(self.sim, self.inputs)
+        if trace:
+            trace.end()
+    
+    #go to sleep if the coming steps can't change anything and everyone has the current state, returns True if it did
+    #inputs waiting in a buffer, a serve key held down, the ball in play or anything still queued for a user keep a
+    #match awake: roster and score count as sent once queued, and nothing flushes a sleeping match's users
+    def hibernate(self):
+        idle = self.sim.idle_steps(self.inputs)
+        if idle == 0:
+            return False
+        
+        fields = self.snapshots.fields
+        state = self.state
+        if fields != packet.snapshot_fields(state) or (state.p1_name, state.p2_name) != self.roster_key \
+                or (state.score, state.server) != self.score_key: #changed since the last transmit
+            return False
+        for conn in self.users:
+            if conn.input_buffer.commands or conn.has_pending() \
+                    or conn.last_roster is not self.roster or conn.last_score is not self.score:
+                return False
+            acked = self.snapshots.history.get(conn.encoder.acked) #UDP snapshots can be lost, so only an ack will do
+            if acked is None or acked[1] != fields:
+                return False
+        for conn in self.spectators:
+            if self.spectator_fields != fields or conn.has_pending() \
+                    or conn.last_roster is not self.roster or conn.last_score is not self.score:
+                return False
+        
+        self.hibernating = True
+        self.wake_at = None if idle is None else self.last_tick + (idle + 1) * self.tick_interval
+        return True
     
-def vec2mag(a): #returns scalar
-    return math.sqrt(a[0] ** 2 + a[1] ** 2)
+    #take the steps a hibernating match slept through up to loop_time at once, they'd have changed nothing but the tick
+    #anything that reads the tick or changes the inputs calls this first
+    def catch_up(self, loop_time):
+        if not self.hibernating:
+            return
+        steps = int((loop_time - self.last_tick) / self.tick_interval)
+        idle = self.sim.idle_steps(self.inputs)
+        if idle is not None:
+            steps = min(steps, idle)
+        if steps > 0:
+            self.sim.skip(self.inputs, steps)
+            self.last_tick += steps * self.tick_interval
+    
+    def wake(self, loop_time):
+        self.catch_up(loop_time)
+        self.hibernating = False
+        self.wake_at = None
+    
+    #finish the recording, if there is one
+    def close(self):
+        if self.recorder:
+            self.recorder.close(self.sim)
+    
+    #loop time of the next tick or transmit
+    def next_due(self):
+        return min(self.last_tick + self.tick_interval, self.last_tx + self.tx_interval)
+    
+    #returns True (and restarts the timer) if the state should be sent out
+    def tx_due(self, loop_time):
+        if loop_time - self.last_tx >= self.tx_interval:
+            self.last_tx = loop_time
+            return True
+        return False
+    
+    #take this transmit's snapshot, returns the framed messages shared by every user: (roster, score)
+    #roster and score are only packed again when they change, so unchanged ones are the same objects
+    def transmit(self):
+        seq = self.snapshots.update(self.state, self.sim.tick)
+        self.sent_times[seq] = time.monotonic()
+        while len(self.sent_times) > self.snapshots.history_size:
+            del self.sent_times[next(iter(self.sent_times))]
+        
+        names = (self.state.p1_name, self.state.p2_name)
+        if names != self.roster_key:
+            self.roster = packet.frame(packet.RosterPacket(*names).pack_bytes())
+            self.roster_key = names
+        score = (self.state.score, self.state.server)
+        if score != self.score_key:
+            self.score = packet.frame(packet.ScorePacket(*score).pack_bytes())
+            self.score_key = score
+        return self.roster, self.score
 
-def init_socket(sock):
-    sock.setblocking(False)
+'''
+Server side of one user's connection
+'''
+class Connection:
+    def __init__(self, sock, match, conn_id = 0, spectator = False):
+        self.sock = sock #socket, or asyncio StreamWriter
+        self.id = conn_id
+        self.match = match #None for a spectator waiting for their match
+        self.spectator = spectator
+        self.watching = None #match id a spectator asked for
+        self.frames = packet.FrameBuffer() #received bytes not yet parsed into messages
+        
+        self.encoder = packet.SnapshotEncoder(match.snapshots) if match else None
+        self.last_roster = None #last roster/score messages sent, resent only when they change
+        self.last_score = None
+        
+        self.token = random.getrandbits(32) #identifies this connection's datagrams
+        self.udp_addr = None #set once the user's first datagram arrives, snapshots then go over UDP
+        self.input_buffer = jitterbuffer.InputBuffer() #tick-stamped inputs waiting for their tick
+        
+        self.srtt = None #smoothed round trip time from snapshot acks (seconds)
+        self.clock = clocksync.ClockSync() #round trip time, jitter and clock offset from pings
+        self.view_delay = 0 #how far behind the newest snapshot the user draws (seconds)
+        
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.snapshots_sent = 0
+        self.snapshots_coalesced = 0 #snapshots replaced by a newer one before they went out
+        self.send_failures = 0
+        
+        self.outbound = bytearray() #bytes handed to the stream, sent exactly as they are
+        self.reliable = collections.deque() #framed messages waiting, in order
+        self.reliable_bytes = 0
+        self.snapshot = None #newest framed snapshot waiting, replaced while it waits
+        self.behind_since = None #when the stream last had nothing left over
+        self.writing = False #the select loop is waiting for the socket to take more
+    
+    #queue outgoing stream data, reliable messages keep their order and only the newest snapshot is kept
+    def queue(self, reliable = b'', snapshot = None):
+        if reliable:
+            self.reliable.append(reliable)
+            self.reliable_bytes += len(reliable)
+        if snapshot is not None:
+            if self.snapshot is not None:
+                self.snapshots_coalesced += 1
+            self.snapshot = snapshot
+    
+    def has_pending(self):
+        return bool(self.outbound or self.reliable or self.snapshot)
+    
+    #everything queued, in send order, the queue is left empty
+    def take_pending(self):
+        data = b''.join(self.reliable) + (self.snapshot or b'')
+        self.reliable.clear()
+        self.reliable_bytes = 0
+        self.snapshot = None
+        return data
+    
+    def queued_bytes(self):
+        return len(self.outbound) + self.reliable_bytes + len(self.snapshot or b'')
+    
+    #round trip sample from a snapshot ack
+    def ack(self, seq):
+        if not self.encoder.ack(seq): #stale, or a repeat
+            return
+        sent = self.match.sent_times.get(seq)
+        if sent is None:
+            return
+        rtt = time.monotonic() - sent
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+    
+    #ticks between the server simulating a tick and this user's reaction to it being played in
+    def lag_ticks(self):
+        if self.srtt is None:
+            return 0
+        buffered = self.input_buffer.depth if self.input_buffer.received else 0
+        return min(round((self.srtt + self.view_delay) / sim.Simulation.tick_interval) + buffered,
+                   sim.Simulation.max_lag_ticks)
+    
+    #framed roster and score, whichever changed since this user was last sent them
+    def changed_messages(self, roster, score):
+        reliable = b''
+        if roster is not self.last_roster:
+            reliable += roster
+            self.last_roster = roster
+        if score is not self.last_score:
+            reliable += score
+            self.last_score = score
+        return reliable
+    
+    #everything this user needs for the current transmit: (framed reliable messages, framed snapshot)
+    def update_bytes(self, roster, score):
+        return self.changed_messages(roster, score), self.encoder.frame()
 
+'''
+Game server, runs any number of matches over one listening socket
+'''
 class Server:
     def __init__(self, port, **kwargs):
         self.port = port
         self.sock = socket.socket()
-        self.state = packet.GamePacket() #current game state to be sent to users
-        self.state.server = 3
         
-        self.ball_subpixel = (-2,-2) #float vector to convert to int for sending out state
-        self.ball_velocity = (0,0) #vector describing ball velocity
+        self.udp = kwargs.get('udp', False) #offer clients snapshots and inputs over UDP on the same port
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if self.udp else None
+        self.loss = kwargs.get('loss', 0) #fraction of outgoing datagrams to drop, for testing
+        self.lag_compensation = kwargs.get('lag_compensation', True)
+        self.step_ticks = kwargs.get('step_ticks', 1) #ticks of game time simulated per step, more means fewer steps a second
+        self.record_dir = kwargs.get('record_dir') #directory to record every match into, None to not record
+        if self.record_dir:
+            os.makedirs(self.record_dir, exist_ok = True)
+        self.max_stall = kwargs.get('max_stall', 2) #seconds a user's stream may stay backed up before they're dropped
+        self.max_queued = kwargs.get('max_queued', 65536) #bytes a user may have queued before they're dropped
+        self.tokens = {} #datagram token -> Connection
         
-        self.w_court = 160
-        self.h_court = 90
-        self.paddle_sep = 5
-        self.paddle_len = 9
+        self.matches = [] #active matches, a match is dropped once its last user leaves
+        self.connections = {} #user socket -> Connection
+        self.next_match_id = 0
         
-        self.last_tx = 0
-        self.tx_interval = 0.033
+        self.tick_stats = TickStats()
+        self.work_stats = TickStats(label = "Work") #time spent simulating and sending per loop that did either
+        self.metrics = stats.Metrics()
+        self.admin_port = kwargs.get('admin_port') #local port serving the stats report, None for no admin socket
+        self.admin_sock = None
+        self.spectator_port = kwargs.get('spectator_port') #port spectators and relays connect to, None for no spectators
+        self.spectator_interval = kwargs.get('spectator_interval', 0.1) #seconds between spectator snapshots
+        self.spectator_sock = None
+        self.waiting_spectators = [] #spectators whose match hasn't started yet
+        self.next_conn_id = 0
+        self.handoff = kwargs.get('handoff') #unix socket a launcher hands accepted users over (see launcher.py), None to listen ourselves
+        self.status_interval = kwargs.get('status_interval', 1) #seconds between load reports to the launcher
+        self.next_status = 0
+        self.status_clock = None #(wall, cpu) time of the last load report
+        self.adopted = 0 #users handed over by the launcher
+        self.failed = [] #users whose stream broke mid-send this tick, removed once the tick is done
+        self.trace = kwargs.get('trace') #tracer.Tracer for the loop's phases, None to not trace
+        self.schedule = schedule.Schedule() #deadlines of the matches that are awake or have a state timeout
+        self.hibernation = kwargs.get('hibernation', True) #let idle matches sleep until a user does something
+        self.selector = selectors.DefaultSelector() #epoll or kqueue where there is one, sockets are registered once
         
-        self.last_tick = 0
-        self.tick_interval = 0.01
+        self.open = True
+    
+    def start(self):
+        if not self.handoff:
+            self.sock.bind(('',self.port))
+        if self.udp:
+            self.udp_sock.bind(('',self.port))
+            init_socket(self.udp_sock)
+        if self.admin_port:
+            self.admin_sock = stats.admin_socket(self.admin_port)
+        if self.spectator_port:
+            self.spectator_sock = socket.socket()
+            self.spectator_sock.bind(('',self.spectator_port))
+    
+    def listen(self):
+        if self.handoff:
+            init_socket(self.handoff)
+        else:
+            self.sock.listen()
+            init_socket(self.sock)
+        if self.spectator_sock:
+            self.spectator_sock.listen()
+            init_socket(self.spectator_sock)
+        
+        #the select loop calls a listening socket's handler when it's readable, user sockets carry their Connection
+        if self.handoff:
+            self.selector.register(self.handoff, selectors.EVENT_READ, self.adopt_users)
+        else:
+            self.selector.register(self.sock, selectors.EVENT_READ, self.accept_users)
+        if self.udp:
+            self.selector.register(self.udp_sock, selectors.EVENT_READ, self.receive_datagrams)
+        if self.admin_sock:
+            self.selector.register(self.admin_sock, selectors.EVENT_READ, self.serve_admin)
+        if self.spectator_sock:
+            self.selector.register(self.spectator_sock, selectors.EVENT_READ, self.accept_spectators)
+    
+    def accept(self):
+        return self.sock.accept()
+    
+    #put a new user into the first match with a free slot, or open a new match
+    def assign(self, user):
+        for match in self.matches:
+            if not match.is_full():
+                break
+        else:
+            match = Match(self.next_match_id, self.lag_compensation, self.step_ticks, self.record_dir, self.trace)
+            self.next_match_id += 1
+            self.matches.append(match)
+            self.schedule_match(match, 0)
+            for conn in list(self.waiting_spectators):
+                self.watch(conn, conn.watching)
         
-        self.last_hit = 0
-        self.hit_interval = 0.2
+        conn = Connection(user, match, self.next_conn_id)
+        self.next_conn_id += 1
+        self.metrics.accepted += 1
+        self.wake_match(match)
+        match.add_user(conn)
+        self.connections[user] = conn
+        self.tokens[conn.token] = conn
+        return conn
+    
+    #a spectator's stream starts once they've said which match to watch
+    def add_spectator(self, sock):
+        conn = Connection(sock, None, self.next_conn_id, spectator = True)
+        self.next_conn_id += 1
+        self.metrics.accepted += 1
+        self.connections[sock] = conn
+        return conn
+    
+    #move a spectator to the match they asked for, WATCH_ANY prefers a match with both players in,
+    #they wait for it if it hasn't started
+    def watch(self, conn, match_id):
+        if conn.match:
+            conn.match.spectators.remove(conn)
+            conn.match = None
+        elif conn in self.waiting_spectators:
+            self.waiting_spectators.remove(conn)
+        conn.watching = match_id
         
-        self.end_start = 0
-        self.end_interval = 5
+        if match_id == packet.WATCH_ANY:
+            candidates = [match for match in self.matches if match.is_full()] or self.matches
+        else:
+            candidates = [match for match in self.matches if match.id == match_id]
+        if not candidates:
+            self.waiting_spectators.append(conn)
+            return
         
-        self.users = [] #list of user sockets
-        self.open = True
+        conn.match = candidates[0]
+        conn.last_roster = conn.last_score = None #the new match's roster and score go out with its first snapshot
+        conn.match.spectators.append(conn)
+        self.wake_match(conn.match)
+    
+    def remove_user(self, user):
+        conn = self.connections.pop(user)
+        self.tokens.pop(conn.token, None)
+        match = conn.match
         
-        self.p1_key = 0 #user key presses (for serving)
-        self.p2_key = 0
+        if conn.spectator:
+            if match:
+                match.spectators.remove(conn)
+            elif conn in self.waiting_spectators:
+                self.waiting_spectators.remove(conn)
+            self.metrics.disconnected += 1
+            self.close_socket(user)
+            return
         
-        self.win_score = 10
+        self.wake_match(match)
+        match.remove_user(conn)
+        if len(match.users) == 0:
+            self.matches.remove(match)
+            self.schedule.remove(match)
+            match.close()
+            for spectator in list(match.spectators): #on to another match, or wait for one
+                self.watch(spectator, spectator.watching)
         
-        self.connection_thread = threading.Thread(target = self.await_connection, daemon = True)
+        self.metrics.disconnected += 1
+        self.close_socket(user)
+        print("Disconnected User")
+    
+    #a user's socket is waited on from accept to close, one that can't be is dropped straight away
+    def register(self, conn):
+        try:
+            self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+        except (ValueError, OSError):
+            self.remove_user(conn.sock)
+            return False
+        return True
+    
+    def close_socket(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+    
+    #wait for a user's socket to be writable only while they have data queued
+    def want_write(self, conn, backed_up):
+        if backed_up == conn.writing:
+            return
+        conn.writing = backed_up
+        try:
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE if backed_up else selectors.EVENT_READ, conn)
+        except (KeyError, ValueError, OSError):
+            self.drop_user(conn)
+    
+    def schedule_match(self, match, due):
+        self.schedule.set(match, due)
+    
+    #a hibernating match catches up on the steps it slept through and runs again, call before changing what it plays
+    def wake_match(self, match):
+        if match.hibernating:
+            match.wake(time.time())
+            self.schedule_match(match, match.next_due())
+    
+    def accept_users(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as e: #out of file descriptors, the user waits in the backlog
+                print("Accept failed: {}".format(e))
+                return
+            
+            init_stream(sock)
+            conn = self.assign(sock)
+            if self.register(conn):
+                print("Connection Accepted! (match {})".format(conn.match.id))
+    
+    #take the users the launcher has accepted for us, each one comes as one byte carrying its socket
+    def adopt_users(self):
+        while True:
+            try:
+                data, fds, flags, addr = socket.recv_fds(self.handoff, 1, 1)
+            except BlockingIOError:
+                return
+            if not data: #the launcher has gone, and so do we
+                self.open = False
+                return
+            for fd in fds:
+                self.adopt(socket.socket(fileno = fd))
+    
+    def adopt(self, sock):
+        self.adopted += 1
+        init_stream(sock)
+        conn = self.assign(sock)
+        if self.register(conn):
+            print("Connection Accepted! (match {})".format(conn.match.id))
+    
+    #tell the launcher how busy we are, a report it can't take right now is skipped
+    def send_status(self, now):
+        clock = (now, time.process_time())
+        cpu = 0
+        if self.status_clock and clock[0] > self.status_clock[0]:
+            cpu = (clock[1] - self.status_clock[1]) / (clock[0] - self.status_clock[0])
+        self.status_clock = clock
+        self.next_status = now + self.status_interval
+        try:
+            self.handoff.send(stats.worker_status(self, cpu))
+        except BlockingIOError:
+            pass
+        except (BrokenPipeError, ConnectionResetError): #the launcher has gone before we read its EOF
+            self.open = False
+    
+    def accept_spectators(self):
+        while True:
+            try:
+                sock, addr = self.spectator_sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                print("Accept failed: {}".format(e))
+                return
+            
+            init_stream(sock)
+            self.register(self.add_spectator(sock))
+    
+    #handle every complete message received from a user, raises ValueError on a bad frame
+    def handle_data(self, conn, data):
+        conn.bytes_received += len(data)
+        self.metrics.bytes_received += len(data)
+        for raw in conn.frames.feed(data):
+            self.handle_message(conn, raw)
+    
+    #handle a datagram, anything without a known token is ignored
+    def handle_datagram(self, data, addr):
+        self.metrics.datagrams_received += 1
+        self.metrics.bytes_received += len(data)
+        if len(data) < packet.datagram_header.size:
+            return
+        conn = self.tokens.get(packet.datagram_header.unpack_from(data)[0])
+        if conn is None:
+            return
         
-    def start(self):
-        self.sock.bind(('',self.port))
+        conn.udp_addr = addr
+        conn.bytes_received += len(data)
+        try:
+            for raw in packet.datagram_messages(data[packet.datagram_header.size:]):
+                self.handle_message(conn, raw)
+        except (ValueError, struct.error):
+            pass #a mangled datagram only loses itself
     
-    def listen(self):
-        self.sock.listen()
+    def handle_message(self, conn, raw):
+        self.metrics.messages_received += 1
+        if conn.match:
+            conn.match.catch_up(time.time()) #pongs and inputs are stamped with the tick
+        msg_type = raw[0]
+        if msg_type == packet.MSG_PING: #anyone may ask for the time
+            self.send_stream(conn, clocksync.answer(raw, time.time(), conn.match.sim.tick if conn.match else 0))
+        elif conn.spectator: #spectators only get to choose what they watch
+            if msg_type == packet.MSG_WATCH:
+                msg = packet.WatchPacket()
+                msg.unpack_bytes(raw)
+                self.watch(conn, msg.match_id)
+        elif msg_type == packet.MSG_INPUT: #untimed, from clients older than InputsPacket
+            msg = packet.InputPacket()
+            msg.unpack_bytes(raw)
+            if conn.input_buffer.add_unstamped(msg.pos, msg.key, conn.match.sim.tick):
+                self.wake_match(conn.match)
+        elif msg_type == packet.MSG_INPUTS:
+            msg = packet.InputsPacket()
+            msg.unpack_bytes(raw)
+            for seq, tick, pos, key in msg.inputs: #oldest first, the buffer skips anything it already has
+                if conn.input_buffer.add(seq, tick, pos, key, conn.match.sim.tick):
+                    self.wake_match(conn.match)
+        elif msg_type == packet.MSG_ACK:
+            msg = packet.AckPacket()
+            msg.unpack_bytes(raw)
+            conn.ack(msg.seq)
+        elif msg_type == packet.MSG_PONG:
+            conn.clock.pong(raw, time.time())
+        elif msg_type == packet.MSG_HELLO:
+            msg = packet.HelloPacket()
+            msg.unpack_bytes(raw)
+            self.wake_match(conn.match)
+            conn.match.set_name(conn, msg.name)
+            conn.view_delay = msg.view_delay / 1000
+            if self.udp:
+                self.send_stream(conn, packet.frame(packet.WelcomePacket(conn.token, self.port).pack_bytes()))
     
-    def accept(self):
-        return self.sock.accept()
+    def count_sent(self, conn, size):
+        conn.bytes_sent += size
+        self.metrics.bytes_sent += size
+    
+    #queue reliable stream data and send what the socket will take
+    def send_stream(self, conn, data):
+        conn.queue(data)
+        self.flush(conn)
+    
+    #send as much queued data as the socket takes without blocking, the rest waits for it to be writable
+    def flush(self, conn):
+        if not conn.outbound:
+            conn.outbound += conn.take_pending()
+        
+        if conn.outbound:
+            try:
+                sent = conn.sock.send(conn.outbound)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                conn.send_failures += 1
+                self.metrics.send_failures += 1
+                self.drop_user(conn)
+                return
+            del conn.outbound[:sent]
+            self.count_sent(conn, sent)
+        
+        backed_up = conn.has_pending()
+        self.want_write(conn, backed_up)
+        self.check_backlog(conn, backed_up)
+    
+    #drop users whose stream stays backed up for too long or whose queue grows too big
+    def check_backlog(self, conn, behind):
+        if not behind:
+            conn.behind_since = None
+            return
+        
+        now = time.monotonic()
+        if conn.behind_since is None:
+            conn.behind_since = now
+        elif now - conn.behind_since > self.max_stall or conn.queued_bytes() > self.max_queued:
+            self.metrics.slow_drops += 1
+            self.drop_user(conn)
+    
+    #users can't be removed mid tick, they're removed once it's done
+    def drop_user(self, conn):
+        if conn not in self.failed:
+            self.failed.append(conn)
+    
+    def send_datagram(self, conn, data):
+        if packet.lose_datagram(self.loss):
+            self.metrics.datagrams_dropped += 1
+            return
+        self.count_sent(conn, len(data))
+        self.metrics.datagrams_sent += 1
+        packet.send_datagram(self.udp_sock, data, conn.udp_addr)
+    
+    #send a user their update for this transmit, snapshots go over UDP once the user has a UDP address
+    def send_update(self, conn, roster, score):
+        trace = self.trace
+        if trace:
+            trace.begin('pack')
+        reliable, snapshot = conn.update_bytes(roster, score)
+        ping = conn.clock.ping(time.time())
+        if ping:
+            reliable += ping
+        conn.snapshots_sent += 1
+        self.metrics.snapshots_sent += 1
+        if trace:
+            trace.end()
+            trace.begin('send')
+        if conn.udp_addr:
+            if reliable:
+                self.send_stream(conn, reliable)
+            self.send_datagram(conn, snapshot)
+        else:
+            conn.queue(reliable, snapshot)
+            self.flush(conn)
+        if trace:
+            trace.end()
+    
+    #every spectator of a match gets the same full snapshot, spectators don't ack so no snapshot depends on another
+    def send_spectators(self, match, roster, score, loop_time):
+        if not match.spectators or loop_time - match.last_spectator_tx < self.spectator_interval:
+            return
+        match.last_spectator_tx = loop_time
+        match.spectator_fields = match.snapshots.fields
+        
+        snapshot = match.snapshots.frame()
+        for conn in match.spectators:
+            conn.snapshots_sent += 1
+            conn.queue(conn.changed_messages(roster, score), snapshot)
+            self.flush(conn)
+        self.metrics.spectator_snapshots += len(match.spectators)
+    
+    def receive_datagrams(self):
+        while True:
+            try:
+                data, addr = self.udp_sock.recvfrom(packet.max_datagram_length)
+            except (BlockingIOError, ConnectionResetError):
+                return
+            self.handle_datagram(data, addr)
     
-    def await_connection(self): #wait for connection and spawn user when connected
-        while self.open == True:
-            conn, addr = self.sock.accept()
-            self.users.append(conn)
-            init_socket(conn)
-            print("Connection Accepted!")
-    
-    #only call during a hit
-    def get_velocity_from_hit(self, player_y, ball_pos, ball_v):
-        v = vec2mul(ball_v, (-1,1))
-        m = vec2mag(v) #vector magnitude
-        v_x = v[0] / abs(v[0])#1 = right, -1 = left
-    
-        if abs(player_y - ball_pos[1]) <= self.paddle_len/6: #center hit (center 1/3 of paddle)
-            return (m * v_x, 0) #go straight
-        elif player_y - ball_pos[1] < 0: #if ball is below
-            return (m * v_x * 1/math.sqrt(2), m * 1/math.sqrt(2)) #go down
-        elif player_y - ball_pos[1] > 0: #if ball is above
-            return (m * v_x * 1/math.sqrt(2), m * -1/math.sqrt(2)) #go up
+    #answer every waiting admin connection with the stats report
+    def serve_admin(self):
+        while True:
+            try:
+                sock, addr = self.admin_sock.accept()
+            except BlockingIOError:
+                return
+            
+            sock.settimeout(1)
+            try:
+                sock.sendall(stats.report(self))
+            except OSError:
+                pass
+            sock.close()
     
     #server tick function
     def tick(self):
         loop_time = time.time()
-    
-        user_packet = packet.PlayerPacket(None, None)
+        trace = self.trace
         
-        '''
-        Server State Machine:
-        -0 = game
-        -1 = p1_serve
-        -2 = p2_serve
-        -3 = waiting
-        -4 = end
-        '''
         try:
-            if len(self.users) > 0:
-                r, w, e = select.select(self.users, self.users, self.users, 1)
+            if trace:
+                trace.begin('select')
+            #sleep until the next match is due, sockets only wake the loop when there's something to do
+            #with every match hibernating only a user (or the once a second housekeeping) wakes it
+            next_due = self.schedule.next_due()
+            timeout = next_due - loop_time if next_due is not None else 1
+            events = self.selector.select(max(0, min(timeout, 1)))
+            loop_time = time.time()
+            if trace:
+                trace.end()
             
-                for user in r: #readable sockets
-                    user_index = self.users.index(user)
-                
-                    try:
-                        user_packet.unpack_bytes(user.recv(user_packet.length))
-                        name_str = user_packet.name.rstrip(b'\x00').decode("utf_8")
-                        
-                        if user_index == 0:
-                            self.state.p1y = user_packet.pos
-                            self.state.p1_name = name_str
-                            self.p1_key = user_packet.key
-                        elif user_index == 1:
-                            self.state.p2y = user_packet.pos
-                            self.state.p2_name = name_str
-                            self.p2_key = user_packet.key
-                    except (ConnectionResetError, struct.error):
-                        self.users.remove(user)
-                        
-                        if user_index == 0:
-                            if len(self.users) > 0:
-                                self.state.p1_name = self.state.p2_name
-                                self.state.score = (self.state.score[1], self.state.score[0])
-                                self.state.p2_name = ""
-                            else:
-                                self.state.p1_name = ""
-                        elif user_index == 1:
-                            self.state.p2_name = ""
-                        
-                        print("Disconnected User")
-                    
-                '''
-                Do Game Logic + State machine
-                '''
-                if loop_time - self.last_tick >= self.tick_interval:
-                    '''
-                    State machine transitions
-                    '''
-                    if self.state.server == 0:
-                        #out of bounds
-                        if self.ball_subpixel[0] < 0: #out on player 1
-                            self.ball_subpixel = (80,100)
-                            self.state.score = vec2add(self.state.score,(0,1))
-                            self.state.server = 2
-                        elif self.ball_subpixel[0] > self.w_court: #out on player 2
-                            self.ball_subpixel = (80,100)
-                            self.state.score = vec2add(self.state.score,(1,0))
-                            self.state.server = 1
-                        if self.state.score[0] > self.win_score or self.state.score[1] > self.win_score:
-                            self.end_start = loop_time
-                            self.state.server = 4 #win mode
-                    elif self.state.server == 1:
-                        if len(self.users) < 2:
-                            self.state.server = 3
-                        elif self.p1_key == 32:
-                            self.ball_subpixel = (self.paddle_sep + 1, self.state.p1y)
-                            self.ball_velocity = (1,0)
-                            self.state.server = 0
-                            self.p1_key = 0
-                    elif self.state.server == 2:
-                        if len(self.users) < 2:
-                            self.state.server = 3
-                        elif self.p2_key == 32:
-                            self.ball_subpixel = (self.w_court - self.paddle_sep - 1, self.state.p2y)
-                            self.ball_velocity = (-1,0)
-                            self.state.server = 0
-                            self.p2_key = 0
-                    elif self.state.server == 3: #wait for players
-                        if len(self.users) >= 2:
-                            self.state.server = 1 #start game
-                    elif self.state.server == 4: #end
-                        if loop_time - self.end_start > self.end_interval:
-                            #determine who serves first based on winner
-                            if self.state.score[0] > self.state.score[1] and len(self.users) >= 2:
-                                self.state.server = 1
-                            elif self.state.score[1] > self.state.score[0] and len(self.users) >= 2:
-                                self.state.server = 2
-                            else:
-                                self.state.server = 3
-                                
-                            self.state.score = (0,0)
-                            self.state.ball = (80,100)
-                            self.p1y = 45
-                            self.p2y = 45
-                    '''
-                    State machine actions
-                    '''
-                    if self.state.server == 0: #game
-                        self.ball_subpixel = vec2add(self.ball_subpixel, self.ball_velocity)
-                            
-                        #wall bounce
-                        if self.ball_subpixel[1] <= 0 or self.ball_subpixel[1] >= self.h_court:
-                            self.ball_velocity = vec2mul(self.ball_velocity, (1,-1))
-                    
-                        #paddle hit (left)
-                        if int(self.ball_subpixel[0]) == self.paddle_sep:
-                            if abs(self.state.p1y - self.ball_subpixel[1]) <= self.paddle_len/2 and (loop_time - self.last_hit) > self.hit_interval:
-                                self.ball_velocity = self.get_velocity_from_hit(self.state.p1y,
-                                                                            self.ball_subpixel,
-                                                                            self.ball_velocity)
-                                self.last_hit = loop_time                                               
-                        #paddle hit (right)
-                        elif int(self.ball_subpixel[0]) == self.w_court - self.paddle_sep:
-                            if abs(self.state.p2y - self.ball_subpixel[1]) <= self.paddle_len/2 and (loop_time - self.last_hit) > self.hit_interval:
-                                self.ball_velocity = self.get_velocity_from_hit(self.state.p2y,
-                                                                            self.ball_subpixel,
-                                                                            self.ball_velocity)
-                                self.last_hit = loop_time
-                    elif self.state.server == 1: #p1 serve
-                        pass
-                    elif self.state.server == 2: #p2 serve
-                        pass
-                    elif self.state.server == 3: #waiting for players
-                        pass
-                    elif self.state.server == 4:
-                        pass
-                    
-                    '''
-                    Universal Actions
-                    '''
-                    self.state.ball = vec2quantize(self.ball_subpixel)
-                    
-                    self.last_tick = loop_time
+            recv_start = time.perf_counter()
+            writable = [] #backed up users whose sockets can take more
+            for key, mask in events:
+                conn = key.data
+                if not isinstance(conn, Connection): #a listening socket, data is its handler
+                    conn()
+                    continue
+                if conn.sock not in self.connections: #removed earlier in this loop
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    writable.append(conn)
+                if not mask & selectors.EVENT_READ:
+                    continue
                 
-                '''
-                Send updates to users
-                '''
-                if loop_time - self.last_tx >= self.tx_interval:
-                    for user in w: #writable sockets 
-                        user.sendall(self.state.pack_bytes())
-                        
-                    self.last_tx = loop_time
-
+                try:
+                    if trace:
+                        trace.begin('recv')
+                    data = packet.recv_all(conn.sock)
+                    if trace:
+                        trace.end()
+                        trace.begin('unpack')
+                    self.handle_data(conn, data)
+                    if trace:
+                        trace.end()
+                except (OSError, ValueError, struct.error): #only ever costs this user
+                    if trace:
+                        trace.end()
+                    self.remove_user(conn.sock)
+            
+            '''
+            Do Game Logic + State machine
+            '''
+            work_start = time.perf_counter()
+            if events:
+                self.metrics.phase['recv'].record(work_start - recv_start)
+            
+            ticked = False
+            due = self.schedule.pop_due(loop_time) #only these are looked at this time round
+            for match in due:
+                if match.hibernating: #its state timed out
+                    match.wake(loop_time)
+                last_tick = match.last_tick
+                if match.update(loop_time):
+                    ticked = True
+                    self.metrics.ticks += 1
+                    if last_tick:
+                        self.tick_stats.record(loop_time - last_tick - match.tick_interval)
+            
+            '''
+            Send updates to users
+            '''
+            broadcast_start = time.perf_counter()
+            if ticked:
+                self.metrics.phase['simulate'].record(broadcast_start - work_start)
+            
+            for conn in writable:
+                if conn.sock in self.connections:
+                    self.flush(conn)
+            
+            sent = False
+            for match in due:
+                if match.tx_due(loop_time):
+                    sent = True
+                    if trace:
+                        trace.begin('transmit')
+                    roster, score = match.transmit()
+                    if trace:
+                        trace.end()
+                    for conn in match.users:
+                        self.send_update(conn, roster, score)
+                    self.send_spectators(match, roster, score, loop_time)
+            
+            for conn in self.failed:
+                if conn.sock in self.connections:
+                    self.remove_user(conn.sock)
+            self.failed.clear()
+            
+            #back on the schedule, or asleep until a user does something or the state times out
+            for match in due:
+                if not match.users: #closed
+                    continue
+                if not (self.hibernation and match.hibernate()):
+                    self.schedule_match(match, match.next_due())
+                elif match.wake_at is not None:
+                    self.schedule_match(match, match.wake_at)
+            
+            if sent:
+                self.metrics.phase['broadcast'].record(time.perf_counter() - broadcast_start)
+            if ticked or sent:
+                self.work_stats.record(time.perf_counter() - work_start)
+            
+            if self.handoff and loop_time >= self.next_status:
+                self.send_status(loop_time)
+        
         except KeyboardInterrupt:
             print("Keyboard interrupt: killing server")
+            print(self.tick_stats)
+            print(self.work_stats)
+            for match in self.matches:
+                match.close()
             exit()
-        
+
 if __name__ == '__main__':
-    s = Server(10000)
-    s.state.ball = (80,45)
+    parser = argparse.ArgumentParser(description = "NetPong server")
+    parser.add_argument('--port', type = int, default = 10000)
+    parser.add_argument('--engine', choices = ['select', 'asyncio'], default = 'select')
+    parser.add_argument('--udp', action = 'store_true', help = "offer clients the UDP transport")
+    parser.add_argument('--loss', type = float, default = 0, help = "fraction of outgoing datagrams to drop")
+    parser.add_argument('--no-lag-compensation', dest = 'lag_compensation', action = 'store_false',
+                        help = "judge hits against the newest paddle positions only")
+    parser.add_argument('--admin-port', type = int, default = 10001, help = "local port for the stats report, 0 to disable")
+    parser.add_argument('--step-ticks', type = int, default = 1,
+                        help = "10 ms ticks simulated per step, 2 steps at 50 Hz, 4 at 25 Hz")
+    parser.add_argument('--record', metavar = 'DIR', help = "record every match into DIR (see record.py)")
+    parser.add_argument('--spectator-port', type = int, default = 10002, help = "port for spectators and relays, 0 to disable")
+    parser.add_argument('--spectator-rate', type = float, default = 10, help = "snapshots per second sent to spectators")
+    parser.add_argument('--no-hibernate', dest = 'hibernation', action = 'store_false',
+                        help = "keep stepping and sending matches that are waiting for players or a serve")
+    parser.add_argument('--trace', metavar = 'FILE',
+                        help = "record a timeline of the loop's phases, written to FILE as Chrome trace JSON on exit or SIGUSR1")
+    args = parser.parse_args()
+    
+    trace = None
+    if args.trace:
+        import tracer
+        trace = tracer.Tracer(name = "NetPong server")
+        trace.install(args.trace)
+    
+    options = dict(udp = args.udp, loss = args.loss, lag_compensation = args.lag_compensation, admin_port = args.admin_port,
+                   step_ticks = args.step_ticks, record_dir = args.record, spectator_port = args.spectator_port,
+                   spectator_interval = 1 / args.spectator_rate, hibernation = args.hibernation, trace = trace)
+    if args.engine == 'asyncio':
+        import asyncserver
+        asyncserver.main(args.port, **options)
+        exit()
+    
+    s = Server(args.port, **options)
     s.start()
     
     s.listen()
     print("Waiting for connections...")
     
-    s.connection_thread.start()
-        
     while True:
         s.tick()
     
-    print("Exiting...")
\ No newline at end of file
+    print("Exiting...")
@@ -0,0 +1,345 @@
+import math
+
+import packet
+
+def vec2add(a, b):
+    return (a[0] + b[0], a[1] + b[1])
+
+def vec2mul(a, b):
+    return (a[0] * b[0], a[1] * b[1])
+
+def vec2scalarmul(a, b):
+    return (a * b[0], a * b[1])
+
+def vec2div(a,b):
+    return (a[0] / b[0], a[1] / b[1])
+
+def vec2quantize(a):
+    return (int(a[0]), int(a[1]))
+
+def vec2mag(a): #returns scalar
+    return math.sqrt(a[0] ** 2 + a[1] ** 2)
+
+'''
+Player inputs fed to the simulation each step
+'''
+class PlayerInput:
+    def __init__(self):
+        self.p1y = 45 #paddle y positions
+        self.p2y = 45
+        self.p1_key = 0 #key presses (for serving), cleared once a serve is taken
+        self.p2_key = 0
+        self.players = 0 #number of players in the match
+        self.p1_lag = 0 #ticks between the server simulating a tick and that player's reaction to it arriving
+        self.p2_lag = 0
+    
+    def __str__(self):
+        return "P1 Y: {}, P2 Y: {}, P1 Key: {}, P2 Key: {}, Players: {}, Lag: {}".format(self.p1y, self.p2y,
+                                                                                    self.p1_key, self.p2_key,
+                                                                                    self.players,
+                                                                                    (self.p1_lag, self.p2_lag))
+
+'''
+Headless match simulation
+
+Knows nothing about sockets or wall clock time, everything is counted in
+ticks, so the same inputs always produce the same states and it can be
+stepped as fast as the CPU allows.
+
+The ball is moved by sweeping its path for the step against the walls and
+the paddle planes, so hits and bounces land where the path crosses them
+however far the ball travels in one step. A step can cover several ticks
+(step_ticks) and the ball can move more than a unit per tick
+(ball_speed) without passing through a paddle; game time is still
+counted in ticks of tick_interval either way. A step that runs out of
+bounces (max_bounces) leaves the ball on its last crossing and carries
+the time it didn't use into the next step, it never moves unchecked.
+
+Lag compensation: each player's paddle positions are kept in a short ring
+buffer indexed by the tick that player was looking at when they set it
+(the current tick minus their lag). When the ball reaches a lagged
+player's paddle and misses, the point is held until the paddle for that
+view tick is known. If the player had the paddle there on their screen,
+the hit is applied at the crossing and the ball is replayed forward.
+'''
+class Simulation:
+    w_court = 160
+    h_court = 90
+    paddle_sep = 5
+    paddle_len = 9
+    
+    tick_interval = 0.01 #seconds of game time per tick
+    end_ticks = 500 #ticks to show the end screen for
+    max_lag_ticks = 20 #lag compensation never looks further back than this
+    
+    ball_speed = 1 #units per tick
+    max_bounces = 8 #walls and paddles resolved per step, past that the ball stops at the last one until the next step
+    
+    win_score = 10
+    
+    left_plane = paddle_sep + 1 #x the ball crosses to reach each paddle
+    right_plane = w_court - paddle_sep
+    
+    def __init__(self, step_ticks = 1):
+        self.step_ticks = step_ticks #ticks of game time per step
+        self.step_interval = step_ticks * self.tick_interval
+        
+        self.state = packet.GamePacket() #current game state
+        self.state.server = 3
+        
+        self.ball_subpixel = (-2,-2) #float vector to convert to int for sending out state
+        self.ball_velocity = (0,0) #vector describing ball velocity
+        self.ball_carry = 0 #ticks of movement the last step ran out of bounces for, added to the next one
+        
+        self.tick = 0 #ticks of game time so far
+        self.last_hit = -1 #time of the latest paddle hit
+        self.end_start = 0
+        
+        history_size = self.max_lag_ticks + 4
+        self.paddle_history = ([45] * history_size, [45] * history_size) #per player, paddle y by view tick
+        self.view_ticks = [0, 0] #newest view tick in each player's history
+        self.missed = [None, None] #per player, (time, ball position, ball velocity, lag) of a miss waiting on their view
+        
+        self.trace = None #tracer.Tracer for the stages of a step, None to not trace
+    
+    #only call during a hit
+    def get_velocity_from_hit(self, player_y, ball_pos, ball_v):
+        v = vec2mul(ball_v, (-1,1))
+        m = vec2mag(v) #vector magnitude
+        v_x = v[0] / abs(v[0])#1 = right, -1 = left
+        
+        if abs(player_y - ball_pos[1]) <= self.paddle_len/6: #center hit (center 1/3 of paddle)
+            return (m * v_x, 0) #go straight
+        elif player_y - ball_pos[1] < 0: #if ball is below
+            return (m * v_x * 1/math.sqrt(2), m * 1/math.sqrt(2)) #go down
+        elif player_y - ball_pos[1] > 0: #if ball is above
+            return (m * v_x * 1/math.sqrt(2), m * -1/math.sqrt(2)) #go up
+    
+    #move the ball for duration ticks from time start, bouncing off walls and paddles where its path crosses them,
+    #along with any time carried over from the step before (which started that much earlier)
+    def move_ball(self, inputs, start, duration):
+        trace = self.trace
+        if trace:
+            trace.begin('move_ball')
+        remaining = duration + self.ball_carry
+        self.ball_carry = 0
+        for i in range(self.max_bounces):
+            x, y = self.ball_subpixel
+            v_x, v_y = self.ball_velocity
+            
+            #earliest crossing before the end of the move, paddles win ties with walls
+            t = remaining
+            crossing = None #0 = left paddle, 1 = right paddle, 2 = wall
+            if v_x < 0 and x > self.left_plane:
+                t_paddle = (self.left_plane - x) / v_x
+                if t_paddle <= t:
+                    t, crossing = t_paddle, 0
+            elif v_x > 0 and x < self.right_plane:
+                t_paddle = (self.right_plane - x) / v_x
+                if t_paddle <= t:
+                    t, crossing = t_paddle, 1
+            if v_y != 0:
+                t_wall = max(0, ((0 if v_y < 0 else self.h_court) - y) / v_y)
+                if t_wall < t:
+                    t, crossing = t_wall, 2
+            
+            if crossing is None:
+                break
+            
+            remaining -= t
+            if trace:
+                trace.begin('bounce')
+            if crossing == 2: #wall bounce
+                self.ball_subpixel = (x + v_x * t, 0 if v_y < 0 else self.h_court)
+                self.ball_velocity = (v_x, -v_y)
+            else:
+                self.ball_subpixel = ((self.left_plane, self.right_plane)[crossing], y + v_y * t)
+                self.paddle_crossing(inputs, crossing, start + duration - remaining)
+            if trace:
+                trace.end()
+        else: #out of bounces, wait on the last crossing rather than move the rest of the way unchecked
+            self.ball_carry = remaining
+            if trace:
+                trace.end()
+            return
+        
+        x, y = self.ball_subpixel
+        v_x, v_y = self.ball_velocity
+        self.ball_subpixel = (x + v_x * remaining, y + v_y * remaining)
+        if trace:
+            trace.end()
+    
+    #the ball is on a paddle's plane at the given time, bounce it off the paddle or note the miss for lag compensation,
+    #it only crosses a plane heading towards its paddle, so a hit can't be counted twice
+    def paddle_crossing(self, inputs, player, time):
+        paddle_y = (self.state.p1y, self.state.p2y)[player]
+        lag = (inputs.p1_lag, inputs.p2_lag)[player]
+        if abs(paddle_y - self.ball_subpixel[1]) <= self.paddle_len/2:
+            self.ball_velocity = self.get_velocity_from_hit(paddle_y, self.ball_subpixel, self.ball_velocity)
+            self.last_hit = time
+        elif lag > 0 and self.missed[player] is None:
+            self.missed[player] = (time, self.ball_subpixel, self.ball_velocity, min(lag, self.max_lag_ticks))
+    
+    #store each player's paddle against the tick they were looking at
+    def record_paddles(self, inputs):
+        for player, y, lag in ((0, inputs.p1y, inputs.p1_lag), (1, inputs.p2y, inputs.p2_lag)):
+            history = self.paddle_history[player]
+            view = self.tick - min(lag, self.max_lag_ticks)
+            first = min(self.view_ticks[player] + 1, view) #lag shrinking skips view ticks, fill them in
+            for v in range(max(first, view - len(history) + 1), view + 1):
+                history[v % len(history)] = y
+            self.view_ticks[player] = view
+    
+    #settle misses once the paddle each player had at the crossing (as they saw it) is known
+    def resolve_misses(self, inputs):
+        for player in (0, 1):
+            if self.missed[player] is None:
+                continue
+            time, pos, velocity, lag = self.missed[player]
+            if self.tick - time < lag:
+                continue
+            
+            self.missed[player] = None
+            if self.last_hit >= time: #hit normally later on
+                continue
+            
+            history = self.paddle_history[player]
+            tick = int(time)
+            for view in range(tick - 1, min(tick + 1, self.view_ticks[player]) + 1): #a tick either side absorbs lag jitter
+                paddle_y = history[view % len(history)]
+                if abs(paddle_y - pos[1]) <= self.paddle_len/2:
+                    self.ball_subpixel = pos
+                    self.ball_velocity = self.get_velocity_from_hit(paddle_y, pos, velocity)
+                    self.ball_carry = 0
+                    self.last_hit = time
+                    now = self.tick - self.step_ticks #this step's own move comes after
+                    self.move_ball(inputs, time, now - time) #catch up to where the ball would be now
+                    break
+    
+    #steps these inputs can take with nothing but the tick and the paddle history changing: 0 while the ball is
+    #in play or something is about to happen, None if it stays that way until the inputs change
+    def idle_steps(self, inputs):
+        state = self.state
+        if state.p1y != inputs.p1y or state.p2y != inputs.p2y:
+            return 0
+        if state.server == 3:
+            return None if inputs.players < 2 else 0
+        if state.server == 1:
+            return None if inputs.players >= 2 and inputs.p1_key != 32 else 0
+        if state.server == 2:
+            return None if inputs.players >= 2 and inputs.p2_key != 32 else 0
+        if state.server == 4:
+            return max(0, (self.end_start + self.end_ticks - self.tick) // self.step_ticks)
+        return 0
+    
+    #take n idle steps at once (see idle_steps), the result is the same as stepping n times
+    def skip(self, inputs, n):
+        self.tick += n * self.step_ticks
+        self.record_paddles(inputs) #fills in every view tick passed over
+    
+    #advance n steps with the same inputs, returns the resulting state
+    def step(self, inputs, n = 1):
+        for i in range(n):
+            self.step_once(inputs)
+        return self.state
+    
+    def step_once(self, inputs):
+        trace = self.trace
+        self.tick += self.step_ticks
+        
+        self.state.p1y = inputs.p1y
+        self.state.p2y = inputs.p2y
+        self.record_paddles(inputs)
+        
+        '''
+        State Machine:
+        -0 = game
+        -1 = p1_serve
+        -2 = p2_serve
+        -3 = waiting
+        -4 = end
+        '''
+        
+        '''
+        State machine transitions
+        '''
+        if trace:
+            trace.begin('transitions')
+        if self.state.server == 0:
+            if trace:
+                trace.begin('misses')
+            self.resolve_misses(inputs)
+            if trace:
+                trace.end()
+            
+            #out of bounds, held while a miss is waiting on that player's view
+            if self.ball_subpixel[0] < 0 and self.missed[0] is None: #out on player 1
+                self.ball_subpixel = (80,100)
+                self.state.score = vec2add(self.state.score,(0,1))
+                self.state.server = 2
+            elif self.ball_subpixel[0] > self.w_court and self.missed[1] is None: #out on player 2
+                self.ball_subpixel = (80,100)
+                self.state.score = vec2add(self.state.score,(1,0))
+                self.state.server = 1
+            if self.state.score[0] > self.win_score or self.state.score[1] > self.win_score:
+                self.end_start = self.tick
+                self.state.server = 4 #win mode
+        elif self.state.server == 1:
+            if inputs.players < 2:
+                self.state.server = 3
+            elif inputs.p1_key == 32:
+                if trace:
+                    trace.begin('serve')
+                self.ball_subpixel = (self.paddle_sep + 1, self.state.p1y)
+                self.ball_velocity = (self.ball_speed,0)
+                self.ball_carry = 0
+                self.state.server = 0
+                self.missed = [None, None]
+                inputs.p1_key = 0
+                if trace:
+                    trace.end()
+        elif self.state.server == 2:
+            if inputs.players < 2:
+                self.state.server = 3
+            elif inputs.p2_key == 32:
+                if trace:
+                    trace.begin('serve')
+                self.ball_subpixel = (self.w_court - self.paddle_sep - 1, self.state.p2y)
+                self.ball_velocity = (-self.ball_speed,0)
+                self.ball_carry = 0
+                self.state.server = 0
+                self.missed = [None, None]
+                inputs.p2_key = 0
+                if trace:
+                    trace.end()
+        elif self.state.server == 3: #wait for players
+            if inputs.players >= 2:
+                self.state.server = 1 #start game
+        elif self.state.server == 4: #end
+            if self.tick - self.end_start > self.end_ticks:
+                #determine who serves first based on winner
+                if self.state.score[0] > self.state.score[1] and inputs.players >= 2:
+                    self.state.server = 1
+                elif self.state.score[1] > self.state.score[0] and inputs.players >= 2:
+                    self.state.server = 2
+                else:
+                    self.state.server = 3
+                
+                self.state.score = (0,0)
+                self.ball_subpixel = (80,100)
+        if trace:
+            trace.end()
+        '''
+        State machine actions
+        '''
+        if trace:
+            trace.begin('actions')
+        if self.state.server == 0: #game
+            self.move_ball(inputs, self.tick - self.step_ticks, self.step_ticks)
+        
+        '''
+        Universal Actions
+        '''
+        self.state.ball = vec2quantize(self.ball_subpixel)
+        if trace:
+            trace.end()
@@ -0,0 +1,153 @@
+import argparse
+import bisect
+import socket
+import time
+
+'''
+Server metrics: plain counters and fixed-bucket histograms
+
+Everything here is cheap to update from the tick loop, recording is an
+integer add or a bisect into a short list, so the bookkeeping costs the
+same no matter how long the server has been up. The report is only built
+when someone asks for it over the admin socket.
+'''
+
+'''
+Histogram of durations with power of two buckets from 1 us to about 1 s
+'''
+class Histogram:
+    bounds = [0.000001 * 2 ** i for i in range(21)] #bucket upper bounds (seconds), the last bucket catches the rest
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.worst = 0
+    
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.worst:
+            self.worst = value
+    
+    #upper bound of the bucket holding the pth percentile, never more than the largest value recorded
+    def percentile(self, p):
+        target = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(self.bounds[i], self.worst) if i < len(self.bounds) else self.worst
+        return 0
+    
+    def __str__(self):
+        mean = self.total / self.count if self.count else 0
+        return "count={} mean={:.3f} p50<={:.3f} p99<={:.3f} max={:.3f}".format(self.count,
+                                                                               mean * 1000,
+                                                                               self.percentile(50) * 1000,
+                                                                               self.percentile(99) * 1000,
+                                                                               self.worst * 1000)
+
+'''
+Whole-server counters, per connection counters live on server.Connection
+'''
+class Metrics:
+    phases = ('recv', 'simulate', 'broadcast')
+    
+    def __init__(self):
+        self.start = time.time()
+        
+        self.accepted = 0
+        self.disconnected = 0
+        self.ticks = 0 #match steps
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages_received = 0
+        self.snapshots_sent = 0
+        self.spectator_snapshots = 0
+        self.datagrams_sent = 0
+        self.datagrams_received = 0
+        self.datagrams_dropped = 0 #lost on purpose (--loss)
+        self.send_failures = 0
+        self.slow_drops = 0 #users dropped for falling too far behind
+        
+        self.phase = {name : Histogram() for name in self.phases} #time spent per phase of the loop (seconds)
+
+#plain text report, one "name value" line per metric then one line per connection
+def report(server):
+    metrics = server.metrics
+    lines = [
+        "uptime_s {:.1f}".format(time.time() - metrics.start),
+        "matches {}".format(len(server.matches)),
+        "hibernating {}".format(sum(1 for match in server.matches if match.hibernating)),
+        "users {}".format(len(server.connections)),
+        "spectators {}".format(sum(1 for conn in server.connections.values() if conn.spectator)),
+    ]
+    for name in ('accepted', 'disconnected', 'ticks', 'bytes_sent', 'bytes_received', 'messages_received',
+                'snapshots_sent', 'spectator_snapshots', 'datagrams_sent', 'datagrams_received', 'datagrams_dropped',
+                'send_failures', 'slow_drops'):
+        lines.append("{} {}".format(name, getattr(metrics, name)))
+    for name in metrics.phases:
+        lines.append("phase_{}_ms {}".format(name, metrics.phase[name]))
+    
+    for conn in list(server.connections.values()):
+        lines.append(("conn {} match={} spectator={} udp={} bytes_sent={} bytes_received={} snapshots_sent={} "
+                      "snapshots_coalesced={} queued={} send_failures={} rtt_ms={} ping_ms={} jitter_ms={} "
+                      "clock_offset_ms={} input_depth={} inputs_late={}").format(
+            conn.id,
+            conn.match.id if conn.match else "-",
+            int(conn.spectator),
+            int(conn.udp_addr is not None),
+            conn.bytes_sent,
+            conn.bytes_received,
+            conn.snapshots_sent,
+            conn.snapshots_coalesced,
+            conn.queued_bytes(),
+            conn.send_failures,
+            "{:.1f}".format(conn.srtt * 1000) if conn.srtt is not None else "-",
+            "{:.1f}".format(conn.clock.rtt * 1000) if conn.clock.rtt is not None else "-",
+            "{:.1f}".format(conn.clock.jitter * 1000) if conn.clock.jitter is not None else "-",
+            "{:+.1f}".format(conn.clock.offset * 1000) if conn.clock.offset is not None else "-",
+            conn.input_buffer.depth,
+            conn.input_buffer.late))
+    
+    return ("\n".join(lines) + "\n").encode()
+
+#one line load report from a launcher's worker (see launcher.py), cpu is the share of a core used since the last one
+def worker_status(server, cpu):
+    return "users={} matches={} open={} adopted={} ticks={} cpu={:.3f} jitter_p99_ms={:.3f}\n".format(
+        len(server.connections),
+        len(server.matches),
+        sum(1 for match in server.matches if not match.is_full()),
+        server.adopted,
+        server.metrics.ticks,
+        cpu,
+        server.tick_stats.percentile(99) * 1000).encode()
+
+def parse_status(line):
+    return {key : float(value) for key, value in (field.split('=') for field in line.split())}
+
+#admin socket, local connections only: every connection gets the report and is closed
+def admin_socket(port):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen()
+    sock.setblocking(False)
+    return sock
+
+#print a running server's report
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "NetPong server stats")
+    parser.add_argument('--port', type = int, default = 10001, help = "the server's admin port")
+    args = parser.parse_args()
+    
+    with socket.create_connection(('127.0.0.1', args.port)) as sock:
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    print(b''.join(chunks).decode(), end = '')
@@ -0,0 +1,84 @@
+import atexit
+import json
+import os
+import signal
+import threading
+import time
+
+'''
+Span timeline for the server and client loops, exported as Chrome
+trace-event JSON (open it in chrome://tracing or ui.perfetto.dev)
+
+Tracing is opt-in. Code that can be traced holds a Tracer or None and
+writes every span as
+    
+    if trace:
+        trace.begin('select')
+    ...
+    if trace:
+        trace.end()
+
+so with tracing off a span costs one test of a local. Events go into a
+ring allocated up front and the oldest are overwritten once it's full,
+so a long run keeps its last few seconds. Nothing is formatted until the
+ring is dumped, on exit or on demand with SIGUSR1 (see install).
+'''
+class Tracer:
+    def __init__(self, **kwargs):
+        self.size = kwargs.get('size', 200000) #events kept, the oldest are overwritten
+        self.name = kwargs.get('name', "NetPong") #process name shown in the viewer
+        
+        self.events = [None] * self.size #(phase, name, perf_counter time, thread id)
+        self.count = 0 #events written in total
+        self.origin = time.perf_counter()
+    
+    def begin(self, name):
+        self.events[self.count % self.size] = ('B', name, time.perf_counter(), threading.get_ident())
+        self.count += 1
+    
+    #ends the innermost open span on this thread, as in the trace format
+    def end(self):
+        self.events[self.count % self.size] = ('E', None, time.perf_counter(), threading.get_ident())
+        self.count += 1
+    
+    #events still in the ring, oldest first
+    def recent(self):
+        if self.count <= self.size:
+            return self.events[:self.count]
+        start = self.count % self.size
+        return self.events[start:] + self.events[:start]
+    
+    #the ring as a list of trace events, ends whose begin was overwritten are left out
+    def trace_events(self):
+        pid = os.getpid()
+        thread_names = {thread.ident : thread.name for thread in threading.enumerate()}
+        trace_events = [{'name' : 'process_name', 'ph' : 'M', 'pid' : pid, 'args' : {'name' : self.name}}]
+        
+        depth = {} #thread id -> spans open
+        for phase, name, at, thread in self.recent():
+            if thread not in depth:
+                depth[thread] = 0
+                trace_events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : thread,
+                                     'args' : {'name' : thread_names.get(thread, str(thread))}})
+            if phase == 'E':
+                if depth[thread] == 0:
+                    continue
+                depth[thread] -= 1
+            else:
+                depth[thread] += 1
+            event = {'ph' : phase, 'ts' : round((at - self.origin) * 1e6, 1), 'pid' : pid, 'tid' : thread}
+            if name:
+                event['name'] = name
+            trace_events.append(event)
+        return trace_events
+    
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents' : self.trace_events(), 'displayTimeUnit' : 'ms'}, f)
+        print("Wrote {} trace events to {}".format(min(self.count, self.size), path))
+    
+    #dump to path on exit and whenever the process gets SIGUSR1, call from the main thread
+    def install(self, path):
+        atexit.register(self.dump, path)
+        if hasattr(signal, 'SIGUSR1'): #not on Windows
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump(path))